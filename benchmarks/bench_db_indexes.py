@@ -0,0 +1,172 @@
+"""
+Частые запросы к users.db без индексов DB_INDEXES и с ними + проверка планов EXPLAIN QUERY PLAN.
+
+Синтетическая база создаётся во временной папке (по умолчанию 100 тыс. пользователей
+и 10 млн записей истории баллов — генерация занимает несколько минут).
+С --check база маленькая и только проверяется, что каждый запрос идёт по своему индексу;
+при расхождении код выхода 1.
+
+Запуск из корня проекта (нужен config.py, как для самого бота):
+    python benchmarks/bench_db_indexes.py [--users 100000] [--history 10000000] [--check]
+"""
+import argparse
+import atexit
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+TMP_DIR = tempfile.mkdtemp()
+atexit.register(shutil.rmtree, TMP_DIR, ignore_errors=True)
+os.environ['DB_PATH'] = os.path.join(TMP_DIR, 'bench_users.db')
+
+from gitbot import DB_INDEXES, create_db_indexes, db_transaction, get_db_connection, init_db
+from spiski import AVAILABLE_CITIES
+
+START = datetime(2024, 1, 1)
+CITIES = list(AVAILABLE_CITIES)
+
+# (название, SQL как в боте, параметры, индекс, который должен быть в плане)
+QUERIES = [
+    ('история баллов пользователя',
+     'SELECT date, amount, reason, admin_id FROM points_history WHERE user_id = ? ORDER BY date DESC LIMIT 10',
+     lambda args: (random.randint(1, args.users),), 'idx_points_history_user_date'),
+    ('отчёт по баллам за неделю',
+     'SELECT ph.date, u.first_name, ph.amount FROM points_history ph '
+     'LEFT JOIN users u ON ph.user_id = u.user_id WHERE ph.date >= ? AND ph.date <= ?',
+     lambda args: week_range(), 'idx_points_history_date'),
+    ('получатели муниципалитета',
+     'SELECT user_id FROM users WHERE city = ? AND is_banned = 0',
+     lambda args: (random.choice(CITIES),), 'idx_users_city_banned'),
+    ('рейтинг муниципалитетов',
+     "SELECT city, COUNT(*), SUM(points), ROUND(AVG(points), 1), MAX(points) FROM users "
+     "WHERE city != 'Не указан' AND is_banned = 0 GROUP BY city",
+     lambda args: (), 'idx_users_city_banned'),
+    ('топ пользователей',
+     'SELECT user_id, first_name, city, points FROM users ORDER BY points DESC LIMIT 15',
+     lambda args: (), 'idx_users_points'),
+    ('загрузка дедлайнов',
+     'SELECT id, task_name, assigned_city, due_date, deadline_notified FROM bot_tasks '
+     'WHERE is_completed = 0 AND due_date IS NOT NULL AND due_date > ?',
+     lambda args: (stamp(700),), 'idx_bot_tasks_open_due'),
+    ('отчёт по распушу',
+     'SELECT city, links, completed_at, user_id FROM raspush_completions WHERE task_id = ? ORDER BY completed_at',
+     lambda args: (random.randint(1, 1000),), 'idx_raspush_completions_task'),
+    ('участники планёрок',
+     'SELECT COUNT(mh.id) FROM meetings_history mh WHERE mh.user_id = ?',
+     lambda args: (random.randint(1, args.users),), 'idx_meetings_history_user'),
+]
+
+
+def stamp(days):
+    return (START + timedelta(days=days)).strftime("%Y-%m-%d %H:%M:%S")
+
+
+def week_range():
+    day = random.uniform(0, 700)
+    return stamp(day), stamp(day + 7)
+
+
+def fill(args):
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.executemany(
+        'INSERT INTO users (user_id, first_name, city, points, is_banned) VALUES (?, ?, ?, ?, ?)',
+        ((i, f"Пользователь {i}", random.choice(CITIES), random.randint(0, 500),
+          int(random.random() < 0.05)) for i in range(1, args.users + 1)))
+    cursor.executemany(
+        'INSERT INTO points_history (user_id, amount, reason, admin_id, date) VALUES (?, ?, ?, ?, ?)',
+        ((random.randint(1, args.users), random.randint(-5, 20), 'Начисление', 1,
+          stamp(random.uniform(0, 730))) for _ in range(args.history)))
+    cursor.executemany(
+        'INSERT INTO bot_tasks (task_name, assigned_city, due_date, is_completed, deadline_notified) '
+        'VALUES (?, ?, ?, ?, 0)',
+        ((f"Задача {i}", random.choice(CITIES), stamp(random.uniform(0, 730)),
+          int(random.random() < 0.8)) for i in range(args.tasks)))
+    cursor.executemany(
+        'INSERT OR IGNORE INTO raspush_completions (task_id, user_id, city, links, completed_at) '
+        'VALUES (?, ?, ?, ?, ?)',
+        ((random.randint(1, 1000), random.randint(1, args.users), f"Город {i}", 'https://t.me/x',
+          stamp(random.uniform(0, 730))) for i in range(args.users)))
+    cursor.executemany(
+        'INSERT INTO meetings_history (user_id, meeting_date, meeting_topic) VALUES (?, ?, ?)',
+        ((random.randint(1, args.users), stamp(random.uniform(0, 730)), 'Планёрка')
+         for _ in range(args.users * 2)))
+    conn.commit()
+
+
+def drop_indexes():
+    conn = get_db_connection()
+    for name, _, _ in DB_INDEXES:
+        conn.execute(f'DROP INDEX IF EXISTS {name}')
+    conn.execute('ANALYZE')
+    conn.commit()
+
+
+def plan(sql, params):
+    rows = get_db_connection().execute(f'EXPLAIN QUERY PLAN {sql}', params).fetchall()
+    return ' | '.join(row['detail'] for row in rows)
+
+
+def measure(args):
+    conn = get_db_connection()
+    results = {}
+    for name, sql, make_params, _ in QUERIES:
+        random.seed(7)
+        started = time.perf_counter()
+        for _ in range(args.repeat):
+            conn.execute(sql, make_params(args)).fetchall()
+        results[name] = (time.perf_counter() - started) / args.repeat * 1000
+    return results
+
+
+def check_plans(args):
+    failed = 0
+    for name, sql, make_params, index in QUERIES:
+        detail = plan(sql, make_params(args))
+        ok = index in detail
+        failed += not ok
+        print(f"{'OK ' if ok else 'ERR'} {name}: {detail}")
+    return failed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=100_000)
+    parser.add_argument('--history', type=int, default=10_000_000)
+    parser.add_argument('--tasks', type=int, default=50_000)
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--check', action='store_true', help='маленькая база, только проверка планов')
+    args = parser.parse_args()
+    if args.check:
+        args.users, args.history, args.tasks = 2_000, 50_000, 2_000
+
+    random.seed(42)
+    init_db()
+    drop_indexes()
+    started = time.perf_counter()
+    fill(args)
+    print(f"База: {args.users} пользователей, {args.history} записей истории "
+          f"({time.perf_counter() - started:.1f} c)")
+
+    if not args.check:
+        before = measure(args)
+
+    started = time.perf_counter()
+    with db_transaction() as conn:
+        create_db_indexes(conn.cursor())
+    print(f"Индексы созданы за {time.perf_counter() - started:.1f} c\n")
+
+    failed = check_plans(args)
+    if not args.check:
+        after = measure(args)
+        print(f"\n{'запрос':<30} {'без индексов, мс':>17} {'с индексами, мс':>16}")
+        for name in before:
+            print(f"{name:<30} {before[name]:>17.2f} {after[name]:>16.2f}")
+
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,96 @@
+"""
+Сравнение нормализации столбца 'Дата': старый построчный цикл и normalize_task_dates.
+
+Запуск из корня проекта (нужен config.py, как для самого бота):
+    python benchmarks/bench_task_dates.py [кол-во строк ...]
+"""
+import os
+import random
+import re
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from gitbot import TASK_DATE_FORMATS, normalize_task_dates
+
+
+def legacy_normalize(df):
+    """Прежний вариант: цикл по строкам, regex и до семи strptime на строку"""
+    for i in range(len(df)):
+        date_str = df.at[i, 'Дата']
+
+        if not date_str or date_str in ['', 'nan', 'None', 'NaT', '<NA>']:
+            df.at[i, 'Дата'] = ""
+        else:
+            date_str = str(date_str).strip()
+
+            if re.match(r'\d{2}\.\d{2}\.\d{4}', date_str):
+                df.at[i, 'Дата'] = date_str
+            else:
+                parsed = False
+                for fmt in TASK_DATE_FORMATS:
+                    try:
+                        dt = datetime.strptime(date_str, fmt)
+                        df.at[i, 'Дата'] = dt.strftime("%d.%m.%Y")
+                        parsed = True
+                        break
+                    except ValueError:
+                        continue
+                if not parsed:
+                    df.at[i, 'Дата'] = date_str
+    return df
+
+
+def make_workbook(rows, path):
+    """Синтетический файл задач со смесью форматов дат"""
+    start = datetime(2025, 1, 1)
+    formats = ["%d.%m.%Y", "%Y-%m-%d %H:%M:%S", "%Y-%m-%d", "%m/%d/%Y", "%d-%m-%Y", None, ""]
+    dates = []
+    for _ in range(rows):
+        fmt = random.choice(formats)
+        if fmt is None:
+            dates.append("до конца месяца")
+        elif fmt == "":
+            dates.append("")
+        else:
+            dates.append((start + timedelta(days=random.randint(0, 365))).strftime(fmt))
+
+    pd.DataFrame({
+        'Дата': dates,
+        'Задача': [f"Задача {i}" for i in range(rows)],
+        'Описание': ["Описание"] * rows,
+        'Ответственный': ["Все муниципалитеты"] * rows,
+    }).to_excel(path, index=False)
+
+
+def run(rows):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, f"tasks_{rows}.xlsx")
+        make_workbook(rows, path)
+        source = pd.read_excel(path, engine='openpyxl', converters={'Дата': str})
+        source['Дата'] = source['Дата'].fillna('').astype(str)
+
+    df = source.copy()
+    t0 = time.perf_counter()
+    legacy = legacy_normalize(df)['Дата']
+    legacy_time = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    display, _ = normalize_task_dates(source['Дата'])
+    vector_time = time.perf_counter() - t0
+
+    mismatches = int((legacy.astype(str).values != display.astype(str).values).sum())
+    print(f"{rows:>7} строк: цикл {legacy_time:.3f} c, векторно {vector_time:.3f} c, "
+          f"ускорение x{legacy_time / vector_time:.1f}, расхождений: {mismatches}")
+
+
+if __name__ == '__main__':
+    random.seed(42)
+    sizes = [int(arg) for arg in sys.argv[1:]] or [10_000, 100_000]
+    for size in sizes:
+        run(size)
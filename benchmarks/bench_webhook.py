@@ -0,0 +1,160 @@
+"""
+Нагрузочный прогон приёма обновлений: вебхук против long polling.
+
+Обновления (записанные JSON из getUpdates/вебхука, по одному на строку, или синтетические)
+поступают с заданной частотой. Вебхук получает их POST-запросами на локальный сервер
+create_webhook_server, polling — через подменённый bot.get_updates пачками до 100 штук
+с задержкой сети --rtt-ms. Обработчики заменены паузой --work-ms, поэтому меряется путь
+приёма и раздачи по потокам: пропускная способность и задержка от поступления до конца обработки.
+
+Запуск из корня проекта (нужен config.py, как для самого бота):
+    python benchmarks/bench_webhook.py [--updates updates.jsonl] [--count 5000] [--rate 500]
+"""
+import argparse
+import http.client
+import json
+import os
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import gitbot
+from gitbot import WEBHOOK_PATH, create_webhook_server, poll_updates, start_update_workers
+from telebot import types
+
+
+def make_payloads(count, chats):
+    """Синтетические обновления: сообщения и нажатия кнопок от chats пользователей"""
+    payloads = []
+    for i in range(count):
+        user = {'id': random.randint(1, chats), 'is_bot': False, 'first_name': 'Тест'}
+        chat = {'id': user['id'], 'type': 'private'}
+        message = {'message_id': i, 'from': user, 'chat': chat, 'date': int(time.time()), 'text': '/start'}
+        if i % 2:
+            payloads.append({'message': message})
+        else:
+            payloads.append({'callback_query': {'id': str(i), 'from': user, 'chat_instance': '1',
+                                                'message': message, 'data': 'my_points'}})
+    return payloads
+
+
+def load_payloads(path):
+    with open(path, encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+class Run:
+    """Расписание поступления и отметки окончания обработки по update_id"""
+
+    def __init__(self, payloads, rate, first_id):
+        self.payloads = []
+        for offset, payload in enumerate(payloads):
+            payload = dict(payload)
+            payload['update_id'] = first_id + offset
+            self.payloads.append(payload)
+        self.first_id = first_id
+        self.start = time.perf_counter() + 0.2
+        step = 1 / rate if rate else 0
+        self.arrival = [self.start + i * step for i in range(len(payloads))]
+        self.done = {}
+        self.finished = threading.Event()
+
+    def mark_done(self, update_id):
+        self.done[update_id] = time.perf_counter()
+        if len(self.done) == len(self.payloads):
+            self.finished.set()
+
+    def report(self, name):
+        latencies = sorted(self.done[self.first_id + i] - self.arrival[i] for i in range(len(self.payloads)))
+        elapsed = max(self.done.values()) - self.start
+        p = lambda q: latencies[min(len(latencies) - 1, int(len(latencies) * q))] * 1000
+        print(f"{name:>8}: {len(latencies)} обновлений за {elapsed:.2f} c, "
+              f"{len(latencies) / elapsed:.0f} обн/с, p50 {p(0.5):.1f} мс, "
+              f"p99 {p(0.99):.1f} мс, макс {latencies[-1] * 1000:.1f} мс")
+
+
+def install_fake_handler(work_ms, runs):
+    def process_new_updates(updates):
+        for update in updates:
+            time.sleep(work_ms / 1000)
+            runs[-1].mark_done(update.update_id)
+    gitbot.bot.process_new_updates = process_new_updates
+
+
+def bench_webhook(run, concurrency):
+    server = create_webhook_server('127.0.0.1', 0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    port = server.server_address[1]
+    local = threading.local()
+
+    def post(i):
+        delay = run.arrival[i] - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        if not hasattr(local, 'conn'):
+            local.conn = http.client.HTTPConnection('127.0.0.1', port)
+        body = json.dumps(run.payloads[i]).encode('utf-8')
+        local.conn.request('POST', WEBHOOK_PATH, body, {'Content-Type': 'application/json'})
+        local.conn.getresponse().read()
+
+    with ThreadPoolExecutor(concurrency) as pool:
+        list(pool.map(post, range(len(run.payloads))))
+    run.finished.wait()
+    server.shutdown()
+    server.server_close()
+
+
+def bench_polling(run, rtt_ms):
+    def get_updates(offset=None, timeout=20, long_polling_timeout=20, **kwargs):
+        # Telegram держит запрос, пока нет обновлений, и отдаёт не больше 100 за раз
+        index = (offset or run.first_id) - run.first_id
+        while index >= len(run.payloads):
+            time.sleep(1)
+        wait = run.arrival[index] - time.perf_counter()
+        if wait > 0:
+            time.sleep(wait)
+        time.sleep(rtt_ms / 2000)
+        now = time.perf_counter()
+        batch = []
+        while index < len(run.payloads) and len(batch) < 100 and run.arrival[index] <= now:
+            batch.append(types.Update.de_json(json.dumps(run.payloads[index])))
+            index += 1
+        time.sleep(rtt_ms / 2000)
+        return batch
+
+    gitbot.bot.get_updates = get_updates
+    threading.Thread(target=poll_updates, daemon=True).start()
+    run.finished.wait()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--updates', help='файл с записанными обновлениями (JSON на строку)')
+    parser.add_argument('--count', type=int, default=5000)
+    parser.add_argument('--chats', type=int, default=300)
+    parser.add_argument('--rate', type=float, default=500, help='обновлений в секунду, 0 — всё сразу')
+    parser.add_argument('--work-ms', type=float, default=5, help='время обработки одного обновления')
+    parser.add_argument('--concurrency', type=int, default=gitbot.WEBHOOK_MAX_CONNECTIONS)
+    parser.add_argument('--rtt-ms', type=float, default=60, help='сетевая задержка до api.telegram.org')
+    args = parser.parse_args()
+
+    random.seed(42)
+    payloads = load_payloads(args.updates) if args.updates else make_payloads(args.count, args.chats)
+    print(f"Потоков обработки: {gitbot.UPDATE_WORKERS}, обработка {args.work_ms} мс, "
+          f"поступление {f'{args.rate:g} обн/с' if args.rate else 'всё сразу'}")
+
+    runs = []
+    install_fake_handler(args.work_ms, runs)
+    start_update_workers()
+
+    runs.append(Run(payloads, args.rate, first_id=1))
+    bench_webhook(runs[-1], args.concurrency)
+    runs[-1].report('webhook')
+
+    runs.append(Run(payloads, args.rate, first_id=len(payloads) + 1))
+    bench_polling(runs[-1], args.rtt_ms)
+    runs[-1].report('polling')
@@ -5,13 +5,25 @@ import sqlite3
 import threading
 import telebot
 import time
+import queue
+import requests
 from telebot import types
+from telebot.apihelper import ApiTelegramException
 from datetime import datetime, timedelta
 import pandas as pd
 import os
 import traceback
 import re
 import hashlib
+import uuid
+import heapq
+import random
+import signal
+from contextlib import contextmanager
+from collections import OrderedDict
+from bisect import bisect_right
+from openpyxl import Workbook, load_workbook
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 # Отключаем SSL проверку для requests
 import ssl
@@ -21,9 +33,131 @@ from config import bot, ADMIN_IDS, RULES_TEXT, EXCEL_FILE_PATH
 from spiski import AVAILABLE_CITIES, ACHIEVEMENT_EMOJIS, STICKER_IDS, ACHIEVEMENT_MESSAGES, COUNTERS_CONFIG
 
 TASKS_PER_PAGE = 5  # Количество задач на одной странице
+# Где хранятся задачи муниципалитетам:
+# 'excel'  — рабочий файл EXCEL_FILE_PATH (по умолчанию)
+# 'sqlite' — таблица sheet_tasks, Excel используется только для импорта/экспорта
+TASKS_STORAGE = os.getenv('TASKS_STORAGE', 'excel')
+TASKS_EXPORT_DELAY = 10  # Через сколько секунд после последнего изменения выгружать задачи в Excel
+REPORTS_DIR = os.getenv('REPORTS_DIR', 'reports')  # Готовые отчёты, пока не изменились данные
+REPORT_FETCH_SIZE = 1000  # Строк из базы за раз при записи отчёта
+REPORT_WORKERS = 2  # Потоков формирования отчётов
+REPORT_PROGRESS_INTERVAL = 3  # Как часто обновлять сообщение о ходе формирования (секунд)
+REPORT_CACHE_DAYS = 7  # Сколько хранить готовые отчёты
+report_queue = queue.Queue()
+report_requests = {}  # {(тип, параметры): кто ждёт отчёт, который сейчас формируется}
+report_workers = []
+report_lock = threading.Lock()
 
 # Глобальный словарь для кэша рассылки
 broadcast_cache = {}
+# Кэш задач из Excel: общий для всех потоков, ключ — (mtime, размер) файла
+tasks_cache = {
+    'key': None,
+    'tasks': None,
+    'index': None,
+    'hits': 0,
+    'misses': 0
+}
+tasks_cache_lock = threading.Lock()
+# Кэш собранных экранов (личный кабинет, достижения, рейтинг): {владелец: {экран: (текст, клавиатура)}}.
+# Владелец — user_id, для общих экранов None. Сбрасывается при изменении данных (invalidate_screens)
+SCREEN_CACHE_SIZE = 5000  # Пользователей в кэше, дольше всех не открывавшие экраны вытесняются
+screen_cache = OrderedDict()  # Порядок — от давно открывавших к недавним (LRU)
+screen_versions = {}  # {владелец: номер изменения} — чтобы не закэшировать экран из старых данных
+screen_metrics = {}  # {экран: {'hits', 'misses', 'render_total', 'render_max'}}
+screen_cache_lock = threading.Lock()
+# Все изменения файла задач идут через одну блокировку
+excel_lock = threading.RLock()
+# Очередь исходящих сообщений (рассылки и уведомления)
+OUTBOUND_WORKERS = 4  # Потоков отправки
+OUTBOUND_GLOBAL_RATE = 25  # Сообщений в секунду на всего бота (лимит Telegram — около 30)
+OUTBOUND_CHAT_INTERVAL = 1.0  # Не чаще одного сообщения в секунду в один чат
+OUTBOUND_MAX_RETRIES = 3  # Повторов при временных ошибках
+OUTBOUND_PROGRESS_INTERVAL = 3  # Как часто обновлять прогресс рассылки у админа (секунд)
+outbound_queue = queue.Queue()
+outbound_jobs = {}  # {job_id: состояние рассылки}
+outbound_chat_next = {}  # {chat_id: время, раньше которого в чат не пишем}
+outbound_rate = {'next_slot': 0.0, 'paused_until': 0.0}
+outbound_lock = threading.Lock()
+# Напоминания о дедлайнах: (за сколько часов, бит в bot_tasks.deadline_notified).
+# Бит 1 — прежнее напоминание за 24 часа, поэтому старые отметки остаются верными
+DEADLINE_REMINDERS = [(72, 2), (24, 1), (2, 4)]
+deadline_heap = []  # [(время напоминания, id задачи)], ближайшее — первым
+deadline_tasks = {}  # {id задачи: данные для напоминания и отправленные биты}
+deadline_lock = threading.Lock()
+# Планировщик фоновых заданий: периодические и разовые задания в одном потоке,
+# состояние запусков — в таблице scheduler_jobs
+SCHEDULER_JITTER = 0.05  # Случайный сдвиг периодического запуска, доля интервала
+scheduler_jobs = {}  # {название: задание}
+scheduler_heap = []  # [(время запуска, номер постановки, название)], ближайшее — первым
+scheduler_state = {'seq': 0, 'thread': None}
+scheduler_condition = threading.Condition()
+shutdown_event = threading.Event()  # Бот останавливается: фоновые циклы завершаются
+# is_banned: 1 — забанен админом, USER_BLOCKED_BOT — пользователь заблокировал бота.
+# Рассылки (enqueue_bulk) берут только is_banned = 0; баллы и рейтинг — is_banned != 1,
+# то есть заблокировавшие бота остаются участниками своего муниципалитета
+USER_BLOCKED_BOT = 2
+# Маршруты кнопок: точные callback_data и префиксное дерево, плюс время обработки
+callback_routes = {}  # {callback_data: маршрут}
+callback_prefix_trie = {}  # {символ: узел}, маршрут лежит в узле под ключом None
+callback_metrics = {}  # {название маршрута: {'count', 'errors', 'total', 'max'}}
+callback_metrics_lock = threading.Lock()
+# Обработка входящих обновлений пулом потоков.
+# Обновления одного чата всегда попадают в один поток — шаги register_next_step_handler
+# идут по порядку, разные чаты обрабатываются параллельно. 0 — старый режим bot.polling
+UPDATE_WORKERS = int(os.getenv('UPDATE_WORKERS', 8))
+UPDATE_QUEUE_SIZE = 50  # Очередь одного потока; когда заполнена, опрос Telegram ждёт
+UPDATE_POLL_TIMEOUT = 30  # Long polling, секунд
+update_queues = []  # Очередь на каждый поток обработки
+update_metrics = {'processed': 0, 'errors': 0, 'wait_total': 0.0, 'wait_max': 0.0,
+                  'work_total': 0.0, 'work_max': 0.0, 'backpressure': 0}
+update_metrics_lock = threading.Lock()
+# Активность пользователей: время последнего обновления держим в памяти,
+# в users.last_active пишем одной пачкой раз в ACTIVITY_FLUSH_INTERVAL секунд и при остановке
+ACTIVITY_FLUSH_INTERVAL = int(os.getenv('ACTIVITY_FLUSH_INTERVAL', 60))
+ACTIVITY_MEMORY_DAYS = 30  # Дольше не заходившие пользователи из памяти убираются
+activity_last_seen = {}  # {user_id: time.time() последнего обновления}
+activity_pending = {}  # {user_id: time.time()} — ещё не записано в базу
+activity_lock = threading.Lock()
+# Способ получения обновлений: 'polling' или 'webhook'.
+# Вебхук слушает обычный HTTP — TLS завершает обратный прокси (nginx и т.п.) на WEBHOOK_URL
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')  # Внешний адрес, например https://bot.example.ru
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', 8080))
+WEBHOOK_PATH = '/telegram-webhook'
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', '')  # Telegram присылает его в X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_MAX_CONNECTIONS = 40
+# База данных: WAL, запись строго по одной (db_write_lock), чтение — отдельными соединениями только для чтения
+DB_PATH = os.getenv('DB_PATH', 'users.db')
+DB_BUSY_TIMEOUT = 5  # Секунд ждать освобождения записи, потом "database is locked"
+DB_MMAP_SIZE = 256 * 1024 * 1024
+DB_CACHE_SIZE_KB = 16 * 1024
+DB_WRITE_STATEMENTS = ('INSERT', 'UPDATE', 'DELETE', 'REPLACE', 'CREATE', 'DROP', 'ALTER', 'BEGIN')
+db_write_lock = threading.Lock()
+# Автоматические достижения: {тип счётчика: (пороги по возрастанию, достижения в том же порядке)}
+ACHIEVEMENT_THRESHOLDS = {}
+for counter_type, counter_config in COUNTERS_CONFIG.items():
+    thresholds = sorted(counter_config.get('achievements', {}).items())
+    ACHIEVEMENT_THRESHOLDS[counter_type] = ([threshold for threshold, _ in thresholds],
+                                            [achievement_id for _, achievement_id in thresholds])
+AUTO_ACHIEVEMENT_POINTS = 5  # Баллов за автоматическое достижение
+# Индексы под частые запросы: (имя, таблица, столбцы). Новые индексы — через новую миграцию
+DB_INDEXES = [
+    # История баллов пользователя (последние операции) и отчёт за период
+    ('idx_points_history_user_date', 'points_history', 'user_id, date'),
+    ('idx_points_history_date', 'points_history', 'date'),
+    # Получатели по муниципалитету; points — чтобы рейтинг городов считался по индексу
+    ('idx_users_city_banned', 'users', 'city, is_banned, points'),
+    # Топ пользователей
+    ('idx_users_points', 'users', 'points'),
+    # Проверка дедлайнов и активные задачи
+    ('idx_bot_tasks_open_due', 'bot_tasks', 'is_completed, due_date'),
+    # Отчёт по распушу
+    ('idx_raspush_completions_task', 'raspush_completions', 'task_id, completed_at'),
+    # Статистика планёрок
+    ('idx_meetings_history_user', 'meetings_history', 'user_id'),
+]
 # Создаем локальную переменную для потоков
 thread_local = threading.local()
 
@@ -32,17 +166,201 @@ thread_local = threading.local()
 # ==============================
 # 2. БАЗА ДАННЫХ
 # ==============================
+class DbCursor(sqlite3.Cursor):
+    """Курсор, который перед первой записью в транзакции берёт общую блокировку записи"""
+
+    def execute(self, sql, parameters=()):
+        self.connection.begin_write(sql)
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self.connection.end_autocommit_write()
+
+    def executemany(self, sql, seq_of_parameters):
+        self.connection.begin_write(sql)
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            self.connection.end_autocommit_write()
+
+    def executescript(self, sql_script):
+        self.connection.begin_write(sql_script)
+        try:
+            return super().executescript(sql_script)
+        finally:
+            self.connection.end_autocommit_write()
+class DbConnection(sqlite3.Connection):
+    """Соединение потока: пишущие транзакции разных потоков идут строго по очереди.
+
+    Блокировка берётся на первом изменяющем запросе и отпускается в commit/rollback,
+    поэтому SQLite не отвечает "database is locked" при одновременной записи
+    из обработчиков, рассылок и фоновых проверок
+    """
+
+    holds_write = False
+
+    def cursor(self, factory=DbCursor):
+        return super().cursor(factory)
+
+    # Connection.execute* создают курсор в обход cursor(), поэтому переопределяем их тоже
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def executescript(self, sql_script):
+        return self.cursor().executescript(sql_script)
+
+    def begin_write(self, sql):
+        if self.holds_write or not sql.lstrip()[:7].upper().startswith(DB_WRITE_STATEMENTS):
+            return
+        if not db_write_lock.acquire(timeout=DB_BUSY_TIMEOUT):
+            raise sqlite3.OperationalError("database is locked")
+        self.holds_write = True
+
+    def end_autocommit_write(self):
+        # Запрос выполнился вне транзакции (DDL или ошибка до BEGIN) — держать блокировку незачем
+        if self.holds_write and not self.in_transaction:
+            self.release_write()
+
+    def release_write(self):
+        if self.holds_write:
+            self.holds_write = False
+            db_write_lock.release()
+
+    def commit(self):
+        try:
+            super().commit()
+        finally:
+            self.release_write()
+
+    def rollback(self):
+        try:
+            super().rollback()
+        finally:
+            self.release_write()
+def apply_db_pragmas(conn):
+    """Общие настройки соединения: ожидание блокировок, кэш страниц и mmap"""
+    conn.row_factory = sqlite3.Row
+    conn.execute(f"PRAGMA busy_timeout = {DB_BUSY_TIMEOUT * 1000}")
+    conn.execute(f"PRAGMA cache_size = -{DB_CACHE_SIZE_KB}")
+    conn.execute(f"PRAGMA mmap_size = {DB_MMAP_SIZE}")
+    conn.execute("PRAGMA temp_store = MEMORY")
 def get_db_connection():
-    """Потокобезопасное соединение с БД"""
+    """Потокобезопасное соединение с БД (чтение и запись)"""
     if not hasattr(thread_local, 'connection'):
-        thread_local.connection = sqlite3.connect('users.db', check_same_thread=False)
-        thread_local.connection.row_factory = sqlite3.Row
-        thread_local.connection.execute("PRAGMA foreign_keys = ON")
+        conn = sqlite3.connect(DB_PATH, check_same_thread=False, factory=DbConnection)
+        apply_db_pragmas(conn)
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute("PRAGMA synchronous = NORMAL")
+        conn.execute("PRAGMA foreign_keys = ON")
+        thread_local.connection = conn
     return thread_local.connection
+def get_db_read_connection():
+    """Соединение потока только для чтения.
+
+    В режиме WAL читатели не ждут писателя и видят последнее зафиксированное состояние.
+    Незафиксированные изменения своего же потока отсюда не видны — для чтения
+    посреди записи используйте get_db_connection()
+    """
+    if not hasattr(thread_local, 'read_connection'):
+        # Файл и режим WAL создаёт пишущее соединение
+        get_db_connection()
+        conn = sqlite3.connect(f"file:{DB_PATH}?mode=ro", uri=True, check_same_thread=False)
+        apply_db_pragmas(conn)
+        thread_local.read_connection = conn
+    return thread_local.read_connection
+@contextmanager
+def db_transaction():
+    """Транзакция записи: блокировка берётся сразу, commit при выходе, rollback при ошибке.
+
+    Вложенные db_transaction() выполняются в рамках внешней
+    """
+    conn = get_db_connection()
+    depth = getattr(thread_local, 'transaction_depth', 0)
+    if depth == 0:
+        thread_local.after_commit = []
+        if not conn.in_transaction:
+            conn.execute('BEGIN IMMEDIATE')
+    thread_local.transaction_depth = depth + 1
+    try:
+        yield conn
+    except Exception:
+        thread_local.transaction_depth = depth
+        if depth == 0:
+            thread_local.after_commit = []
+            conn.rollback()
+        raise
+    thread_local.transaction_depth = depth
+    if depth == 0:
+        conn.commit()
+        callbacks, thread_local.after_commit = thread_local.after_commit, []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                print(f"Ошибка после сохранения транзакции: {e}")
+def run_after_commit(callback):
+    """Выполнить callback после commit внешней db_transaction() (сразу, если транзакции нет).
+
+    Для уведомлений: пользователь не получит сообщение о том, что потом откатится
+    """
+    if getattr(thread_local, 'transaction_depth', 0):
+        thread_local.after_commit.append(callback)
+    else:
+        callback()
+def rollback_db_writes():
+    """Откатить брошенную транзакцию потока (после ошибки в обработчике), чтобы не держать запись"""
+    conn = getattr(thread_local, 'connection', None)
+    if conn is not None and (conn.in_transaction or conn.holds_write):
+        conn.rollback()
+def get_schema_version():
+    """Номер последней применённой миграции (0 — новая база)"""
+    conn = get_db_connection()
+    try:
+        return conn.execute('SELECT MAX(version) FROM schema_version').fetchone()[0] or 0
+    except sqlite3.OperationalError as e:
+        # Таблицы schema_version ещё нет — её создаёт первая миграция
+        if 'no such table' in str(e):
+            return 0
+        raise
+def run_migrations():
+    """Применить недостающие миграции из DB_MIGRATIONS по порядку.
+
+    Каждая миграция выполняется в своей транзакции вместе с записью в schema_version:
+    при ошибке база остаётся на предыдущей версии. Если всё применено — только чтение версии
+    """
+    current = get_schema_version()
+    for version, description, migrate in DB_MIGRATIONS:
+        if version <= current:
+            continue
+        with db_transaction() as conn:
+            cursor = conn.cursor()
+            migrate(cursor)
+            cursor.execute('INSERT INTO schema_version (version, description, applied_at) VALUES (?, ?, ?)',
+                           (version, description, datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
+        print(f"Миграция базы {version}: {description}")
 def init_db():
     """Инициализация базы данных"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    run_migrations()
+def add_column_if_missing(cursor, table, column, definition):
+    """Добавить колонку в таблицу, если её нет (только для миграций)"""
+    cursor.execute(f'PRAGMA table_info({table})')
+    if column not in [row['name'] for row in cursor.fetchall()]:
+        cursor.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+
+# Миграции: функция получает курсор внутри транзакции. Новые — только в конец списка
+def migration_001_base_schema(cursor):
+    """Базовая схема: все таблицы бота, в том числе для баз, созданных до миграций"""
+    # Применённые миграции
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            description TEXT,
+            applied_at TEXT
+        )
+    ''')
 
     # Таблица распуш-задач
     cursor.execute('''
@@ -136,24 +454,57 @@ def init_db():
         )
     ''')
 
-    # Попытка добавить колонку если она не существует (безопасный вариант)
-    try:
-        cursor.execute('''
-            ALTER TABLE bot_tasks 
-            ADD COLUMN deadline_notified BOOLEAN DEFAULT 0
-        ''')
-    except sqlite3.OperationalError:
-        pass  # Колонка уже существует
+    # Старые базы: колонки, которые раньше добавлялись ALTER TABLE при каждом запуске
+    add_column_if_missing(cursor, 'bot_tasks', 'deadline_notified', 'BOOLEAN DEFAULT 0')
+    add_column_if_missing(cursor, 'bot_tasks', 'is_raspush', 'BOOLEAN DEFAULT 0')
 
-    # Добавляем колонку для распуш-задач
-    try:
-        cursor.execute('''
-            ALTER TABLE bot_tasks 
-            ADD COLUMN is_raspush BOOLEAN DEFAULT 0
-        ''')
-    except sqlite3.OperationalError:
-        pass
 
+    # Таблица задач из Excel (режим TASKS_STORAGE = 'sqlite')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS sheet_tasks (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            task_date TEXT DEFAULT '',
+            due_date TEXT,
+            task_name TEXT NOT NULL,
+            description TEXT DEFAULT '',
+            responsible TEXT DEFAULT '',
+            updated_at TEXT
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_sheet_tasks_responsible ON sheet_tasks (responsible)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_sheet_tasks_due_date ON sheet_tasks (due_date)')
+
+    # Рассылки и статус доставки каждому получателю
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS broadcast_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            title TEXT,
+            text TEXT NOT NULL,
+            parse_mode TEXT,
+            reply_markup TEXT,
+            report_chat_id INTEGER,
+            total INTEGER DEFAULT 0,
+            status TEXT DEFAULT 'running',
+            created_at TEXT,
+            finished_at TEXT
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS broadcast_deliveries (
+            job_id INTEGER,
+            user_id INTEGER,
+            status TEXT DEFAULT 'pending',
+            error_code TEXT,
+            updated_at TEXT,
+            PRIMARY KEY (job_id, user_id),
+            FOREIGN KEY (job_id) REFERENCES broadcast_jobs (id)
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_broadcast_jobs_status ON broadcast_jobs (status)')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_broadcast_deliveries_status
+        ON broadcast_deliveries (job_id, status)
+    ''')
 
     # Таблица достижений пользователей
     cursor.execute('''
@@ -198,7 +549,113 @@ def init_db():
         )
     ''')
 
-    conn.commit()
+    # Журнал снятых достижений
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS removed_achievements_history (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            achievement_id TEXT,
+            admin_id INTEGER,
+            reason TEXT,
+            removed_at TEXT,
+            FOREIGN KEY (user_id) REFERENCES users (user_id)
+        )
+    ''')
+def migration_002_hot_indexes(cursor):
+    """Индексы под частые запросы (DB_INDEXES)"""
+    create_db_indexes(cursor)
+def create_db_indexes(cursor):
+    """Создать индексы из DB_INDEXES и обновить статистику планировщика"""
+    for name, table, columns in DB_INDEXES:
+        cursor.execute(f'CREATE INDEX IF NOT EXISTS {name} ON {table} ({columns})')
+    cursor.execute('ANALYZE')
+def migration_003_city_leaderboard(cursor):
+    """Рейтинг муниципалитетов, который поддерживают триггеры на users"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS city_leaderboard (
+            city TEXT PRIMARY KEY,
+            users_count INTEGER NOT NULL DEFAULT 0,
+            total_points INTEGER NOT NULL DEFAULT 0,
+            max_points INTEGER
+        )
+    ''')
+
+    create_city_leaderboard_triggers(cursor)
+    rebuild_city_leaderboard(cursor)
+def create_city_leaderboard_triggers(cursor):
+    """Триггеры на users, которые поддерживают city_leaderboard (забаненные админом не учитываются)"""
+    # Пользователь выбывает из рейтинга старого города; максимум берётся по индексу (city, is_banned, points)
+    leave_city = '''
+        UPDATE city_leaderboard
+        SET users_count = users_count - 1,
+            total_points = total_points - COALESCE(OLD.points, 0),
+            max_points = (SELECT MAX(points) FROM users WHERE city = OLD.city AND is_banned != 1)
+        WHERE city = OLD.city AND OLD.is_banned != 1;
+        DELETE FROM city_leaderboard WHERE city = OLD.city AND users_count <= 0;
+    '''
+    # ...и попадает в рейтинг нового
+    join_city = '''
+        INSERT INTO city_leaderboard (city, users_count, total_points, max_points)
+        SELECT NEW.city, 1, COALESCE(NEW.points, 0), COALESCE(NEW.points, 0)
+        WHERE NEW.is_banned != 1 AND NEW.city IS NOT NULL
+        ON CONFLICT (city) DO UPDATE SET
+            users_count = users_count + 1,
+            total_points = total_points + excluded.total_points,
+            max_points = MAX(COALESCE(max_points, excluded.max_points), excluded.max_points);
+    '''
+    cursor.execute(f'CREATE TRIGGER IF NOT EXISTS city_leaderboard_insert AFTER INSERT ON users BEGIN {join_city} END')
+    cursor.execute(f'CREATE TRIGGER IF NOT EXISTS city_leaderboard_delete AFTER DELETE ON users BEGIN {leave_city} END')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS city_leaderboard_update
+        AFTER UPDATE OF city, points, is_banned ON users
+        WHEN OLD.city IS NOT NEW.city OR OLD.points IS NOT NEW.points OR OLD.is_banned IS NOT NEW.is_banned
+        BEGIN {leave_city} {join_city} END
+    ''')
+def migration_004_scheduler_jobs(cursor):
+    """Последний и следующий запуск фоновых заданий планировщика"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS scheduler_jobs (
+            name TEXT PRIMARY KEY,
+            title TEXT,
+            interval INTEGER,
+            last_run TIMESTAMP,
+            next_run TIMESTAMP,
+            last_duration REAL,
+            last_error TEXT,
+            runs INTEGER DEFAULT 0,
+            errors INTEGER DEFAULT 0
+        )
+    ''')
+def migration_005_report_files(cursor):
+    """Готовые файлы отчётов и их file_id в Telegram"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS report_files (
+            key TEXT PRIMARY KEY,
+            prefix TEXT NOT NULL,
+            report_type TEXT NOT NULL,
+            path TEXT NOT NULL,
+            file_id TEXT,
+            created_at TIMESTAMP
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_report_files_prefix ON report_files (prefix)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_report_files_created ON report_files (created_at)')
+def migration_006_blocked_users_in_rating(cursor):
+    """Заблокировавшие бота (is_banned = USER_BLOCKED_BOT) снова учитываются в рейтинге"""
+    for name in ('city_leaderboard_insert', 'city_leaderboard_delete', 'city_leaderboard_update'):
+        cursor.execute(f'DROP TRIGGER IF EXISTS {name}')
+    create_city_leaderboard_triggers(cursor)
+    rebuild_city_leaderboard(cursor)
+
+
+DB_MIGRATIONS = [
+    (1, 'Базовая схема', migration_001_base_schema),
+    (2, 'Индексы для частых запросов', migration_002_hot_indexes),
+    (3, 'Рейтинг муниципалитетов', migration_003_city_leaderboard),
+    (4, 'Состояние фоновых заданий', migration_004_scheduler_jobs),
+    (5, 'Готовые отчёты', migration_005_report_files),
+    (6, 'Заблокировавшие бота в рейтинге', migration_006_blocked_users_in_rating),
+]
 
 # ==============================
 # 3. ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ
@@ -218,6 +675,7 @@ def get_or_create_user(user_id, username, first_name, last_name, city='Не ук
         ''', (user_id, username or '', first_name or '', last_name or '',
               city, 0, now, now, 0))
         conn.commit()
+        invalidate_screens(rating=True)
     return True
 def get_user_info(user_id):
     """Информация о пользователе"""
@@ -225,19 +683,69 @@ def get_user_info(user_id):
     cursor = conn.cursor()
     cursor.execute('SELECT * FROM users WHERE user_id = ?', (user_id,))
     return cursor.fetchone()
-def update_user_points(user_id, amount):
-    """Обновление баллов пользователя"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
+def apply_points(user_id, amount, reason, admin_id=None, counter_type=None, counter_amount=1):
+    """Операция с баллами одной транзакцией: баланс, запись в истории и (если указан) счётчик.
+
+    Возвращает (новый баланс, новое значение счётчика). При amount == 0 баланс и история
+    не меняются, баланс возвращается как None. Внутри внешней db_transaction() — в её рамках
+    """
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    new_points = new_counter_value = None
+
+    with db_transaction() as conn:
+        cursor = conn.cursor()
+        if amount:
+            cursor.execute('UPDATE users SET points = points + ? WHERE user_id = ? RETURNING points',
+                           (amount, user_id))
+            row = cursor.fetchone()
+            if row is None:
+                raise ValueError(f"Пользователь {user_id} не найден")
+            new_points = row['points']
+            cursor.execute('''
+                INSERT INTO points_history (user_id, amount, reason, admin_id, date)
+                VALUES (?, ?, ?, ?, ?)
+            ''', (user_id, amount, reason, admin_id, now))
 
-    cursor.execute('UPDATE users SET points = points + ? WHERE user_id = ?', (amount, user_id))
-    cursor.execute('SELECT points FROM users WHERE user_id = ?', (user_id,))
-    new_points = cursor.fetchone()['points']
+            invalidate_screens([user_id], rating=True)
 
-    conn.commit()
-    return new_points
+        if counter_type:
+            new_counter_value = update_user_counter(user_id, counter_type, counter_amount)
+
+    return new_points, new_counter_value
+def apply_points_batch(entries, counter_type=None, counter_amount=1):
+    """Массовое начисление одной транзакцией.
+
+    entries — [(user_id, amount, reason, admin_id)]. Возвращает {user_id: новый баланс}
+    """
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    entries = [entry for entry in entries if entry[1]]
+    balances = {}
+    if not entries:
+        return balances
+
+    with db_transaction() as conn:
+        cursor = conn.cursor()
+        cursor.executemany('UPDATE users SET points = points + ? WHERE user_id = ?',
+                           [(amount, user_id) for user_id, amount, _, _ in entries])
+        cursor.executemany('''
+            INSERT INTO points_history (user_id, amount, reason, admin_id, date)
+            VALUES (?, ?, ?, ?, ?)
+        ''', [(user_id, amount, reason, admin_id, now) for user_id, amount, reason, admin_id in entries])
+
+        if counter_type:
+            update_user_counters_bulk([entry[0] for entry in entries], counter_type, counter_amount)
+
+        user_ids = list({entry[0] for entry in entries})
+        invalidate_screens(user_ids, rating=True)
+        for i in range(0, len(user_ids), 500):
+            chunk = user_ids[i:i + 500]
+            cursor.execute(f'SELECT user_id, points FROM users WHERE user_id IN ({",".join("?" * len(chunk))})',
+                           chunk)
+            balances.update((row['user_id'], row['points']) for row in cursor.fetchall())
+
+    return balances
 def log_points_history(user_id, amount, reason, admin_id):
-    """Логирование операций"""
+    """Запись в истории без изменения баланса (например, отметка о принятой задаче)"""
     conn = get_db_connection()
     cursor = conn.cursor()
 
@@ -253,30 +761,11 @@ def update_user_city(user_id, city):
     cursor = conn.cursor()
     cursor.execute('UPDATE users SET city = ? WHERE user_id = ?', (city, user_id))
     conn.commit()
+    invalidate_screens([user_id], rating=True)
     return True
 def is_admin(user_id):
     """Проверка прав администратора"""
     return user_id in ADMIN_IDS
-def ensure_tables_exist():
-    """Проверить и создать необходимые таблицы, если их нет"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
-    # Проверяем существование таблицы points_history
-    cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='points_history'")
-    if not cursor.fetchone():
-        cursor.execute('''
-            CREATE TABLE points_history (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                amount INTEGER,
-                reason TEXT,
-                admin_id INTEGER,
-                date TEXT,
-                FOREIGN KEY (user_id) REFERENCES users (user_id)
-            )
-        ''')
-    conn.commit()
 
 # Правила и Контент-план
 def save_rules(rules_text):
@@ -360,27 +849,69 @@ def get_content_plan_info():
     }
 
 #Рейтинг
+# city_leaderboard обновляется триггерами на users в той же транзакции, что и баллы,
+# поэтому рейтинг читается без GROUP BY по всей таблице пользователей
+CITY_LEADERBOARD_SQL = '''
+    SELECT city, COUNT(*) as users_count, SUM(COALESCE(points, 0)) as total_points,
+           MAX(points) as max_points
+    FROM users
+    WHERE is_banned != 1 AND city IS NOT NULL
+    GROUP BY city
+'''
 def get_city_rating():
     """Получить рейтинг муниципалитетов по среднему баллу"""
-    conn = get_db_connection()
+    conn = get_db_read_connection()
     cursor = conn.cursor()
 
     cursor.execute('''
         SELECT 
             city,
-            COUNT(*) as users_count,
-            SUM(points) as total_points,
-            ROUND(AVG(points), 1) as avg_points,
-            MAX(points) as max_points
-        FROM users 
-        WHERE city != 'Не указан' AND is_banned = 0
-        GROUP BY city 
+            users_count,
+            total_points,
+            ROUND(CAST(total_points AS REAL) / users_count, 1) as avg_points,
+            max_points
+        FROM city_leaderboard 
+        WHERE city != 'Не указан' AND users_count > 0
         ORDER BY avg_points DESC, total_points DESC
     ''')
 
     return cursor.fetchall()
+def get_top_users(limit):
+    """Топ пользователей по баллам (по индексу idx_users_points — читается только limit строк)"""
+    conn = get_db_read_connection()
+    cursor = conn.cursor()
+    cursor.execute('SELECT user_id, first_name, city, points FROM users ORDER BY points DESC LIMIT ?', (limit,))
+    return cursor.fetchall()
+def rebuild_city_leaderboard(cursor):
+    """Пересчитать city_leaderboard с нуля по таблице users (внутри транзакции)"""
+    cursor.execute('DELETE FROM city_leaderboard')
+    cursor.execute(f'INSERT INTO city_leaderboard (city, users_count, total_points, max_points) {CITY_LEADERBOARD_SQL}')
+def check_city_leaderboard():
+    """Сверить city_leaderboard с пересчётом по users.
+
+    Возвращает список расхождений [(город, сохранено, фактически)], пустой — всё сходится
+    """
+    conn = get_db_read_connection()
+    cursor = conn.cursor()
+
+    cursor.execute('SELECT city, users_count, total_points, max_points FROM city_leaderboard')
+    stored = {row['city']: tuple(row)[1:] for row in cursor.fetchall()}
+    cursor.execute(CITY_LEADERBOARD_SQL)
+    actual = {row['city']: tuple(row)[1:] for row in cursor.fetchall()}
+
+    return [(city, stored.get(city), actual.get(city))
+            for city in sorted(set(stored) | set(actual))
+            if stored.get(city) != actual.get(city)]
 def show_city_rating(chat_id, message_id=None):
     """Показать рейтинг муниципалитетов"""
+    response, markup = get_screen(None, 'city_rating', render_city_rating)
+
+    if message_id:
+        bot.edit_message_text(response, chat_id, message_id, parse_mode='HTML', reply_markup=markup)
+    else:
+        bot.send_message(chat_id, response, parse_mode='HTML', reply_markup=markup)
+def render_city_rating():
+    """Текст и клавиатура рейтинга муниципалитетов"""
     rating = get_city_rating()
 
     if not rating:
@@ -401,13 +932,10 @@ def show_city_rating(chat_id, message_id=None):
     markup = types.InlineKeyboardMarkup()
     markup.add(types.InlineKeyboardButton('🔙 Назад', callback_data='personal_cabinet'))
 
-    if message_id:
-        bot.edit_message_text(response, chat_id, message_id, parse_mode='HTML', reply_markup=markup)
-    else:
-        bot.send_message(chat_id, response, parse_mode='HTML', reply_markup=markup)
+    return response, markup
 def show_city_stats_for_admin(chat_id):
     """Расширенная статистика для админа"""
-    conn = get_db_connection()
+    conn = get_db_read_connection()
     cursor = conn.cursor()
 
     # Топ муниципалитетов по активным задачам
@@ -440,18 +968,284 @@ def make_task_uid(task_name: str) -> str:
     Генерирует короткий безопасный ID задачи (≤ 64 байт)
     """
     return hashlib.md5(task_name.encode('utf-8')).hexdigest()[:16]
+def new_task_id(existing_ids=()):
+    """Новый постоянный ID задачи (короткий, помещается в callback_data)"""
+    while True:
+        task_id = uuid.uuid4().hex[:8]
+        if task_id not in existing_ids:
+            return task_id
+def make_missing_task_ids(rows):
+    """ID для строк без ID: хэш названия задачи (с номером, если такой уже занят).
+
+    rows — [(ID, название)] в порядке строк файла, возвращает ID для каждой строки
+    (у строки без названия остаётся пустым). Чтение и запись в файл получают одинаковые ID,
+    поэтому уже показанные кнопки продолжают работать после того, как ID попадут в файл
+    """
+    blank = lambda value: value is None or pd.isna(value) or str(value).strip() == ''
+    used = {str(task_id) for task_id, _ in rows if not blank(task_id)}
+
+    task_ids = []
+    for task_id, name in rows:
+        if blank(task_id) and not blank(name):
+            name = str(name).strip()
+            task_id = make_task_uid(name)
+            number = 1
+            while task_id in used:
+                task_id = make_task_uid(f"{name}#{number}")
+                number += 1
+            used.add(task_id)
+        task_ids.append(task_id)
+    return task_ids
+def assign_sheet_task_ids(sheet, columns):
+    """Проставить на открытом листе ID строкам без ID. Возвращает число проставленных"""
+    id_col = columns['ID']
+    task_col = columns.get('Задача')
+    if not task_col:
+        return 0
+
+    task_ids = [value for (value,) in sheet.iter_rows(min_row=2, min_col=id_col, max_col=id_col, values_only=True)]
+    names = [value for (value,) in sheet.iter_rows(min_row=2, min_col=task_col, max_col=task_col, values_only=True)]
+    rows = list(zip(task_ids, names))
+
+    assigned = 0
+    for row, (old_id, task_id) in enumerate(zip(task_ids, make_missing_task_ids(rows)), start=2):
+        if old_id != task_id:
+            sheet.cell(row=row, column=id_col, value=task_id)
+            assigned += 1
+    return assigned
+def materialize_task_ids(file_path=None):
+    """Записать в файл ID строкам Excel, у которых его нет (при запуске бота, правкой ячеек)"""
+    file_path = file_path or EXCEL_FILE_PATH
+    with excel_lock:
+        workbook = load_workbook(file_path)
+        sheet = workbook.active
+        if assign_sheet_task_ids(sheet, get_sheet_columns(sheet)):
+            workbook.save(file_path)
+# ==========================
+# ЗАПИСЬ ЗАДАЧ В EXCEL (правки ячеек через openpyxl, без пересборки через pandas)
+# ==========================
+def get_sheet_columns(sheet):
+    """{столбец: номер} по заголовку листа. Столбец ID создаётся при отсутствии"""
+    columns = {cell.value: cell.column for cell in sheet[1] if cell.value}
+    if 'ID' not in columns:
+        columns['ID'] = sheet.max_column + 1
+        sheet.cell(row=1, column=columns['ID'], value='ID')
+    return columns
+def open_tasks_workbook(file_path=None):
+    """Открыть файл задач: (книга, лист, {столбец: номер}).
+
+    Вызывать под excel_lock. Строкам без ID сразу проставляются те же ID,
+    что видит чтение задач, — они запишутся в файл вместе с правкой
+    """
+    workbook = load_workbook(file_path or EXCEL_FILE_PATH)
+    sheet = workbook.active
+    columns = get_sheet_columns(sheet)
+    assign_sheet_task_ids(sheet, columns)
+
+    return workbook, sheet, columns
+def get_sheet_task_ids(sheet, columns):
+    """Все ID задач на листе"""
+    id_col = columns['ID']
+    return {
+        str(value)
+        for (value,) in sheet.iter_rows(min_row=2, min_col=id_col, max_col=id_col, values_only=True)
+        if value not in (None, '')
+    }
+def find_sheet_task_row(sheet, columns, task_id):
+    """Номер строки листа с задачей: позиция из индекса с проверкой ID, иначе поиск по столбцу.
+
+    Задачи здесь не загружаются: индекс берётся из кэша, только если он построен
+    по этой же версии файла, иначе просматривается столбец ID уже открытого листа
+    """
+    task_id = str(task_id)
+    id_col = columns['ID']
+
+    position = None
+    try:
+        key = get_tasks_file_key()
+    except OSError:
+        key = None
+    with tasks_cache_lock:
+        if key is not None and tasks_cache['key'] == key and tasks_cache['index'] is not None:
+            position = tasks_cache['index']['by_id'].get(task_id)
+
+    if position is not None:
+        row = position + 2  # строка 1 — заголовок
+        if row <= sheet.max_row and str(sheet.cell(row=row, column=id_col).value) == task_id:
+            return row
+
+    for row, (value,) in enumerate(
+            sheet.iter_rows(min_row=2, min_col=id_col, max_col=id_col, values_only=True), start=2):
+        if str(value) == task_id:
+            return row
+    return None
+def read_sheet_row(sheet, columns, row):
+    """Значения строки листа по названиям столбцов"""
+    return {name: sheet.cell(row=row, column=col).value for name, col in columns.items()}
+def append_tasks_to_excel(rows):
+    """Дописать задачи в конец листа (одно сохранение файла на весь список). Возвращает ID задач"""
+    with excel_lock:
+        workbook, sheet, columns = open_tasks_workbook()
+        existing_ids = get_sheet_task_ids(sheet, columns)
+
+        task_ids = []
+        for row in rows:
+            task_id = new_task_id(existing_ids)
+            existing_ids.add(task_id)
+            task_ids.append(task_id)
+
+            values = [None] * max(columns.values())
+            for name, value in dict(row, ID=task_id).items():
+                if name in columns:
+                    values[columns[name] - 1] = value
+            sheet.append(values)
+
+        workbook.save(EXCEL_FILE_PATH)
+
+    invalidate_tasks_cache()
+    return task_ids
+def update_excel_task_cells(task_id, values):
+    """Изменить ячейки одной задачи. Возвращает прежние значения строки (None — задача не найдена)"""
+    with excel_lock:
+        workbook, sheet, columns = open_tasks_workbook()
+        row = find_sheet_task_row(sheet, columns, task_id)
+        if row is None:
+            return None
+
+        old_values = read_sheet_row(sheet, columns, row)
+        for name, value in values.items():
+            sheet.cell(row=row, column=columns[name], value=value)
+
+        workbook.save(EXCEL_FILE_PATH)
+
+    invalidate_tasks_cache()
+    return old_values
+def delete_excel_tasks(task_ids):
+    """Удалить строки задач. Возвращает значения удалённых строк"""
+    with excel_lock:
+        workbook, sheet, columns = open_tasks_workbook()
+
+        rows = []
+        for task_id in task_ids:
+            row = find_sheet_task_row(sheet, columns, task_id)
+            if row is not None:
+                rows.append(row)
+
+        if not rows:
+            return []
+
+        deleted = []
+        # Снизу вверх, чтобы номера оставшихся строк не сдвигались
+        for row in sorted(set(rows), reverse=True):
+            deleted.append(read_sheet_row(sheet, columns, row))
+            sheet.delete_rows(row)
+
+        workbook.save(EXCEL_FILE_PATH)
+
+    invalidate_tasks_cache()
+    return deleted
 # ==========================
 # ЭКСЕЛЬ ФУНКЦИИ
 # ==========================
+def get_tasks_file_key():
+    """Ключ кэша задач: время изменения и размер файла"""
+    if TASKS_STORAGE == 'sqlite':
+        # Все записи в таблицу идут через бота и сами сбрасывают кэш
+        return 'sqlite'
+    stat = os.stat(EXCEL_FILE_PATH)
+    return stat.st_mtime_ns, stat.st_size
+def invalidate_tasks_cache():
+    """Сбросить кэш задач (вызывается после каждой записи в Excel)"""
+    with tasks_cache_lock:
+        tasks_cache['key'] = None
+        tasks_cache['tasks'] = None
+        tasks_cache['index'] = None
+def get_tasks_cache_stats():
+    """Счётчики попаданий/промахов кэша задач"""
+    with tasks_cache_lock:
+        hits = tasks_cache['hits']
+        misses = tasks_cache['misses']
+
+    total = hits + misses
+    return {
+        'hits': hits,
+        'misses': misses,
+        'hit_rate': round(hits * 100 / total, 1) if total else 0.0
+    }
 def load_tasks_from_excel():
-    """Загрузить задачи из Excel файла"""
+    """Загрузить задачи из Excel файла (через кэш).
+
+    Возвращает общий для всех потоков список задач — его нельзя изменять на месте.
+    """
+    if TASKS_STORAGE != 'sqlite' and not os.path.exists(EXCEL_FILE_PATH):
+        return None, "Файл с задачами не найден"
+
     try:
-        if not os.path.exists(EXCEL_FILE_PATH):
+        key = get_tasks_file_key()
+    except OSError as e:
+        return None, f"Ошибка при загрузке файла: {str(e)}"
+
+    with tasks_cache_lock:
+        if tasks_cache['tasks'] is not None and tasks_cache['key'] == key:
+            tasks_cache['hits'] += 1
+            return tasks_cache['tasks'], None
+        tasks_cache['misses'] += 1
+
+    if TASKS_STORAGE == 'sqlite':
+        tasks, error = read_tasks_from_db()
+    else:
+        tasks, error = read_tasks_from_excel()
+    if error:
+        return None, error
+
+    index = build_tasks_index(tasks)
+
+    with tasks_cache_lock:
+        tasks_cache['key'] = key
+        tasks_cache['tasks'] = tasks
+        tasks_cache['index'] = index
+
+    return tasks, None
+TASK_DATE_FORMATS = [
+    "%Y-%m-%d %H:%M:%S", "%Y-%m-%d",
+    "%d.%m.%Y", "%m/%d/%Y", "%d-%m-%Y",
+    "%Y/%m/%d", "%d.%m.%y"
+]
+def normalize_task_dates(dates):
+    """Нормализовать столбец 'Дата' целиком.
+
+    Возвращает (строки для отображения в формате ДД.ММ.ГГГГ, разобранные даты).
+    Строки, которые не подошли ни под один формат, остаются как есть, дата для них — NaT
+    """
+    dates = dates.fillna('').astype(str).str.strip()
+    dates = dates.mask(dates.isin(['nan', 'None', 'NaT', '<NA>']), '')
+
+    # Уже отформатированные даты оставляем как есть
+    keep = (dates == '') | dates.str.match(r'\d{2}\.\d{2}\.\d{4}')
+
+    parsed = pd.Series(pd.NaT, index=dates.index, dtype='datetime64[ns]')
+    for fmt in TASK_DATE_FORMATS:
+        pending = ~keep & parsed.isna()
+        if not pending.any():
+            break
+        parsed[pending] = pd.to_datetime(dates[pending], format=fmt, errors='coerce')
+
+    display = dates.where(keep | parsed.isna(), parsed.dt.strftime("%d.%m.%Y"))
+
+    # Дата для сортировки — по итоговой строке, как в parse_task_date
+    due = pd.to_datetime(display, format="%d.%m.%Y", errors='coerce')
+    return display, due
+def read_tasks_from_excel(file_path=None):
+    """Прочитать и нормализовать задачи из Excel файла (без кэша, файл не изменяется)"""
+    file_path = file_path or EXCEL_FILE_PATH
+    try:
+        if not os.path.exists(file_path):
             return None, "Файл с задачами не найден"
 
         # Принудительно читаем все столбцы как строки, но с сохранением дат
         # Используем converters для конкретных столбцов
         converters = {
+            'ID': str,  # Постоянный ID задачи
             'Дата': str,  # Даты читаем как строки
             'Задача': str,  # Задачи как строки
             'Описание': str,  # Описания как строки
@@ -459,14 +1253,14 @@ def load_tasks_from_excel():
         }
 
         df = pd.read_excel(
-            EXCEL_FILE_PATH,
+            file_path,
             engine='openpyxl',
             converters=converters,  # Важно: converters преобразует данные при чтении
             dtype=None  # Отключаем автоматическое определение типов
         )
 
         # Принудительно преобразуем все нужные столбцы в строки (на всякий случай)
-        for col in ['Дата', 'Задача', 'Описание', 'Ответственный']:
+        for col in ['ID', 'Дата', 'Задача', 'Описание', 'Ответственный']:
             if col in df.columns:
                 # Преобразуем все в строки, заменяя NaN, None, 'nan' на пустую строку
                 df[col] = df[col].astype(str).replace({
@@ -478,41 +1272,8 @@ def load_tasks_from_excel():
                     '': ''
                 }).str.strip()
 
-        # Теперь обработка дат
-        for i in range(len(df)):
-            date_str = df.at[i, 'Дата']
-
-            if not date_str or date_str in ['', 'nan', 'None', 'NaT', '<NA>']:
-                df.at[i, 'Дата'] = ""
-            else:
-                # Убираем возможные лишние символы
-                date_str = str(date_str).strip()
-
-                # Если это уже отформатированная дата, оставляем как есть
-                if re.match(r'\d{2}\.\d{2}\.\d{4}', date_str):
-                    df.at[i, 'Дата'] = date_str
-                else:
-                    # Пробуем разные форматы
-                    try:
-                        formats = [
-                            "%Y-%m-%d %H:%M:%S", "%Y-%m-%d",
-                            "%d.%m.%Y", "%m/%d/%Y", "%d-%m-%Y",
-                            "%Y/%m/%d", "%d.%m.%y"
-                        ]
-                        parsed = False
-                        for fmt in formats:
-                            try:
-                                dt = datetime.strptime(date_str, fmt)
-                                df.at[i, 'Дата'] = dt.strftime("%d.%m.%Y")
-                                parsed = True
-                                break
-                            except ValueError:
-                                continue
-                        if not parsed:
-                            # Оставляем как есть
-                            df.at[i, 'Дата'] = date_str
-                    except:
-                        df.at[i, 'Дата'] = date_str
+        # Теперь обработка дат (по всему столбцу сразу)
+        df['Дата'], df['_due'] = normalize_task_dates(df['Дата'])
 
         # Обработка столбца "Ответственный"
         if 'Ответственный' in df.columns:
@@ -542,57 +1303,131 @@ def load_tasks_from_excel():
             if col not in df.columns:
                 return None, f"Отсутствует столбец: {col}"
 
+        # Строкам без ID (например, дописанным в файл вручную) — те же ID,
+        # которые запишет в файл первая правка (open_tasks_workbook)
+        if 'ID' not in df.columns:
+            df['ID'] = ''
+        df['ID'] = make_missing_task_ids(list(zip(df['ID'], df['Задача'])))
+
         tasks = df.to_dict('records')
+        for task in tasks:
+            due = task['_due']
+            task['_due'] = datetime.max if pd.isna(due) else due.to_pydatetime()
         return tasks, None
 
     except Exception as e:
         import traceback
         return None, f"Ошибка при загрузке файла: {str(e)}\n\n{traceback.format_exc()}"
-def filter_tasks_by_city(tasks, city_name):
-    """Отфильтровать задачи по муниципалитету (по ответственному)"""
-    if not tasks:
-        return []
+# Значения "Ответственный", которые означают задачу для всех муниципалитетов
+ALL_CITIES_TOKENS = {'все муниципалитеты', 'all', 'all municipalities', 'municipalities', 'все'}
+# Муниципалитеты в нижнем регистре -> название из AVAILABLE_CITIES
+CITY_TOKENS = {city.lower(): city for city in AVAILABLE_CITIES}
 
-    # ЕСЛИ ЗАДАЧА ДЛЯ ВСЕХ МУНИЦИПАЛИТЕТОВ
-    if city_name == "ALL" or city_name == "Все муниципалитеты":
-        # Показываем ВСЕ задачи, которые не пустые
-        filtered_tasks = []
-        for task in tasks:
-            if task.get('Ответственный'):
-                filtered_tasks.append(task)
-        return filtered_tasks
+def parse_task_date(date_str):
+    """Дата задачи для сортировки (без даты — в конец списка)"""
+    if not date_str:
+        return datetime.max
+
+    for fmt in ["%d.%m.%Y", "%Y-%m-%d", "%m/%d/%Y"]:
+        try:
+            return datetime.strptime(date_str, fmt)
+        except ValueError:
+            continue
+    return datetime.max
+def get_responsible_cities(responsible):
+    """Разобрать поле 'Ответственный' на муниципалитеты.
 
-    city_lower = str(city_name).lower()
-    filtered_tasks = []
+    Возвращает (для_всех, список муниципалитетов). Сравнение — точное по названию
+    из AVAILABLE_CITIES, несколько муниципалитетов можно перечислить через , или ;
+    """
+    for_all = False
+    cities = []
 
-    for task in tasks:
+    for token in re.split(r'[,;\n]', str(responsible or '')):
+        token = token.strip().lower()
+        if not token:
+            continue
+        if token in ALL_CITIES_TOKENS:
+            for_all = True
+        elif token in CITY_TOKENS:
+            cities.append(CITY_TOKENS[token])
+
+    return for_all, cities
+def build_tasks_index(tasks):
+    """Индекс задач: разобранные даты, порядок по сроку и позиции задач по муниципалитетам"""
+    due_dates = [task['_due'] if '_due' in task else parse_task_date(task.get('Дата', ''))
+                 for task in tasks]
+    by_date = sorted(range(len(tasks)), key=lambda i: due_dates[i])
+
+    by_city = {city: [] for city in AVAILABLE_CITIES}
+    all_cities = []
+    assigned = []
+
+    for i, task in enumerate(tasks):
         if task.get('Ответственный'):
-            # Если ответственный содержит "Все муниципалитеты" или "ALL" - показываем всем
-            if 'все муниципалитеты' in str(task['Ответственный']).lower() or 'all' in str(
-                    task['Ответственный']).lower():
-                filtered_tasks.append(task)
-            elif city_lower in str(task['Ответственный']).lower():
-                filtered_tasks.append(task)
-
-    def date_key(task):
-        date_str = task.get('Дата', '')
-        if not date_str:
-            return datetime.max
-        try:
-            # Преобразуем разные форматы дат
-            formats = ["%d.%m.%Y", "%Y-%m-%d", "%m/%d/%Y"]
-            for fmt in formats:
-                try:
-                    return datetime.strptime(date_str, fmt)
-                except ValueError:
-                    continue
-            return datetime.max
-        except:
-            return datetime.max
+            assigned.append(i)
+
+    for i in by_date:
+        for_all, cities = get_responsible_cities(tasks[i].get('Ответственный'))
+        if for_all:
+            all_cities.append(i)
+            for city_positions in by_city.values():
+                city_positions.append(i)
+        else:
+            for city in set(cities):
+                by_city[city].append(i)
+
+    return {
+        'due_dates': due_dates,
+        'by_date': by_date,
+        'by_city': by_city,
+        'all_cities': all_cities,
+        'assigned': assigned,
+        'by_id': {str(task.get('ID')): i for i, task in enumerate(tasks) if task.get('ID')}
+    }
+def get_tasks_index(tasks):
+    """Индекс для списка задач (для закэшированного списка — готовый)"""
+    with tasks_cache_lock:
+        if tasks is tasks_cache['tasks'] and tasks_cache['index'] is not None:
+            return tasks_cache['index']
+    return build_tasks_index(tasks)
+def get_city_task_positions(tasks, city_name):
+    """Позиции задач муниципалитета в списке tasks, отсортированные по сроку"""
+    if not tasks:
+        return []
+
+    index = get_tasks_index(tasks)
+
+    # ЕСЛИ ЗАДАЧА ДЛЯ ВСЕХ МУНИЦИПАЛИТЕТОВ — показываем ВСЕ задачи, которые не пустые
+    if city_name == "ALL" or city_name == "Все муниципалитеты":
+        return index['assigned']
 
-    filtered_tasks.sort(key=date_key)
+    # Муниципалитет не из списка (например, 'Не указан') видит только общие задачи
+    return index['by_city'].get(city_name, index['all_cities'])
+def filter_tasks_by_city(tasks, city_name):
+    """Отфильтровать задачи по муниципалитету (по ответственному)"""
+    return [tasks[i] for i in get_city_task_positions(tasks, city_name)]
+def find_task_by_id(task_id):
+    """Найти задачу по постоянному ID: (задача, позиция в списке) или (None, None)"""
+    tasks, error = load_tasks_from_excel()
+    if error or not tasks:
+        return None, None
+
+    position = get_tasks_index(tasks)['by_id'].get(str(task_id))
+    if position is None:
+        return None, None
+    return tasks[position], position
+def find_task_by_uid(task_uid):
+    """Найти задачу по ID из кнопки; старые кнопки содержат хэш названия"""
+    task, position = find_task_by_id(task_uid)
+    if task is not None:
+        return task, position
 
-    return filtered_tasks
+    tasks, error = load_tasks_from_excel()
+    for position, task in enumerate(tasks or []):
+        if make_task_uid(str(task['Задача'])) == task_uid:
+            return task, position
+    return None, None
 def show_user_tasks_by_city(user_id, chat_id, page=0, message_id=None):
     """Показать задачи пользователя (из Excel + из бота)"""
     user = get_user_info(user_id)
@@ -608,10 +1443,10 @@ def show_user_tasks_by_city(user_id, chat_id, page=0, message_id=None):
         bot.send_message(chat_id, f"❌ {error}")
         return
 
-    # Фильтруем задачи по муниципалитету
-    city_tasks = filter_tasks_by_city(all_tasks, user_city)
+    # Позиции задач муниципалитета (из готового индекса)
+    city_positions = get_city_task_positions(all_tasks, user_city)
 
-    if not city_tasks:
+    if not city_positions:
         response = (
             f"📋 <b>Мои задачи ({user_city})</b>\n\n"
             f"Для вашего муниципалитета ({user_city}) пока нет задач.\n\n"
@@ -628,12 +1463,12 @@ def show_user_tasks_by_city(user_id, chat_id, page=0, message_id=None):
         return
 
     # Пагинация
-    total_tasks = len(city_tasks)
+    total_tasks = len(city_positions)
     total_pages = (total_tasks + TASKS_PER_PAGE - 1) // TASKS_PER_PAGE
 
     start_idx = page * TASKS_PER_PAGE
     end_idx = min(start_idx + TASKS_PER_PAGE, total_tasks)
-    current_tasks = city_tasks[start_idx:end_idx]
+    current_tasks = [all_tasks[i] for i in city_positions[start_idx:end_idx]]
 
     # Формируем ответ
     response = (
@@ -652,15 +1487,13 @@ def show_user_tasks_by_city(user_id, chat_id, page=0, message_id=None):
     # Создаем клавиатуру
     markup = types.InlineKeyboardMarkup(row_width=3)
 
-    # Кнопки для детального просмотра задач
+    # Кнопки для детального просмотра задач (по постоянному ID задачи)
     task_buttons = []
     for i, task in enumerate(current_tasks):
-        # Используем относительный индекс от 0 до TASKS_PER_PAGE-1
-        relative_index = i
         task_buttons.append(
             types.InlineKeyboardButton(
                 f"📄 {start_idx + i + 1}",
-                callback_data=f'show_city_task_detail_{relative_index}_{page}'
+                callback_data=f"show_city_task_detail_{task['ID']}_{page}"
             )
         )
 
@@ -686,7 +1519,7 @@ def show_user_tasks_by_city(user_id, chat_id, page=0, message_id=None):
         bot.edit_message_text(response, chat_id, message_id, parse_mode='HTML', reply_markup=markup)
     else:
         bot.send_message(chat_id, response, parse_mode='HTML', reply_markup=markup)
-def show_task_detail_by_city(user_id, chat_id, relative_index, page_context, message_id=None):
+def show_task_detail_by_city(user_id, chat_id, task_id, page_context, message_id=None):
     """Показать детальное описание задачи для муниципалитета"""
     user = get_user_info(user_id)
     if not user:
@@ -695,23 +1528,17 @@ def show_task_detail_by_city(user_id, chat_id, relative_index, page_context, mes
 
     user_city = user['city']
 
-    # Загружаем ВСЕ задачи
     tasks, error = load_tasks_from_excel()
     if error:
         bot.send_message(chat_id, f"❌ {error}")
         return
 
-    # Фильтруем по муниципалитету
-    city_tasks = filter_tasks_by_city(tasks, user_city)
-
-    # Вычисляем абсолютный индекс с учетом страницы
-    absolute_index = (page_context * TASKS_PER_PAGE) + relative_index  # ← ВАЖНО
-
-    if not city_tasks or absolute_index >= len(city_tasks):
+    # Показываем только задачи из списка муниципалитета пользователя
+    position = get_tasks_index(tasks)['by_id'].get(str(task_id))
+    if position is None or position not in get_city_task_positions(tasks, user_city):
         bot.send_message(chat_id, "❌ Задача не найдена")
         return
-
-    task = city_tasks[absolute_index]  # ← Используем абсолютный инде
+    task = tasks[position]
 
     # Формируем детальный ответ
     response = (
@@ -752,39 +1579,17 @@ def show_all_tasks(chat_id, page=0, message_id=None):
             bot.send_message(chat_id, response, parse_mode='HTML', reply_markup=markup)
         return
 
-    def date_key(task):
-        date_str = task.get('Дата', '')
-        if not date_str:
-            return datetime.max
-        try:
-            formats = ["%d.%m.%Y", "%Y-%m-%d", "%m/%d/%Y"]
-            for fmt in formats:
-                try:
-                    return datetime.strptime(date_str, fmt)
-                except ValueError:
-                    continue
-            return datetime.max
-        except:
-            return datetime.max
-
-    # СОХРАНИТЬ ИСХОДНЫЕ ИНДЕКСЫ ДО СОРТИРОВКИ
-    tasks_with_original_index = list(enumerate(tasks))  # [(0, task1), (1, task2), ...]
-
-    # Сортировка с сохранением оригинальных индексов
-    tasks_with_original_index.sort(key=lambda x: date_key(x[1]))
-
-    # Разделяем отсортированные индексы и задачи
-    sorted_indices = [idx for idx, _ in tasks_with_original_index]
-    sorted_tasks = [task for _, task in tasks_with_original_index]
+    # Порядок по сроку уже посчитан в индексе (оригинальные индексы задач)
+    sorted_indices = get_tasks_index(tasks)['by_date']
 
     # Пагинация для всех задач
-    total_tasks = len(sorted_tasks)
+    total_tasks = len(sorted_indices)
     total_pages = (total_tasks + TASKS_PER_PAGE - 1) // TASKS_PER_PAGE
 
     start_idx = page * TASKS_PER_PAGE
     end_idx = min(start_idx + TASKS_PER_PAGE, total_tasks)
-    current_tasks = sorted_tasks[start_idx:end_idx]
     current_indices = sorted_indices[start_idx:end_idx]  # ← Важно: используем оригинальные индексы!
+    current_tasks = [tasks[idx] for idx in current_indices]
 
     # Формируем ответ
     response = (
@@ -810,7 +1615,7 @@ def show_all_tasks(chat_id, page=0, message_id=None):
         task_buttons.append(
             types.InlineKeyboardButton(
                 f"📄 {original_idx + 1}",  # ← Тоже original_idx + 1
-                callback_data=f'show_all_task_detail_{original_idx}'
+                callback_data=f"show_all_task_detail_{task['ID']}_{page}"
             )
         )
 
@@ -835,19 +1640,18 @@ def show_all_tasks(chat_id, page=0, message_id=None):
         bot.edit_message_text(response, chat_id, message_id, parse_mode='HTML', reply_markup=markup)
     else:
         bot.send_message(chat_id, response, parse_mode='HTML', reply_markup=markup)
-def show_task_detail_all(chat_id, task_index, page_context=None, message_id=None):
+def show_task_detail_all(chat_id, task_id, page_context=None, message_id=None):
     """Показать детали задачи из общего списка"""
     tasks, error = load_tasks_from_excel()
     if error:
         bot.send_message(chat_id, f"❌ {error}")
         return
 
-    if not tasks or task_index >= len(tasks):
+    task, task_index = find_task_by_id(task_id)
+    if task is None:
         bot.send_message(chat_id, "❌ Задача не найдена")
         return
 
-    task = tasks[task_index]
-
     # Проверяем, свободна ли задача
     current_responsible = str(task.get('Ответственный', '')).strip().lower()
 
@@ -873,12 +1677,10 @@ def show_task_detail_all(chat_id, task_index, page_context=None, message_id=None
     markup = types.InlineKeyboardMarkup()
 
     if is_free:
-        task_uid = make_task_uid(task['Задача'])
-
         markup.add(
             types.InlineKeyboardButton(
                 '✅ Принять задачу',
-                callback_data=f'accept_task:{task_uid}'
+                callback_data=f"accept_task:{task['ID']}"
             )
         )
     if page_context is not None:
@@ -892,148 +1694,408 @@ def show_task_detail_all(chat_id, task_index, page_context=None, message_id=None
         bot.send_message(chat_id, response, parse_mode='HTML', reply_markup=markup)
 def add_task_to_excel(task_name, description, assigned_city, due_date=None):
     """Добавить задачу в Excel файл"""
-    try:
-        file_path = EXCEL_FILE_PATH
+    return add_tasks_to_excel(task_name, description, [assigned_city], due_date)
+def add_tasks_to_excel(task_name, description, cities, due_date=None):
+    """Добавить задачу для нескольких муниципалитетов одной записью в Excel"""
+    if TASKS_STORAGE == 'sqlite':
+        return add_tasks_to_db(task_name, description, cities, due_date)
 
-        if not os.path.exists(file_path):
+    try:
+        if not os.path.exists(EXCEL_FILE_PATH):
             return False, "Файл не найден"
 
-        df = pd.read_excel(file_path)
-
-        if due_date:
-            due_date_str = due_date.strftime("%d.%m.%Y")
-        else:
-            due_date_str = ""
-
-        # ИСПРАВЬ ЭТУ СТРОКУ: замени "ALL" на "Все муниципалитеты"
-        display_city = "Все муниципалитеты" if assigned_city == "Все муниципалитеты" else assigned_city
+        due_date_str = due_date.strftime("%d.%m.%Y") if due_date else ""
 
-        # Создаем новую строку
-        new_task = {
-            'Дата': due_date_str,
-            'Задача': task_name,
-            'Описание': description,
-            'Ответственный': display_city  # ← ЗДЕСЬ ИСПРАВЛЕНО
-        }
-
-        df = pd.concat([df, pd.DataFrame([new_task])], ignore_index=True)
-        df.to_excel(file_path, index=False)
+        append_tasks_to_excel([
+            {
+                'Дата': due_date_str,
+                'Задача': task_name,
+                'Описание': description,
+                'Ответственный': city
+            }
+            for city in cities
+        ])
 
         return True, "Задача добавлена в Excel"
 
     except Exception as e:
         return False, f"Ошибка при записи в Excel: {str(e)}"
 def accept_task_by_uid(task_uid, user_id):
-    try:
-        df = pd.read_excel(EXCEL_FILE_PATH, engine='openpyxl')
+    if TASKS_STORAGE == 'sqlite':
+        return accept_task_in_db(task_uid, user_id)
 
-        # Ищем задачу по UID
-        for idx, row in df.iterrows():
-            uid = make_task_uid(str(row['Задача']))
-            if uid == task_uid:
-                user = get_user_info(user_id)
-                if not user:
-                    return False, "❌ Пользователь не найден"
+    try:
+        # Ищем задачу по ID через индекс, без перебора строк
+        task, _ = find_task_by_uid(task_uid)
+        if task is None:
+            return False, "❌ Задача не найдена"
 
-                df.at[idx, 'Ответственный'] = user['city']
-                df.to_excel(EXCEL_FILE_PATH, index=False)
+        user = get_user_info(user_id)
+        if not user:
+            return False, "❌ Пользователь не найден"
 
-                return True, f"✅ Задача принята!\n📍 {user['city']}"
+        if update_excel_task_cells(task['ID'], {'Ответственный': user['city']}) is None:
+            return False, "❌ Задача не найдена"
 
-        return False, "❌ Задача не найдена"
+        return True, f"✅ Задача принята!\n📍 {user['city']}"
 
     except Exception as e:
         return False, f"❌ Ошибка: {str(e)}"
 
-#Формирование отчёта
-def generate_points_history_report(start_date=None, end_date=None):
-    """Сгенерировать отчет по истории начислений баллов"""
+# ==========================
+# ЗАДАЧИ В SQLITE (TASKS_STORAGE = 'sqlite')
+# ==========================
+def make_sheet_due_date(date_str):
+    """Дата из столбца 'Дата' (ДД.ММ.ГГГГ) в формате ГГГГ-ММ-ДД для индекса"""
+    try:
+        return datetime.strptime(str(date_str).strip(), "%d.%m.%Y").strftime("%Y-%m-%d")
+    except ValueError:
+        return None
+def tasks_changed():
+    """Общие действия после изменения задач в БД"""
+    invalidate_tasks_cache()
+    schedule_tasks_export()
+def read_tasks_from_db():
+    """Прочитать задачи из таблицы sheet_tasks в формате строк Excel"""
     try:
         conn = get_db_connection()
         cursor = conn.cursor()
+        cursor.execute('''
+            SELECT id, task_date, task_name, description, responsible
+            FROM sheet_tasks
+            ORDER BY id
+        ''')
 
-        # Формируем запрос с фильтрацией по дате
-        query = '''
-            SELECT 
-                ph.date,
-                ph.user_id,
-                u.first_name,
-                u.city,
-                ph.amount,
-                ph.reason,
-                ph.admin_id,
-                a.first_name as admin_name
-            FROM points_history ph
-            LEFT JOIN users u ON ph.user_id = u.user_id
-            LEFT JOIN users a ON ph.admin_id = a.user_id
-            WHERE 1=1
-        '''
-        params = []
-
-        if start_date:
-            query += " AND ph.date >= ?"
-            params.append(start_date)
+        tasks = []
+        for row in cursor.fetchall():
+            tasks.append({
+                'ID': str(row['id']),
+                'Дата': row['task_date'] or '',
+                'Задача': row['task_name'] or '',
+                'Описание': row['description'] or '',
+                'Ответственный': row['responsible'] or ''
+            })
+        return tasks, None
 
-        if end_date:
-            query += " AND ph.date <= ?"
-            params.append(end_date)
+    except Exception as e:
+        return None, f"Ошибка при загрузке задач из БД: {str(e)}"
+def get_db_task(task_id):
+    """Задача по ID"""
+    try:
+        task_id = int(task_id)
+    except (TypeError, ValueError):
+        return None
 
-        query += " ORDER BY ph.date DESC"
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute('SELECT * FROM sheet_tasks WHERE id = ?', (task_id,))
+    return cursor.fetchone()
+def add_task_to_db(task_name, description, assigned_city, due_date=None):
+    """Добавить задачу в таблицу sheet_tasks"""
+    return add_tasks_to_db(task_name, description, [assigned_city], due_date)
+def add_tasks_to_db(task_name, description, cities, due_date=None):
+    """Добавить задачу для нескольких муниципалитетов одним запросом"""
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
 
-        cursor.execute(query, params)
-        history = cursor.fetchall()
+        now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        cursor.executemany('''
+            INSERT INTO sheet_tasks (task_date, due_date, task_name, description, responsible, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', [
+            (
+                due_date.strftime("%d.%m.%Y") if due_date else "",
+                due_date.strftime("%Y-%m-%d") if due_date else None,
+                task_name,
+                description or "",
+                city,
+                now
+            )
+            for city in cities
+        ])
+        conn.commit()
+        tasks_changed()
 
-        if not history:
-            return None, "Нет данных за указанный период"
+        return True, "Задача добавлена"
 
-        # Создаем DataFrame
-        data = []
-        for row in history:
-            data.append({
-                'Дата': row['date'],
-                'ID пользователя': row['user_id'],
-                'Имя пользователя': row['first_name'] or 'Неизвестно',
-                'Муниципалитет': row['city'] or 'Не указан',
-                'Сумма': row['amount'],
-                'Причина': row['reason'] or '',
-                'ID администратора': row['admin_id'],
-                'Администратор': row['admin_name'] or 'Система'
-            })
+    except Exception as e:
+        return False, f"Ошибка при записи задачи: {str(e)}"
+def update_db_task_responsible(task_id, responsible):
+    """Изменить ответственного у задачи"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute('''
+        UPDATE sheet_tasks SET responsible = ?, updated_at = ? WHERE id = ?
+    ''', (responsible, datetime.now().strftime("%Y-%m-%d %H:%M:%S"), task_id))
+    conn.commit()
+    tasks_changed()
+    return cursor.rowcount > 0
+def delete_db_tasks(task_ids):
+    """Удалить задачи по id"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.executemany('DELETE FROM sheet_tasks WHERE id = ?', [(task_id,) for task_id in task_ids])
+    conn.commit()
+    tasks_changed()
+    return cursor.rowcount
+def delete_db_tasks_by_name(task_name, responsible):
+    """Удалить задачи муниципалитета, название которых содержит task_name"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute('SELECT id, task_name FROM sheet_tasks WHERE responsible = ?', (responsible,))
+
+    # Сравнение без учёта регистра делаем в Python: lower() в SQLite не понимает кириллицу
+    needle = task_name.casefold()
+    task_ids = [row['id'] for row in cursor.fetchall() if needle in (row['task_name'] or '').casefold()]
+
+    if task_ids:
+        delete_db_tasks(task_ids)
+    return len(task_ids)
+def accept_task_in_db(task_uid, user_id):
+    """Принять задачу (режим SQLite)"""
+    try:
+        task, _ = find_task_by_uid(task_uid)
+        if task is None:
+            return False, "❌ Задача не найдена"
+
+        user = get_user_info(user_id)
+        if not user:
+            return False, "❌ Пользователь не найден"
+
+        update_db_task_responsible(task['ID'], user['city'])
+        return True, f"✅ Задача принята!\n📍 {user['city']}"
+
+    except Exception as e:
+        return False, f"❌ Ошибка: {str(e)}"
+def remove_task_from_db(task_id):
+    """Удалить задачу (режим SQLite)"""
+    try:
+        task_row = get_db_task(task_id)
+        if not task_row:
+            return False, "❌ Задача не найдена"
+
+        delete_db_tasks([task_row['id']])
+        return True, f"✅ Задача удалена:\n<b>{task_row['task_name']}</b>\n📍 {task_row['responsible'] or 'Не указан'}"
+
+    except Exception as e:
+        return False, f"❌ Ошибка при удалении: {str(e)}"
+def clear_task_responsible_in_db(task_id):
+    """Очистить поле 'Ответственный' (режим SQLite)"""
+    try:
+        task_row = get_db_task(task_id)
+        if not task_row:
+            return False, "❌ Задача не найдена"
+
+        update_db_task_responsible(task_row['id'], '')
+        return True, f"✅ Ответственный очищен:\n<b>{task_row['task_name']}</b>\n📍 Было: {task_row['responsible'] or 'Не указан'}"
+
+    except Exception as e:
+        return False, f"❌ Ошибка при очистке ответственного: {str(e)}"
+def import_tasks_from_excel(file_path=None):
+    """Загрузить задачи из Excel в sheet_tasks (полная замена списка).
+
+    Строки с ID из выгрузки (export_tasks_to_excel) обновляются на месте, задачи, которых
+    в файле больше нет, удаляются, новые строки без ID получают новый id — поэтому
+    уже отправленные кнопки с ID задач продолжают работать после повторного импорта
+    """
+    tasks, error = read_tasks_from_excel(file_path)
+    if error:
+        return None, error
+
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    rows_by_id = {}
+    new_rows = []
+    for task in tasks:
+        if not task['Задача']:
+            continue
+        values = (task['Дата'], make_sheet_due_date(task['Дата']), task['Задача'],
+                  task['Описание'], task['Ответственный'], now)
+        # ID из базы — целое число; ID режима Excel и повторы считаются новыми строками
+        match = re.fullmatch(r'(\d+)(?:\.0+)?', str(task.get('ID') or '').strip())
+        if match and int(match.group(1)) not in rows_by_id:
+            rows_by_id[int(match.group(1))] = values
+        else:
+            new_rows.append(values)
+
+    try:
+        with db_transaction() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT id FROM sheet_tasks')
+            removed = [row['id'] for row in cursor.fetchall() if row['id'] not in rows_by_id]
+            cursor.executemany('DELETE FROM sheet_tasks WHERE id = ?', [(task_id,) for task_id in removed])
+            cursor.executemany('''
+                INSERT INTO sheet_tasks (id, task_date, due_date, task_name, description, responsible, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (id) DO UPDATE SET
+                    task_date = excluded.task_date,
+                    due_date = excluded.due_date,
+                    task_name = excluded.task_name,
+                    description = excluded.description,
+                    responsible = excluded.responsible,
+                    updated_at = excluded.updated_at
+            ''', [(task_id,) + values for task_id, values in rows_by_id.items()])
+            cursor.executemany('''
+                INSERT INTO sheet_tasks (task_date, due_date, task_name, description, responsible, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', new_rows)
+    except Exception as e:
+        return None, f"Ошибка импорта задач: {str(e)}"
+
+    tasks_changed()
+    return len(rows_by_id) + len(new_rows), None
+def ensure_tasks_imported():
+    """При первом запуске в режиме SQLite перенести задачи из Excel"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute('SELECT 1 FROM sheet_tasks LIMIT 1')
+    if cursor.fetchone() or not os.path.exists(EXCEL_FILE_PATH):
+        return
+
+    count, error = import_tasks_from_excel(EXCEL_FILE_PATH)
+    if error:
+        print(f"Не удалось импортировать задачи из Excel: {error}")
+    else:
+        print(f"Импортировано задач из Excel: {count}")
+def export_tasks_to_excel():
+    """Выгрузить задачи из sheet_tasks в EXCEL_FILE_PATH"""
+    try:
+        tasks, error = read_tasks_from_db()
+        if error:
+            print(error)
+            return False
+
+        df = pd.DataFrame(tasks, columns=['Дата', 'Задача', 'Описание', 'Ответственный', 'ID'])
+
+        # Пишем во временный файл и подменяем, чтобы не оставить файл недописанным
+        tmp_path = f"{EXCEL_FILE_PATH}.tmp.xlsx"
+        with excel_lock:
+            df.to_excel(tmp_path, index=False)
+            os.replace(tmp_path, EXCEL_FILE_PATH)
+        return True
+
+    except Exception as e:
+        print(f"Ошибка выгрузки задач в Excel: {e}")
+        return False
+def schedule_tasks_export():
+    """Отложенная выгрузка в Excel: серия изменений даёт одну запись файла"""
+    schedule_job('tasks_export', export_tasks_to_excel, delay=TASKS_EXPORT_DELAY,
+                 title="Выгрузка задач в Excel", run_on_shutdown=True)
+
+#Формирование отчёта
+POINTS_REPORT_COLUMNS = ['Дата', 'ID пользователя', 'Имя пользователя', 'Муниципалитет',
+                         'Сумма', 'Причина', 'ID администратора', 'Администратор']
+def generate_points_history_report(start_date=None, end_date=None, filename=None, progress=None):
+    """Сгенерировать отчет по истории начислений баллов.
+
+    Итоги по муниципалитетам и ширины столбцов считает один запрос GROUP BY,
+    строки истории читаются порциями и сразу пишутся в книгу write_only —
+    память не зависит от длины периода. progress(записано, всего) вызывается по ходу записи
+    """
+    try:
+        conn = get_db_read_connection()
+        cursor = conn.cursor()
+
+        # Фильтр по дате — общий для итогов и строк
+        where = "WHERE 1=1"
+        params = []
+
+        if start_date:
+            where += " AND ph.date >= ?"
+            params.append(start_date)
+
+        if end_date:
+            where += " AND ph.date <= ?"
+            params.append(end_date)
+
+        joins = '''
+            FROM points_history ph
+            LEFT JOIN users u ON ph.user_id = u.user_id
+            LEFT JOIN users a ON ph.admin_id = a.user_id
+        '''
+
+        # Итоги по муниципалитетам и самые длинные значения каждого столбца.
+        # В режиме write_only ширину надо задать до первой строки, поэтому она считается здесь
+        cursor.execute(f'''
+            SELECT 
+                COALESCE(NULLIF(u.city, ''), 'Не указан') AS city,
+                SUM(ph.amount) AS total,
+                COUNT(DISTINCT ph.user_id) AS users_count,
+                COUNT(*) AS rows_count,
+                MAX(LENGTH(ph.date)),
+                MAX(LENGTH(ph.user_id)),
+                MAX(LENGTH(COALESCE(NULLIF(u.first_name, ''), 'Неизвестно'))),
+                MAX(LENGTH(COALESCE(NULLIF(u.city, ''), 'Не указан'))),
+                MAX(LENGTH(ph.amount)),
+                MAX(LENGTH(COALESCE(ph.reason, ''))),
+                MAX(LENGTH(ph.admin_id)),
+                MAX(LENGTH(COALESCE(NULLIF(a.first_name, ''), 'Система')))
+            {joins}
+            {where}
+            GROUP BY 1
+            ORDER BY 1
+        ''', params)
+        summary = cursor.fetchall()
+
+        if not summary:
+            return None, "Нет данных за указанный период"
 
-        df = pd.DataFrame(data)
+        widths = [len(column) for column in POINTS_REPORT_COLUMNS]
+        for row in summary:
+            widths = [max(width, row[4 + i] or 0) for i, width in enumerate(widths)]
+        total_rows = sum(row['rows_count'] for row in summary)
+        written = 0
 
-        # Добавляем итоговую статистику
-        summary = df.groupby('Муниципалитет').agg({
-            'Сумма': 'sum',
-            'ID пользователя': 'nunique'
-        }).reset_index()
+        workbook = Workbook(write_only=True)
+        worksheet = workbook.create_sheet('История операций')
+        for i, width in enumerate(widths):
+            worksheet.column_dimensions[chr(ord('A') + i)].width = min(width + 2, 50)
+        worksheet.append(POINTS_REPORT_COLUMNS)
 
-        summary.columns = ['Муниципалитет', 'Всего баллов', 'Уникальных пользователей']
+        cursor.execute(f'''
+            SELECT 
+                ph.date,
+                ph.user_id,
+                u.first_name,
+                u.city,
+                ph.amount,
+                ph.reason,
+                ph.admin_id,
+                a.first_name as admin_name
+            {joins}
+            {where}
+            ORDER BY ph.date DESC
+        ''', params)
+
+        while True:
+            rows = cursor.fetchmany(REPORT_FETCH_SIZE)
+            if not rows:
+                break
+            for row in rows:
+                worksheet.append([
+                    row['date'],
+                    row['user_id'],
+                    row['first_name'] or 'Неизвестно',
+                    row['city'] or 'Не указан',
+                    row['amount'],
+                    row['reason'] or '',
+                    row['admin_id'],
+                    row['admin_name'] or 'Система'
+                ])
+            written += len(rows)
+            if progress:
+                progress(written, total_rows)
+
+        summary_sheet = workbook.create_sheet('Итоги по муниципалитетам')
+        summary_sheet.append(['Муниципалитет', 'Всего баллов', 'Уникальных пользователей'])
+        for row in summary:
+            summary_sheet.append([row['city'], row['total'], row['users_count']])
 
         # Создаем файл
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        filename = f'points_history_{timestamp}.xlsx'
-
-        with pd.ExcelWriter(filename, engine='openpyxl') as writer:
-            df.to_excel(writer, sheet_name='История операций', index=False)
-            summary.to_excel(writer, sheet_name='Итоги по муниципалитетам', index=False)
-
-            # Форматируем
-            workbook = writer.book
-            worksheet = writer.sheets['История операций']
-
-            # Автоширина столбцов
-            for column in worksheet.columns:
-                max_length = 0
-                column_letter = column[0].column_letter
-                for cell in column:
-                    try:
-                        if len(str(cell.value)) > max_length:
-                            max_length = len(str(cell.value))
-                    except:
-                        pass
-                adjusted_width = min(max_length + 2, 50)
-                worksheet.column_dimensions[column_letter].width = adjusted_width
+        if filename is None:
+            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+            filename = f'points_history_{timestamp}.xlsx'
+        workbook.save(filename)
 
         return filename, None
 
@@ -1083,51 +2145,22 @@ def process_report_period(message, chat_id):
             ask_report_period(chat_id)
             return
 
-    # Генерируем отчет
-    bot.send_message(chat_id, f"⏳ Генерирую отчет {period_info}...")
-
-    filename, error = generate_points_history_report(start_date, end_date)
-
-    if error:
-        bot.send_message(chat_id, f"❌ {error}")
-        show_admin_panel(chat_id)
-        return
-
-    # Отправляем файл
-    try:
-        with open(filename, 'rb') as file:
-            bot.send_document(
-                chat_id,
-                file,
-                caption=f"📊 <b>Отчет по истории операций</b>\n{period_info}",
-                parse_mode='HTML'
-            )
-
-        # Удаляем временный файл
-        os.remove(filename)
-
-    except Exception as e:
-        bot.send_message(chat_id, f"❌ Ошибка отправки файла: {str(e)}")
-
-    # Возвращаем в админ-панель
-    show_admin_panel(chat_id)
-def remove_task_from_excel(task_index):
+    # Отчет формируется в фоне, после отправки возвращаем в админ-панель
+    request_report(chat_id, 'points', (start_date, end_date),
+                   f"📊 <b>Отчет по истории операций</b>\n{period_info}",
+                   on_done=lambda: show_admin_panel(chat_id))
+def remove_task_from_excel(task_id):
     """Удалить задачу из Excel файла"""
-    try:
-        # Загружаем Excel
-        df = pd.read_excel(EXCEL_FILE_PATH, engine='openpyxl')
+    if TASKS_STORAGE == 'sqlite':
+        return remove_task_from_db(task_id)
 
-        if task_index >= len(df):
+    try:
+        deleted = delete_excel_tasks([task_id])
+        if not deleted:
             return False, "❌ Задача не найдена"
 
-        # Получаем данные задачи перед удалением
-        task_row = df.iloc[task_index]
-        task_name = task_row['Задача']
-        city = task_row.get('Ответственный', 'Не указан')
-
-        # Удаляем задачу
-        df = df.drop(index=task_index).reset_index(drop=True)
-        df.to_excel(EXCEL_FILE_PATH, index=False)
+        task_name = deleted[0]['Задача']
+        city = deleted[0].get('Ответственный') or 'Не указан'
 
         return True, f"✅ Задача удалена из Excel:\n<b>{task_name}</b>\n📍 {city}"
 
@@ -1137,40 +2170,41 @@ def remove_task_from_excel(task_index):
 # ==============================
 # НОВЫЕ ФУНКЦИИ ДЛЯ УПРАВЛЕНИЯ ОТВЕТСТВЕННЫМИ
 # ==============================
-def clear_task_responsible(task_index):
+def clear_task_responsible(task_id):
     """Очистить поле 'Ответственный' в задаче из Excel"""
-    try:
-        # Загружаем Excel
-        df = pd.read_excel(EXCEL_FILE_PATH, engine='openpyxl')
+    if TASKS_STORAGE == 'sqlite':
+        return clear_task_responsible_in_db(task_id)
 
-        if task_index >= len(df):
+    try:
+        # Очищаем поле Ответственный, получая прежние значения строки
+        old_values = update_excel_task_cells(task_id, {'Ответственный': None})
+        if old_values is None:
             return False, "❌ Задача не найдена"
 
-        # Получаем данные задачи перед очисткой
-        task_row = df.iloc[task_index]
-        task_name = task_row['Задача']
-        old_city = task_row.get('Ответственный', 'Не указан')
-
-        # Очищаем поле Ответственный
-        df.at[task_index, 'Ответственный'] = ''
-        df.to_excel(EXCEL_FILE_PATH, index=False)
+        task_name = old_values['Задача']
+        old_city = old_values.get('Ответственный') or 'Не указан'
 
         return True, f"✅ Ответственный очищен:\n<b>{task_name}</b>\n📍 Было: {old_city}"
 
     except Exception as e:
         return False, f"❌ Ошибка при очистке ответственного: {str(e)}"
-def complete_task_with_points(task_index, user_id, points=0, reason=""):
+def complete_task_with_points(task_id, user_id, points=0, reason=""):
     """Отметить задачу как выполненную и обновить счётчики пользователя"""
     try:
-        # Загружаем Excel
-        df = pd.read_excel(EXCEL_FILE_PATH, engine='openpyxl')
+        if TASKS_STORAGE == 'sqlite':
+            task_row = get_db_task(task_id)
+            if not task_row:
+                return False, "❌ Задача не найдена"
 
-        if task_index >= len(df):
-            return False, "❌ Задача не найдена"
+            task_name = task_row['task_name']
+            responsible_city = task_row['responsible']
+        else:
+            task_row, _ = find_task_by_id(task_id)
+            if task_row is None:
+                return False, "❌ Задача не найдена"
 
-        task_row = df.iloc[task_index]
-        task_name = task_row['Задача']
-        responsible_city = task_row.get('Ответственный', '')
+            task_name = task_row['Задача']
+            responsible_city = task_row.get('Ответственный', '')
 
         # Проверяем, назначена ли задача пользователю
         user = get_user_info(user_id)
@@ -1185,16 +2219,15 @@ def complete_task_with_points(task_index, user_id, points=0, reason=""):
 
         # Удаляем задачу из Excel (или помечаем как выполненную)
         # Вариант 1: Удаляем задачу
-        df = df.drop(index=task_index).reset_index(drop=True)
-        df.to_excel(EXCEL_FILE_PATH, index=False)
-
-        # Обновляем счётчик выполненных задач пользователя
-        new_counter_value = update_user_counter(user_id, 'completed_tasks', 1)
+        if TASKS_STORAGE == 'sqlite':
+            delete_db_tasks([task_row['id']])
+        elif not delete_excel_tasks([task_id]):
+            return False, "❌ Задача не найдена"
 
-        # Начисляем баллы если указаны
-        if points > 0:
-            new_points = update_user_points(user_id, points)
-            log_points_history(user_id, points, f"Выполнение задачи: {task_name} ({reason})", user_id)
+        # Счётчик выполненных задач и баллы (если указаны) — одной операцией
+        _, new_counter_value = apply_points(user_id, points if points > 0 else 0,
+                                            f"Выполнение задачи: {task_name} ({reason})", user_id,
+                                            counter_type='completed_tasks')
 
         return True, f"✅ Задача выполнена!\n📊 Выполнено ТЗ: {new_counter_value}\n{'🏅 +' + str(points) + ' баллов' if points > 0 else ''}"
 
@@ -1204,23 +2237,87 @@ def complete_task_with_points(task_index, user_id, points=0, reason=""):
 # ==============================
 # 4. ФУНКЦИИ ПОЛЬЗОВАТЕЛЬСКОГО ИНТЕРФЕЙСА
 # ==============================
+def get_screen(owner, screen, render):
+    """Экран из кэша или render() -> (текст, клавиатура), None — экран не показать.
+
+    owner — user_id для личных экранов, None для общих (рейтинг)
+    """
+    with screen_cache_lock:
+        metric = screen_metrics.setdefault(screen, {'hits': 0, 'misses': 0, 'render_total': 0.0, 'render_max': 0.0})
+        view = screen_cache.get(owner, {}).get(screen)
+        if view is not None:
+            metric['hits'] += 1
+            screen_cache.move_to_end(owner)
+            return view
+        metric['misses'] += 1
+        version = screen_versions.get(owner, 0)
+
+    started = time.perf_counter()
+    view = render()
+    elapsed = time.perf_counter() - started
+
+    with screen_cache_lock:
+        metric['render_total'] += elapsed
+        metric['render_max'] = max(metric['render_max'], elapsed)
+        # Данные успели измениться, пока экран собирался, — такой экран не кэшируем
+        if view is not None and screen_versions.get(owner, 0) == version:
+            if owner in screen_cache:
+                screen_cache.move_to_end(owner)
+            elif len(screen_cache) >= SCREEN_CACHE_SIZE:
+                screen_cache.popitem(last=False)
+            screen_cache.setdefault(owner, {})[screen] = view
+
+    return view
+def drop_screens(user_ids=(), rating=False):
+    """Удалить экраны из кэша сразу"""
+    owners = list(user_ids) + ([None] if rating else [])
+    with screen_cache_lock:
+        for owner in owners:
+            screen_versions[owner] = screen_versions.get(owner, 0) + 1
+            screen_cache.pop(owner, None)
+def invalidate_screens(user_ids=(), rating=False):
+    """Сбросить личные экраны пользователей (баллы, счётчики, достижения, муниципалитет)
+    и, если rating, рейтинг муниципалитетов.
+
+    Вызывать после commit; внутри db_transaction() сброс сам откладывается до commit,
+    чтобы экран не собрали заново из старых данных
+    """
+    user_ids = list(user_ids)
+    run_after_commit(lambda: drop_screens(user_ids, rating))
+def get_screen_cache_stats():
+    """Попадания в кэш экранов и время сборки по каждому экрану"""
+    with screen_cache_lock:
+        stats = {}
+        for screen, metric in screen_metrics.items():
+            total = metric['hits'] + metric['misses']
+            stats[screen] = {
+                'hits': metric['hits'],
+                'misses': metric['misses'],
+                'hit_rate': round(metric['hits'] * 100 / total, 1) if total else 0.0,
+                'avg_render_ms': round(metric['render_total'] / metric['misses'] * 1000, 1) if metric['misses'] else 0.0,
+                'max_render_ms': round(metric['render_max'] * 1000, 1)
+            }
+        return stats, len(screen_cache)
 def show_personal_cabinet(user_id, chat_id):
-    user = get_user_info(user_id)
-    if not user:
+    # Активность отмечается для каждого входящего обновления в feed_update
+    view = get_screen(user_id, 'personal_cabinet', lambda: render_personal_cabinet(user_id))
+    if view is None:
         bot.send_message(chat_id, "❌ Пользователь не найден")
         return
 
-    # Обновляем активность
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('UPDATE users SET last_active = ? WHERE user_id = ?',
-                   (datetime.now().strftime("%Y-%m-%d %H:%M:%S"), user_id))
-    conn.commit()
+    response, markup = view
+    bot.send_message(chat_id, response, parse_mode='HTML', reply_markup=markup)
+def render_personal_cabinet(user_id):
+    """Текст и клавиатура личного кабинета (None — пользователя нет)"""
+    user = get_user_info(user_id)
+    if not user:
+        return None
 
     # Получаем счётчики
     counters = get_user_counters(user_id)
 
     # Получаем достижения
+    cursor = get_db_read_connection().cursor()
     cursor.execute('''
         SELECT achievement_id, unlocked_at 
         FROM user_achievements 
@@ -1290,7 +2387,7 @@ def show_personal_cabinet(user_id, chat_id):
     if is_admin(user_id):
         markup.add(types.InlineKeyboardButton('⚙️ Админ-панель', callback_data='admin_panel'))
 
-    bot.send_message(chat_id, response, parse_mode='HTML', reply_markup=markup)
+    return response, markup
 def show_city_selection(user_id, chat_id, page=0):
     """Выбор муниципалитета при регистрации"""
     cities_list = list(AVAILABLE_CITIES.items())
@@ -1378,6 +2475,7 @@ def show_achievements_admin_panel(chat_id):
         types.InlineKeyboardButton('➕ Добавить ТЗ', callback_data='admin_add_task'),
         types.InlineKeyboardButton('💡 Добавить идею', callback_data='admin_add_idea'),
         types.InlineKeyboardButton('📋 Добавить планёрку', callback_data='admin_add_meeting'),
+        types.InlineKeyboardButton('👥 Планёрка: несколько', callback_data='admin_add_meeting_group'),
         types.InlineKeyboardButton('🏆 Выдать достижение', callback_data='admin_give_achievement'),
         types.InlineKeyboardButton('🗑️ Снять достижение', callback_data='admin_remove_achievement'),
         types.InlineKeyboardButton('📊 Статистика планёрок', callback_data='admin_meetings_stats'),
@@ -1413,10 +2511,7 @@ def show_achievements_admin_panel(chat_id):
 # Функции для работы с баллами
 def show_user_selection_for_points(chat_id, action='add'):
     """Выбор пользователя для начисления/снятия баллов"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('SELECT user_id, first_name, city, points FROM users ORDER BY points DESC LIMIT 15')
-    users = cursor.fetchall()
+    users = get_top_users(15)
 
     markup = types.InlineKeyboardMarkup(row_width=2)
 
@@ -1531,8 +2626,7 @@ def execute_points_operation(chat_id, target_user_id, points, reason, action, ad
             points_amount = -points
             bot.send_message(chat_id, f"⚠️ Будет списано {points} баллов")
 
-        new_points = update_user_points(target_user_id, points_amount)
-        log_points_history(target_user_id, points_amount, reason, admin_id)
+        new_points, _ = apply_points(target_user_id, points_amount, reason, admin_id)
 
         # Уведомление пользователя
         try:
@@ -1562,7 +2656,7 @@ def execute_points_operation(chat_id, target_user_id, points, reason, action, ad
         bot.send_message(chat_id, f"❌ Ошибка: {str(e)}")
 def show_user_history(user_id, chat_id, message_id=None):
     """Показать историю операций пользователя"""
-    conn = get_db_connection()
+    conn = get_db_read_connection()
     cursor = conn.cursor()
 
     cursor.execute('''
@@ -1603,99 +2697,1234 @@ def show_user_history(user_id, chat_id, message_id=None):
     else:
         bot.send_message(chat_id, response, parse_mode='HTML', reply_markup=markup)
 
-# Функции рассылки
-def show_broadcast_options(chat_id):
-    """Опции рассылки"""
-    markup = types.InlineKeyboardMarkup(row_width=2)
-    buttons = [
-        types.InlineKeyboardButton('📢 Всем пользователям', callback_data='broadcast_all'),
-        types.InlineKeyboardButton('🏙️ Муниципалитету', callback_data='broadcast_by_city'),
-        types.InlineKeyboardButton('🔙 Назад', callback_data='admin_panel')
-    ]
+# ==============================
+# ОЧЕРЕДЬ ИСХОДЯЩИХ СООБЩЕНИЙ
+# ==============================
+def reserve_outbound_slot(chat_id):
+    """Занять ближайшее время отправки с учётом общего лимита и лимита на чат. Возвращает паузу в секундах"""
+    with outbound_lock:
+        now = time.monotonic()
+        slot = max(now, outbound_rate['next_slot'], outbound_rate['paused_until'],
+                   outbound_chat_next.get(chat_id, 0.0))
+
+        outbound_rate['next_slot'] = slot + 1.0 / OUTBOUND_GLOBAL_RATE
+        outbound_chat_next[chat_id] = slot + OUTBOUND_CHAT_INTERVAL
+
+        # Словарь чатов не должен расти бесконечно
+        if len(outbound_chat_next) > 10000:
+            for key in [key for key, value in outbound_chat_next.items() if value < now]:
+                del outbound_chat_next[key]
+
+        return slot - now
+def get_retry_after(error):
+    """Сколько секунд просит подождать Telegram (ответ 429)"""
+    try:
+        return int(error.result_json['parameters']['retry_after'])
+    except (AttributeError, KeyError, TypeError, ValueError):
+        return 5
+def deliver_outbound(item):
+    """Отправить одно сообщение с повторами. Возвращает (успех, код ошибки).
 
-    markup.add(*buttons)
-    bot.send_message(chat_id, "<b>📨 Выберите тип рассылки:</b>", parse_mode='HTML', reply_markup=markup)
-def show_cities_for_broadcast(chat_id):
-    """Выбор муниципалитета для рассылки"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('SELECT DISTINCT city FROM users WHERE city != "Не указан" ORDER BY city')
-    cities = cursor.fetchall()
+    429 не считается попыткой: ждём retry_after столько раз, сколько попросит Telegram
+    """
+    error_code = None
+    attempt = 0
+    while True:
+        time.sleep(reserve_outbound_slot(item['chat_id']))
 
-    markup = types.InlineKeyboardMarkup(row_width=2)
-    for city_record in cities:
-        city = city_record['city']
-        city_emoji = AVAILABLE_CITIES.get(city, '🏙️')
-        markup.add(types.InlineKeyboardButton(f"{city_emoji} {city}", callback_data=f'broadcast_city_{city}'))
+        try:
+            if item.get('sticker'):
+                bot.send_sticker(item['chat_id'], item['sticker'])
+            else:
+                bot.send_message(item['chat_id'], item['text'], **item['kwargs'])
+            return True, None
+
+        except ApiTelegramException as e:
+            if e.error_code == 429:
+                # Ограничение Telegram действует на всего бота — приостанавливаем все потоки
+                retry_after = get_retry_after(e)
+                with outbound_lock:
+                    outbound_rate['paused_until'] = max(outbound_rate['paused_until'],
+                                                        time.monotonic() + retry_after)
+                continue
 
-    markup.add(types.InlineKeyboardButton('🔙 Назад', callback_data='admin_broadcast'))
-    bot.send_message(chat_id, "<b>🏙️ Выберите муниципалитет:</b>", parse_mode='HTML', reply_markup=markup)
-def ask_for_broadcast_text(chat_id, target_type, target_value):
-    """Запрос текста рассылки"""
-    if target_type == 'all':
-        target_info = "📢 <b>Всем пользователям</b>"
-    elif target_type == 'city':
-        city_emoji = AVAILABLE_CITIES.get(target_value, '🏙️')
-        target_info = f"🏙️ <b>Муниципалитету:</b> {city_emoji} {target_value}"
+            if e.error_code < 500:
+                # 400/403: чат не найден, бот заблокирован — повтор не поможет
+                return False, e.error_code
 
-    msg = bot.send_message(
-        chat_id,
-        f"<b>✏️ Введите текст рассылки:</b>\n\n{target_info}",
-        parse_mode='HTML'
-    )
+            error_code = e.error_code
 
-    bot.register_next_step_handler(msg, process_broadcast_text, target_type, target_value, chat_id)
-def process_broadcast_text(message, target_type, target_value, original_chat_id):
-    """Обработка текста рассылки"""
-    broadcast_text = message.text.strip()
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            error_code = 'network'
 
-    if not broadcast_text:
-        bot.send_message(original_chat_id, "❌ Текст не может быть пустым")
-        return
+        # Временная ошибка: ждём дольше с каждой попыткой
+        if attempt >= OUTBOUND_MAX_RETRIES:
+            return False, error_code
+        time.sleep(2 ** attempt)
+        attempt += 1
+def outbound_worker():
+    """Поток отправки: берёт сообщения из общей очереди"""
+    while True:
+        item = outbound_queue.get()
+        # Рассылка продвигается только через update_outbound_job — он должен вызваться при любой ошибке
+        recorded = item['job_id'] is None
+        try:
+            success, error_code = deliver_outbound(item)
+            if not success:
+                print(f"Не удалось отправить сообщение в чат {item['chat_id']}: {error_code}")
+                if item.get('sticker') and item['text'] and error_code != 403:
+                    # Стикер не отправился — вместо него текст (эмодзи)
+                    enqueue_message(item['chat_id'], item['text'])
+            if error_code == 403:
+                mark_user_blocked_bot(item['chat_id'])
+            if not recorded:
+                recorded = True
+                update_outbound_job(item['job_id'], item['chat_id'], success, error_code)
+        except Exception as e:
+            rollback_db_writes()
+            print(f"Ошибка потока отправки: {e}")
+            if not recorded:
+                try:
+                    update_outbound_job(item['job_id'], item['chat_id'], False, type(e).__name__)
+                except Exception as record_error:
+                    rollback_db_writes()
+                    print(f"Ошибка учёта отправки в рассылке {item['job_id']}: {record_error}")
+        finally:
+            outbound_queue.task_done()
+def start_outbound_workers():
+    """Запустить потоки отправки (один раз при старте бота)"""
+    for _ in range(OUTBOUND_WORKERS):
+        threading.Thread(target=outbound_worker, daemon=True).start()
+def mark_user_blocked_bot(user_id):
+    """Пользователь заблокировал бота — исключаем его из рассылок до следующего /start"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute('UPDATE users SET is_banned = ? WHERE user_id = ? AND is_banned = 0',
+                   (USER_BLOCKED_BOT, user_id))
+    conn.commit()
+    invalidate_screens(rating=True)
+def enqueue_message(chat_id, text, job_id=None, **kwargs):
+    """Поставить сообщение в очередь отправки (kwargs — как у bot.send_message)"""
+    outbound_queue.put({'chat_id': chat_id, 'text': text, 'kwargs': kwargs, 'job_id': job_id})
+def enqueue_sticker(chat_id, sticker_id, fallback_text=None):
+    """Поставить стикер в очередь отправки (fallback_text — если стикер отправить не удалось)"""
+    outbound_queue.put({'chat_id': chat_id, 'text': fallback_text, 'kwargs': {}, 'job_id': None,
+                        'sticker': sticker_id})
+def enqueue_bulk(chat_ids, text, title="Рассылка", report_chat_id=None, on_done=None,
+                 parse_mode=None, reply_markup=None):
+    """Разослать одно сообщение списку чатов через очередь.
+
+    Задание и статус по каждому получателю сохраняются в broadcast_jobs/broadcast_deliveries,
+    поэтому после перезапуска рассылка продолжается с неотправленных (resume_broadcast_jobs).
+    Если указан report_chat_id, туда отправляется сообщение с прогрессом, которое
+    обновляется по ходу рассылки. on_done(job) возвращает текст итогового отчёта.
+    Возвращает ID задания рассылки
+    """
+    chat_ids = list(dict.fromkeys(chat_ids))
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
-    # Автоматически определяем форматирование
-    if "```" in broadcast_text or "`" in broadcast_text:
-        parse_mode = 'MarkdownV2'
-    elif "<" in broadcast_text and ">" in broadcast_text:
-        parse_mode = 'HTML'
-    else:
-        parse_mode = None
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute('''
+        INSERT INTO broadcast_jobs (title, text, parse_mode, reply_markup, report_chat_id, total, status, created_at)
+        VALUES (?, ?, ?, ?, ?, ?, 'running', ?)
+    ''', (title, text, parse_mode, reply_markup.to_json() if reply_markup else None,
+          report_chat_id, len(chat_ids), now))
+    job_id = cursor.lastrowid
+    cursor.executemany('''
+        INSERT INTO broadcast_deliveries (job_id, user_id, status, updated_at)
+        VALUES (?, ?, 'pending', ?)
+    ''', [(job_id, chat_id, now) for chat_id in chat_ids])
+    conn.commit()
 
-    # Сохраняем текст в кэше
-    cache_key = f"{original_chat_id}_{target_type}_{target_value}"
-    broadcast_cache[cache_key] = {
-        'text': broadcast_text,
-        'parse_mode': parse_mode
+    start_outbound_job(job_id, title, chat_ids, len(chat_ids), text, report_chat_id, on_done,
+                       parse_mode=parse_mode, reply_markup=reply_markup)
+    return job_id
+def start_outbound_job(job_id, title, chat_ids, total, text, report_chat_id, on_done=None,
+                       sent=0, blocked=0, failed=0, parse_mode=None, reply_markup=None):
+    """Зарегистрировать задание в памяти, показать прогресс и поставить сообщения в очередь"""
+    job = {
+        'title': title,
+        'total': total,
+        'sent': sent,
+        'blocked': blocked,
+        'failed': failed,
+        'errors': {},
+        'report_chat_id': report_chat_id,
+        'progress_message_id': None,
+        'last_progress': 0.0,
+        'on_done': on_done,
+        'started_at': time.monotonic()
     }
+    with outbound_lock:
+        outbound_jobs[job_id] = job
 
-    # Показываем предпросмотр
-    try:
-        if parse_mode == 'HTML':
-            preview_text = f"""
-<b>📋 Предпросмотр рассылки (HTML):</b>
+    if report_chat_id:
+        try:
+            msg = bot.send_message(report_chat_id, format_outbound_progress(job), parse_mode='HTML')
+            job['progress_message_id'] = msg.message_id
+        except Exception as e:
+            print(f"Не удалось отправить прогресс рассылки: {e}")
 
-{broadcast_text}
+    if not chat_ids:
+        finish_outbound_job(job_id)
+        return
 
-────────────────
-<i>Отправить это сообщение?</i>
-"""
-        elif parse_mode == 'MarkdownV2':
-            preview_text = f"""
-*📋 Предпросмотр рассылки (Markdown):*
+    send_kwargs = {}
+    if parse_mode:
+        send_kwargs['parse_mode'] = parse_mode
+    if reply_markup:
+        send_kwargs['reply_markup'] = reply_markup
 
-{broadcast_text}
+    for chat_id in chat_ids:
+        enqueue_message(chat_id, text, job_id=job_id, **send_kwargs)
+def resume_broadcast_jobs():
+    """Продолжить рассылки, прерванные перезапуском: отправляем только неотправленным"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute("SELECT * FROM broadcast_jobs WHERE status = 'running' ORDER BY id")
 
-────────────────
-_Отправить это сообщение?_
-"""
-        else:
-            preview_text = f"""
-📋 Предпросмотр рассылки:
+    for job_row in cursor.fetchall():
+        cursor.execute('''
+            SELECT status, COUNT(*) as count FROM broadcast_deliveries
+            WHERE job_id = ? GROUP BY status
+        ''', (job_row['id'],))
+        counts = {row['status']: row['count'] for row in cursor.fetchall()}
 
-{broadcast_text}
+        cursor.execute('''
+            SELECT user_id FROM broadcast_deliveries
+            WHERE job_id = ? AND status = 'pending'
+        ''', (job_row['id'],))
+        pending = [row['user_id'] for row in cursor.fetchall()]
+
+        reply_markup = None
+        if job_row['reply_markup']:
+            reply_markup = types.InlineKeyboardMarkup.de_json(job_row['reply_markup'])
+
+        print(f"Возобновляем рассылку #{job_row['id']}: осталось {len(pending)} из {job_row['total']}")
+        start_outbound_job(
+            job_row['id'],
+            f"{job_row['title']} (возобновлена)",
+            pending,
+            job_row['total'],
+            job_row['text'],
+            job_row['report_chat_id'],
+            sent=counts.get('sent', 0),
+            blocked=counts.get('blocked', 0),
+            failed=counts.get('failed', 0),
+            parse_mode=job_row['parse_mode'],
+            reply_markup=reply_markup
+        )
+def format_outbound_progress(job):
+    """Текст сообщения с прогрессом рассылки"""
+    done = job['sent'] + job['blocked'] + job['failed']
+    return (
+        f"⏳ <b>{job['title']}</b>\n\n"
+        f"Отправлено: {done} из {job['total']}\n"
+        f"✅ {job['sent']}  🚫 {job['blocked']}  ❌ {job['failed']}"
+    )
+def update_outbound_job(job_id, chat_id, success, error_code=None):
+    """Учесть результат отправки получателю и обновить прогресс"""
+    if success:
+        status = 'sent'
+    elif error_code == 403:
+        status = 'blocked'
+    else:
+        status = 'failed'
 
-────────────────
-Отправить это сообщение?
+    # Ошибка записи статуса не должна останавливать рассылку: счётчики и отчёт — в памяти
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute('''
+            UPDATE broadcast_deliveries SET status = ?, error_code = ?, updated_at = ?
+            WHERE job_id = ? AND user_id = ?
+        ''', (status, None if success else str(error_code),
+              datetime.now().strftime("%Y-%m-%d %H:%M:%S"), job_id, chat_id))
+        conn.commit()
+    except Exception as e:
+        rollback_db_writes()
+        print(f"Ошибка записи статуса рассылки {job_id} для {chat_id}: {e}")
+
+    with outbound_lock:
+        job = outbound_jobs.get(job_id)
+        if not job:
+            return
+
+        job[status] += 1
+        if not success:
+            job['errors'][error_code] = job['errors'].get(error_code, 0) + 1
+
+        is_done = job['sent'] + job['blocked'] + job['failed'] >= job['total']
+        now = time.monotonic()
+        show_progress = (not is_done and job['progress_message_id']
+                         and now - job['last_progress'] >= OUTBOUND_PROGRESS_INTERVAL)
+        if show_progress:
+            job['last_progress'] = now
+            progress_text = format_outbound_progress(job)
+
+    if is_done:
+        finish_outbound_job(job_id)
+    elif show_progress:
+        try:
+            bot.edit_message_text(progress_text, job['report_chat_id'], job['progress_message_id'],
+                                  parse_mode='HTML')
+        except Exception:
+            pass
+def finish_outbound_job(job_id):
+    """Закрыть задание рассылки и отправить итоговый отчёт"""
+    with outbound_lock:
+        job = outbound_jobs.pop(job_id, None)
+    if not job:
+        return
+
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute('''
+        UPDATE broadcast_jobs SET status = 'done', finished_at = ? WHERE id = ?
+    ''', (datetime.now().strftime("%Y-%m-%d %H:%M:%S"), job_id))
+    conn.commit()
+
+    if not job['report_chat_id']:
+        return
+
+    if job['on_done']:
+        report = job['on_done'](job)
+    else:
+        report = (
+            f"📊 <b>{job['title']}: завершено</b>\n\n"
+            f"✅ Успешно отправлено: {job['sent']}\n"
+            f"🚫 Заблокировали бота: {job['blocked']}\n"
+            f"❌ Не удалось отправить: {job['failed']}"
+        )
+
+    try:
+        if job['progress_message_id']:
+            bot.edit_message_text(report, job['report_chat_id'], job['progress_message_id'], parse_mode='HTML')
+        else:
+            bot.send_message(job['report_chat_id'], report, parse_mode='HTML')
+    except Exception as e:
+        print(f"Не удалось отправить отчёт о рассылке: {e}")
+def get_outbound_stats():
+    """Состояние очереди отправки: длина очереди и активные задания"""
+    with outbound_lock:
+        return {
+            'queued': outbound_queue.qsize(),
+            'jobs': {job_id: dict(job) for job_id, job in outbound_jobs.items()}
+        }
+
+# ==============================
+# МАРШРУТИЗАЦИЯ КНОПОК
+# ==============================
+def callback_route(*keys, prefix=None, parse=None, admin=False):
+    """Зарегистрировать обработчик кнопки.
+
+    keys — точные значения callback_data. prefix — префикс (или кортеж префиксов):
+    остаток callback_data после него разбирается функцией parse и передаётся
+    обработчику (кортеж — отдельными аргументами). admin=True — только для админов
+    """
+    def decorator(func):
+        route = {'func': func, 'name': func.__name__, 'parse': parse, 'admin': admin}
+
+        for key in keys:
+            callback_routes[key] = route
+
+        prefixes = (prefix,) if isinstance(prefix, str) else (prefix or ())
+        for route_prefix in prefixes:
+            node = callback_prefix_trie
+            for char in route_prefix:
+                node = node.setdefault(char, {})
+            node[None] = route
+
+        return func
+    return decorator
+def split_args(*converters):
+    """Разбор аргументов вида 'add_123_5' по '_' с приведением типов.
+
+    Делится справа: '_' может быть только в первом аргументе (например, ID задачи 'task_12_3')
+    """
+    def parse(raw):
+        parts = raw.rsplit('_', len(converters) - 1)
+        if len(parts) != len(converters):
+            raise ValueError(f"ожидалось {len(converters)} аргумента: {raw}")
+        return tuple(convert(part) for convert, part in zip(converters, parts))
+    return parse
+def find_callback_route(data):
+    """Найти маршрут: точное совпадение, иначе самый длинный префикс.
+
+    Возвращает (маршрут, остаток после префикса); для точного совпадения остаток None
+    """
+    route = callback_routes.get(data)
+    if route:
+        return route, None
+
+    found = None, None
+    node = callback_prefix_trie
+    for i, char in enumerate(data):
+        node = node.get(char)
+        if node is None:
+            break
+        if None in node:
+            found = node[None], data[i + 1:]
+    return found
+def record_callback_metric(name, elapsed, failed):
+    """Учесть время обработки кнопки"""
+    with callback_metrics_lock:
+        metric = callback_metrics.setdefault(name, {'count': 0, 'errors': 0, 'total': 0.0, 'max': 0.0})
+        metric['count'] += 1
+        metric['total'] += elapsed
+        metric['max'] = max(metric['max'], elapsed)
+        if failed:
+            metric['errors'] += 1
+def get_callback_metrics():
+    """Метрики кнопок: {маршрут: {'count', 'errors', 'avg_ms', 'max_ms'}}, самые нагруженные первыми"""
+    with callback_metrics_lock:
+        items = sorted(callback_metrics.items(), key=lambda item: item[1]['total'], reverse=True)
+        return {
+            name: {
+                'count': metric['count'],
+                'errors': metric['errors'],
+                'avg_ms': round(metric['total'] / metric['count'] * 1000, 1),
+                'max_ms': round(metric['max'] * 1000, 1)
+            }
+            for name, metric in items
+        }
+
+# ==============================
+# ОБРАБОТКА ВХОДЯЩИХ ОБНОВЛЕНИЙ
+# ==============================
+def get_update_chat_key(update):
+    """Ключ очереди для обновления: id чата, для обновлений без чата — id пользователя"""
+    for attr in ('message', 'edited_message', 'channel_post', 'edited_channel_post',
+                 'my_chat_member', 'chat_member', 'chat_join_request'):
+        obj = getattr(update, attr, None)
+        if obj is not None and getattr(obj, 'chat', None) is not None:
+            return obj.chat.id
+
+    call = getattr(update, 'callback_query', None)
+    if call is not None:
+        if call.message is not None:
+            return call.message.chat.id
+        return call.from_user.id
+
+    for attr in ('inline_query', 'chosen_inline_result', 'shipping_query',
+                 'pre_checkout_query', 'poll_answer'):
+        obj = getattr(update, attr, None)
+        user = getattr(obj, 'from_user', None) or getattr(obj, 'user', None)
+        if user is not None:
+            return user.id
+
+    return update.update_id
+def get_update_user_id(update):
+    """Пользователь, от которого пришло обновление (None — обновление без пользователя)"""
+    for attr in ('message', 'edited_message', 'callback_query', 'inline_query', 'chosen_inline_result',
+                 'shipping_query', 'pre_checkout_query', 'poll_answer', 'my_chat_member',
+                 'chat_member', 'chat_join_request'):
+        obj = getattr(update, attr, None)
+        if obj is None:
+            continue
+        user = getattr(obj, 'from_user', None) or getattr(obj, 'user', None)
+        return user.id if user is not None else None
+    return None
+def record_activity(user_id, seen_at=None):
+    """Отметить активность пользователя (в базу попадёт при следующем flush_activity)"""
+    if user_id is None:
+        return
+    seen_at = seen_at or time.time()
+    with activity_lock:
+        activity_last_seen[user_id] = seen_at
+        activity_pending[user_id] = seen_at
+def flush_activity():
+    """Записать накопленную активность в users.last_active одним executemany"""
+    with activity_lock:
+        pending = dict(activity_pending)
+        activity_pending.clear()
+        # Заодно убираем из памяти давно не заходивших
+        cutoff = time.time() - ACTIVITY_MEMORY_DAYS * 86400
+        for user_id in [user_id for user_id, seen_at in activity_last_seen.items() if seen_at < cutoff]:
+            del activity_last_seen[user_id]
+
+    if not pending:
+        return 0
+
+    try:
+        with db_transaction() as conn:
+            conn.cursor().executemany(
+                'UPDATE users SET last_active = ? WHERE user_id = ?',
+                [(format_job_time(seen_at), user_id) for user_id, seen_at in pending.items()]
+            )
+    except Exception:
+        # Не теряем отметки: вернём их к следующей записи, если новых не появилось
+        with activity_lock:
+            for user_id, seen_at in pending.items():
+                if activity_pending.get(user_id, 0) < seen_at:
+                    activity_pending[user_id] = seen_at
+        raise
+
+    return len(pending)
+def load_recent_activity():
+    """Заполнить память активностью из базы, чтобы get_active_users работал сразу после запуска"""
+    cutoff = datetime.now() - timedelta(days=ACTIVITY_MEMORY_DAYS)
+    conn = get_db_read_connection()
+    cursor = conn.cursor()
+    cursor.execute('SELECT user_id, last_active FROM users WHERE last_active >= ?',
+                   (cutoff.strftime("%Y-%m-%d %H:%M:%S"),))
+
+    loaded = {}
+    for user_id, last_active in cursor.fetchall():
+        try:
+            loaded[user_id] = datetime.strptime(last_active, "%Y-%m-%d %H:%M:%S").timestamp()
+        except (TypeError, ValueError):
+            continue
+
+    with activity_lock:
+        for user_id, seen_at in loaded.items():
+            if activity_last_seen.get(user_id, 0) < seen_at:
+                activity_last_seen[user_id] = seen_at
+def get_active_users(seconds):
+    """id пользователей, от которых были обновления за последние seconds секунд (из памяти)"""
+    cutoff = time.time() - seconds
+    with activity_lock:
+        return [user_id for user_id, seen_at in activity_last_seen.items() if seen_at >= cutoff]
+def get_activity_stats():
+    """Активные за 15 минут, час и сутки, плюс сколько отметок ждёт записи"""
+    now = time.time()
+    with activity_lock:
+        seen = list(activity_last_seen.values())
+        pending = len(activity_pending)
+    return {
+        'minutes_15': sum(1 for seen_at in seen if seen_at >= now - 900),
+        'hour': sum(1 for seen_at in seen if seen_at >= now - 3600),
+        'day': sum(1 for seen_at in seen if seen_at >= now - 86400),
+        'pending': pending
+    }
+def record_update_metric(wait, work, failed):
+    """Учесть ожидание в очереди и время обработки обновления"""
+    with update_metrics_lock:
+        update_metrics['processed'] += 1
+        update_metrics['wait_total'] += wait
+        update_metrics['wait_max'] = max(update_metrics['wait_max'], wait)
+        update_metrics['work_total'] += work
+        update_metrics['work_max'] = max(update_metrics['work_max'], work)
+        if failed:
+            update_metrics['errors'] += 1
+def report_handler_error(error, title):
+    """Ошибка в обработчике: откатить незавершённую запись потока (иначе db_write_lock
+    останется занят и встанут все остальные записи) и сообщить админу"""
+    rollback_db_writes()
+    error_msg = f"{title}: {str(error)}\n\n{traceback.format_exc()}"
+    print(f"Ошибка: {error_msg}")
+    from config import send_error_to_admin
+    send_error_to_admin(error_msg)
+def process_update(update):
+    """Выполнить обработчики одного обновления. Возвращает True, если обработчик упал"""
+    try:
+        bot.process_new_updates([update])
+        return False
+    except Exception as e:
+        report_handler_error(e, f"Ошибка обработки обновления {update.update_id}")
+        return True
+class HandlerErrorHandler(telebot.ExceptionHandler):
+    """Ошибки обработчиков в старом режиме bot.polling (UPDATE_WORKERS = 0).
+
+    telebot вызывает handle в том же потоке, где упал обработчик, поэтому откат
+    затрагивает именно его соединение — как в process_update
+    """
+
+    def handle(self, exception):
+        report_handler_error(exception, "Ошибка обработки обновления")
+        return True
+def update_worker(updates):
+    """Поток обработки: по очереди выполняет обновления своих чатов"""
+    while True:
+        update, queued_at = updates.get()
+        started = time.perf_counter()
+        failed = True
+        try:
+            failed = process_update(update)
+        finally:
+            record_update_metric(started - queued_at, time.perf_counter() - started, failed)
+            updates.task_done()
+def start_update_workers():
+    """Запустить потоки обработки обновлений (один раз при старте бота)"""
+    # Обработчики вызываются прямо в наших потоках, без внутреннего пула telebot
+    bot.threaded = False
+    for _ in range(UPDATE_WORKERS):
+        updates = queue.Queue(maxsize=UPDATE_QUEUE_SIZE)
+        update_queues.append(updates)
+        threading.Thread(target=update_worker, args=(updates,), daemon=True).start()
+def dispatch_update(update):
+    """Передать обновление потоку его чата; если очередь полна — ждём (опрос притормаживает)"""
+    updates = update_queues[hash(get_update_chat_key(update)) % len(update_queues)]
+    item = (update, time.perf_counter())
+    try:
+        updates.put_nowait(item)
+    except queue.Full:
+        with update_metrics_lock:
+            update_metrics['backpressure'] += 1
+        updates.put(item)
+def poll_updates():
+    """Long polling Telegram с раздачей обновлений по потокам обработки"""
+    offset = None
+    while not shutdown_event.is_set():
+        try:
+            updates = bot.get_updates(offset=offset, timeout=UPDATE_POLL_TIMEOUT,
+                                      long_polling_timeout=UPDATE_POLL_TIMEOUT)
+        except (ApiTelegramException, requests.exceptions.RequestException) as e:
+            print(f"Ошибка получения обновлений: {e}")
+            time.sleep(3)
+            continue
+
+        for update in updates:
+            offset = update.update_id + 1
+            feed_update(update)
+def feed_update(update):
+    """Общий вход для обновления из любого источника (polling или вебхук)"""
+    record_activity(get_update_user_id(update))
+    if update_queues:
+        dispatch_update(update)
+    else:
+        process_update(update)
+class WebhookHandler(BaseHTTPRequestHandler):
+    """Приём обновлений Telegram: POST WEBHOOK_PATH с JSON одного обновления"""
+
+    def do_POST(self):
+        if self.path != WEBHOOK_PATH:
+            self.send_error(404)
+            return
+        if WEBHOOK_SECRET and self.headers.get('X-Telegram-Bot-Api-Secret-Token') != WEBHOOK_SECRET:
+            self.send_error(403)
+            return
+
+        length = int(self.headers.get('Content-Length', 0))
+        try:
+            update = types.Update.de_json(self.rfile.read(length).decode('utf-8'))
+        except Exception as e:
+            print(f"Некорректное обновление от вебхука: {e}")
+            self.send_error(400)
+            return
+
+        # Отвечаем после постановки в очередь: при полной очереди Telegram подождёт ответа
+        feed_update(update)
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        # Не пишем в консоль строку на каждое обновление
+        pass
+def create_webhook_server(host=None, port=None):
+    """HTTP сервер вебхука: каждый запрос в своём потоке"""
+    server = ThreadingHTTPServer((host or WEBHOOK_LISTEN, port if port is not None else WEBHOOK_PORT),
+                                 WebhookHandler, bind_and_activate=False)
+    server.daemon_threads = True
+    # Очередь соединений по умолчанию (5) меньше, чем Telegram открывает параллельно
+    server.request_queue_size = WEBHOOK_MAX_CONNECTIONS * 2
+    try:
+        server.server_bind()
+        server.server_activate()
+    except Exception:
+        server.server_close()
+        raise
+    return server
+def run_webhook():
+    """Зарегистрировать вебхук в Telegram и принимать обновления до остановки"""
+    if not WEBHOOK_URL:
+        raise RuntimeError("Для BOT_MODE=webhook нужно задать WEBHOOK_URL")
+
+    server = create_webhook_server()
+    try:
+        bot.remove_webhook()
+        bot.set_webhook(url=WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH,
+                        secret_token=WEBHOOK_SECRET or None,
+                        max_connections=WEBHOOK_MAX_CONNECTIONS)
+        print(f"Вебхук слушает {WEBHOOK_LISTEN}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+        server.serve_forever()
+    finally:
+        server.server_close()
+def get_update_stats():
+    """Состояние обработки обновлений: очереди и задержки"""
+    with update_metrics_lock:
+        processed = update_metrics['processed'] or 1
+        return {
+            'workers': len(update_queues),
+            'queued': sum(updates.qsize() for updates in update_queues),
+            'max_queue': max((updates.qsize() for updates in update_queues), default=0),
+            'processed': update_metrics['processed'],
+            'errors': update_metrics['errors'],
+            'backpressure': update_metrics['backpressure'],
+            'avg_wait_ms': round(update_metrics['wait_total'] / processed * 1000, 1),
+            'max_wait_ms': round(update_metrics['wait_max'] * 1000, 1),
+            'avg_work_ms': round(update_metrics['work_total'] / processed * 1000, 1),
+            'max_work_ms': round(update_metrics['work_max'] * 1000, 1)
+        }
+
+# ==============================
+# ФОНОВЫЕ ЗАДАНИЯ
+# ==============================
+def format_job_time(timestamp):
+    """Время задания для таблицы scheduler_jobs и /jobs"""
+    return datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d %H:%M:%S") if timestamp else None
+def load_job_state(name):
+    """Прошлые запуски задания из scheduler_jobs (переживают перезапуск бота)"""
+    conn = get_db_read_connection()
+    cursor = conn.cursor()
+    cursor.execute('SELECT last_run, last_duration, last_error, runs, errors FROM scheduler_jobs WHERE name = ?',
+                   (name,))
+    row = cursor.fetchone()
+    if not row:
+        return {}
+
+    return {
+        'last_run': datetime.strptime(row['last_run'], "%Y-%m-%d %H:%M:%S").timestamp() if row['last_run'] else None,
+        'last_duration': row['last_duration'],
+        'last_error': row['last_error'],
+        'runs': row['runs'] or 0,
+        'errors': row['errors'] or 0
+    }
+def save_job_state(job):
+    """Записать состояние задания в scheduler_jobs"""
+    with scheduler_condition:
+        values = (job['name'], job['title'], job['interval'], format_job_time(job['last_run']),
+                  format_job_time(job['next_run']), job['last_duration'], job['last_error'],
+                  job['runs'], job['errors'])
+
+    with db_transaction() as conn:
+        conn.execute('''
+            INSERT INTO scheduler_jobs
+            (name, title, interval, last_run, next_run, last_duration, last_error, runs, errors)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (name) DO UPDATE SET
+                title = excluded.title,
+                interval = excluded.interval,
+                last_run = excluded.last_run,
+                next_run = excluded.next_run,
+                last_duration = excluded.last_duration,
+                last_error = excluded.last_error,
+                runs = excluded.runs,
+                errors = excluded.errors
+        ''', values)
+def push_job(job, run_at):
+    """Поставить следующий запуск задания в кучу (вызывать под scheduler_condition)"""
+    scheduler_state['seq'] += 1
+    job['seq'] = scheduler_state['seq']
+    job['next_run'] = run_at
+    heapq.heappush(scheduler_heap, (run_at, job['seq'], job['name']))
+    scheduler_condition.notify()
+def schedule_job(name, func, interval=None, delay=0, run_at=None, title=None,
+                 jitter=SCHEDULER_JITTER, run_on_shutdown=False):
+    """Поставить задание в планировщик.
+
+    С interval задание периодическое: следующий запуск через interval секунд (плюс случайный
+    сдвиг до jitter * interval) после окончания предыдущего, поэтому запуски не накладываются,
+    а после перезапуска бота график продолжается от последнего запуска. Без interval задание
+    разовое: через delay секунд или в момент run_at (timestamp). Повторная постановка с тем же
+    именем переносит задание. run_on_shutdown — выполнить ожидающий запуск при остановке бота
+    """
+    with scheduler_condition:
+        job = scheduler_jobs.get(name)
+    if job is None:
+        job = {'name': name, 'runs': 0, 'errors': 0, 'last_run': None, 'last_duration': None,
+               'last_error': None, 'count': 0, 'total': 0.0, 'max': 0.0, 'overlaps': 0,
+               'running': False, 'pending': False, 'cancelled': False, 'thread': None, 'seq': None,
+               'next_run': None}
+        job.update(load_job_state(name))
+
+    if run_at is None:
+        run_at = time.time() + delay
+        if interval and job['last_run'] is not None:
+            run_at = max(run_at, job['last_run'] + interval)
+
+    with scheduler_condition:
+        job = scheduler_jobs.setdefault(name, job)
+        job.update(func=func, interval=interval, title=title or name,
+                   jitter=jitter, run_on_shutdown=run_on_shutdown, cancelled=False)
+        push_job(job, run_at)
+
+    save_job_state(job)
+    start_scheduler()
+def cancel_job(name):
+    """Снять задание с расписания (запуск, который уже идёт, доработает)"""
+    with scheduler_condition:
+        job = scheduler_jobs.get(name)
+        if job is not None:
+            job['seq'] = None
+            job['next_run'] = None
+            job['pending'] = False
+            if job['running']:
+                # Запись убирает run_job после запуска: новое задание с тем же именем
+                # до этого попадёт в неё и не запустится параллельно с идущим
+                job['cancelled'] = True
+            else:
+                del scheduler_jobs[name]
+    if job is not None:
+        save_job_state(job)
+def run_job(job):
+    """Выполнить задание и учесть время, ошибку и следующий запуск"""
+    started_at = time.time()
+    started = time.perf_counter()
+    error = None
+    try:
+        job['func']()
+    except Exception as e:
+        rollback_db_writes()
+        error = str(e) or type(e).__name__
+        print(f"Ошибка в фоновом задании {job['name']}: {e}")
+        print(traceback.format_exc())
+    duration = time.perf_counter() - started
+
+    with scheduler_condition:
+        job['running'] = False
+        job['runs'] += 1
+        job['count'] += 1
+        job['total'] += duration
+        job['max'] = max(job['max'], duration)
+        job['last_run'] = started_at
+        job['last_duration'] = round(duration, 3)
+        job['last_error'] = error
+        if error:
+            job['errors'] += 1
+
+        if job['cancelled']:
+            if scheduler_jobs.get(job['name']) is job:
+                del scheduler_jobs[job['name']]
+        elif scheduler_jobs.get(job['name']) is job and not shutdown_event.is_set():
+            if job['pending']:
+                # Пока задание работало, подошёл ещё один запуск — выполняем его сейчас
+                job['pending'] = False
+                push_job(job, time.time())
+            elif job['interval'] and job['next_run'] is None:
+                push_job(job, time.time() + job['interval'] + random.uniform(0, job['jitter'] * job['interval']))
+
+    save_job_state(job)
+def scheduler_loop():
+    """Поток планировщика: спит до ближайшего задания и запускает его в отдельном потоке"""
+    while True:
+        with scheduler_condition:
+            while True:
+                if shutdown_event.is_set():
+                    return
+                # Перенесённые и снятые задания оставляют в куче устаревшие записи
+                while scheduler_heap and scheduler_jobs.get(scheduler_heap[0][2], {}).get('seq') != scheduler_heap[0][1]:
+                    heapq.heappop(scheduler_heap)
+                now = time.time()
+                if scheduler_heap and scheduler_heap[0][0] <= now:
+                    break
+                scheduler_condition.wait(scheduler_heap[0][0] - now if scheduler_heap else None)
+
+            _, _, name = heapq.heappop(scheduler_heap)
+            job = scheduler_jobs[name]
+            job['seq'] = None
+            job['next_run'] = None
+            if job['running']:
+                job['overlaps'] += 1
+                job['pending'] = True
+                continue
+
+            job['running'] = True
+            job['thread'] = threading.Thread(target=run_job, args=(job,), name=f"job-{name}", daemon=True)
+            job['thread'].start()
+def start_scheduler():
+    """Запустить поток планировщика (повторные вызовы ничего не делают)"""
+    with scheduler_condition:
+        if scheduler_state['thread'] is not None or shutdown_event.is_set():
+            return
+        scheduler_state['thread'] = threading.Thread(target=scheduler_loop, name='scheduler', daemon=True)
+        scheduler_state['thread'].start()
+def stop_scheduler(timeout=30):
+    """Остановка: новых запусков нет, идущие задания дорабатывают,
+    ожидающие задания с run_on_shutdown выполняются сразу"""
+    shutdown_event.set()
+    with scheduler_condition:
+        scheduler_condition.notify_all()
+        running = [job['thread'] for job in scheduler_jobs.values() if job['running']]
+
+    deadline = time.time() + timeout
+    for thread in running:
+        thread.join(max(0, deadline - time.time()))
+
+    # Список — после завершения идущих: запуск, запрошенный во время работы задания (pending),
+    # после остановки уже не ставится в очередь и выполняется здесь
+    with scheduler_condition:
+        flush = [job for job in scheduler_jobs.values()
+                 if job['run_on_shutdown'] and not job['running']
+                 and (job['pending'] or job['next_run'] is not None)]
+        for job in flush:
+            job['seq'] = None
+            job['next_run'] = None
+            job['pending'] = False
+            job['running'] = True
+
+    for job in flush:
+        run_job(job)
+def get_scheduler_stats():
+    """Состояние заданий для /jobs: текущие и сохранённые с прошлых запусков"""
+    conn = get_db_read_connection()
+    cursor = conn.cursor()
+    cursor.execute('SELECT * FROM scheduler_jobs ORDER BY name')
+    stats = {row['name']: {'name': row['name'], 'title': row['title'], 'interval': row['interval'],
+                           'last_run': row['last_run'], 'next_run': None,
+                           'last_duration': row['last_duration'], 'last_error': row['last_error'],
+                           'runs': row['runs'], 'errors': row['errors'], 'running': False,
+                           'avg_ms': None, 'max_ms': None, 'overlaps': 0, 'active': False}
+             for row in cursor.fetchall()}
+
+    with scheduler_condition:
+        for name, job in scheduler_jobs.items():
+            stats[name] = {
+                'name': name,
+                'title': job['title'],
+                'interval': job['interval'],
+                'last_run': format_job_time(job['last_run']),
+                'next_run': format_job_time(job['next_run']),
+                'last_duration': job['last_duration'],
+                'last_error': job['last_error'],
+                'runs': job['runs'],
+                'errors': job['errors'],
+                'running': job['running'],
+                'avg_ms': round(job['total'] / job['count'] * 1000, 1) if job['count'] else None,
+                'max_ms': round(job['max'] * 1000, 1) if job['count'] else None,
+                'overlaps': job['overlaps'],
+                'active': True
+            }
+
+    return list(stats.values())
+def start_background_jobs():
+    """Периодические задания бота (при запуске)"""
+    schedule_job('raspush_cleanup', cleanup_old_raspush, interval=86400, title="Очистка просроченного распуша")
+    schedule_job('reports_cleanup', cleanup_report_files, interval=86400, title="Очистка старых отчётов")
+    load_recent_activity()
+    schedule_job('activity_flush', flush_activity, interval=ACTIVITY_FLUSH_INTERVAL,
+                 title="Запись активности пользователей", run_on_shutdown=True)
+    start_deadline_reminders()
+def handle_shutdown_signal(signum, frame):
+    """SIGTERM от systemd/docker — штатная остановка, как Ctrl+C"""
+    raise SystemExit(0)
+
+# ==============================
+# ФОНОВЫЕ ОТЧЁТЫ
+# ==============================
+def get_report_watermark(report_type, params):
+    """Отметка данных отчёта: меняется, когда появляются новые строки. None — данных нет"""
+    conn = get_db_read_connection()
+    cursor = conn.cursor()
+
+    if report_type == 'points':
+        start_date, end_date = params
+        query = 'SELECT COUNT(*) AS total, MAX(id) AS last_mark FROM points_history WHERE 1=1'
+        args = []
+        if start_date:
+            query += ' AND date >= ?'
+            args.append(start_date)
+        if end_date:
+            query += ' AND date <= ?'
+            args.append(end_date)
+        cursor.execute(query, args)
+    elif report_type == 'raspush':
+        cursor.execute('''
+            SELECT COUNT(*) AS total, MAX(completed_at) AS last_mark
+            FROM raspush_completions 
+            WHERE task_id = ?
+        ''', params)
+    else:
+        raise ValueError(f"Неизвестный тип отчёта: {report_type}")
+
+    row = cursor.fetchone()
+    if not row['total']:
+        return None
+    return f"{row['total']}_{re.sub(r'[^0-9]', '', str(row['last_mark']))}"
+def make_report_prefix(report_type, params):
+    """Начало ключа (и имени файла) отчёта: тип и период/задача, без отметки данных"""
+    names = {'points': 'points_history', 'raspush': 'raspush_report'}
+    parts = [re.sub(r'[^0-9]', '', str(param)) if param is not None else 'all' for param in params]
+    return '_'.join([names[report_type]] + parts)
+def build_report(report_type, params, filename, progress):
+    """Сформировать файл отчёта, возвращает (filename, error)"""
+    if report_type == 'points':
+        return generate_points_history_report(*params, filename=filename, progress=progress)
+    return generate_raspush_report(*params, filename=filename, progress=progress)
+def get_cached_report(key):
+    """Готовый отчёт из report_files или None"""
+    conn = get_db_read_connection()
+    cursor = conn.cursor()
+    cursor.execute('SELECT key, path, file_id FROM report_files WHERE key = ?', (key,))
+    return cursor.fetchone()
+def save_cached_report(key, prefix, report_type, path):
+    """Запомнить готовый отчёт; прежние версии того же отчёта удаляются"""
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    with db_transaction() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            DELETE FROM report_files WHERE prefix = ? AND key != ? RETURNING path
+        ''', (prefix, key))
+        stale = [row['path'] for row in cursor.fetchall()]
+        cursor.execute('''
+            INSERT INTO report_files (key, prefix, report_type, path, file_id, created_at)
+            VALUES (?, ?, ?, ?, NULL, ?)
+            ON CONFLICT (key) DO UPDATE SET path = excluded.path, file_id = NULL, created_at = excluded.created_at
+        ''', (key, prefix, report_type, path, now))
+
+    for path in stale:
+        remove_report_file(path)
+def remove_report_file(path):
+    """Удалить файл отчёта с диска (его может уже не быть)"""
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        print(f"Не удалось удалить старый отчёт {path}: {e}")
+def drop_cached_reports(prefix):
+    """Забыть все версии отчёта (например, задача распуша удалена)"""
+    with db_transaction() as conn:
+        cursor = conn.cursor()
+        cursor.execute('DELETE FROM report_files WHERE prefix = ? RETURNING path', (prefix,))
+        paths = [row['path'] for row in cursor.fetchall()]
+
+    for path in paths:
+        remove_report_file(path)
+def cleanup_report_files():
+    """Задание планировщика: удалить отчёты старше REPORT_CACHE_DAYS"""
+    border = (datetime.now() - timedelta(days=REPORT_CACHE_DAYS)).strftime("%Y-%m-%d %H:%M:%S")
+    with db_transaction() as conn:
+        cursor = conn.cursor()
+        cursor.execute('DELETE FROM report_files WHERE created_at < ? RETURNING path', (border,))
+        paths = [row['path'] for row in cursor.fetchall()]
+
+    for path in paths:
+        remove_report_file(path)
+def edit_report_progress(request_key, text):
+    """Обновить сообщение о ходе формирования у всех, кто ждёт отчёт"""
+    with report_lock:
+        waiters = list(report_requests.get(request_key, []))
+
+    for waiter in waiters:
+        try:
+            bot.edit_message_text(text, waiter['chat_id'], waiter['message_id'])
+        except Exception:
+            # "message is not modified" и подобное не мешают отчёту
+            pass
+def make_report_progress(request_key):
+    """Callback progress(done, total) для генератора: правит сообщение не чаще REPORT_PROGRESS_INTERVAL"""
+    state = {'last': 0.0}
+
+    def progress(done, total):
+        now = time.time()
+        if now - state['last'] < REPORT_PROGRESS_INTERVAL and done < total:
+            return
+        state['last'] = now
+        percent = int(done * 100 / total) if total else 100
+        edit_report_progress(request_key, f"⏳ Формирую отчёт: {done} из {total} строк ({percent}%)")
+
+    return progress
+def send_report(waiter, report):
+    """Отправить готовый отчёт: по file_id без загрузки, если Telegram его уже видел.
+
+    Возвращает file_id отправленного документа
+    """
+    if report['file_id']:
+        try:
+            bot.send_document(waiter['chat_id'], report['file_id'], caption=waiter['caption'], parse_mode='HTML')
+            return report['file_id']
+        except ApiTelegramException as e:
+            print(f"Не удалось отправить отчёт по file_id, загружаем файл: {e}")
+
+    if not os.path.exists(report['path']):
+        # Файл удалили после проверки в run_report_request — следующий запрос сформирует отчёт заново
+        with db_transaction() as conn:
+            conn.execute('DELETE FROM report_files WHERE key = ?', (report['key'],))
+        raise FileNotFoundError("файл отчёта удалён, запросите отчёт ещё раз")
+
+    with open(report['path'], 'rb') as file:
+        sent = bot.send_document(waiter['chat_id'], file, caption=waiter['caption'], parse_mode='HTML')
+    return sent.document.file_id
+def finish_report_request(request_key, report=None, error=None):
+    """Раздать результат всем, кто ждал этот отчёт"""
+    with report_lock:
+        waiters = report_requests.pop(request_key, [])
+
+    file_id = report['file_id'] if report else None
+    for waiter in waiters:
+        try:
+            if error:
+                bot.edit_message_text(f"❌ {error}", waiter['chat_id'], waiter['message_id'])
+            else:
+                file_id = send_report(waiter, dict(report, file_id=file_id))
+                bot.edit_message_text("✅ Отчёт готов", waiter['chat_id'], waiter['message_id'])
+        except Exception as e:
+            print(f"Ошибка отправки отчёта: {e}")
+            bot.send_message(waiter['chat_id'], f"❌ Ошибка отправки файла: {str(e)}")
+
+        if waiter['on_done']:
+            waiter['on_done']()
+
+    if report and file_id and file_id != report['file_id']:
+        with db_transaction() as conn:
+            conn.execute('UPDATE report_files SET file_id = ? WHERE key = ?', (file_id, report['key']))
+def run_report_request(request_key):
+    """Найти готовый отчёт или сформировать его и разослать ждущим"""
+    report_type, params = request_key
+
+    watermark = get_report_watermark(report_type, params)
+    if watermark is None:
+        error = "Нет данных по этой задаче" if report_type == 'raspush' else "Нет данных за указанный период"
+        finish_report_request(request_key, error=error)
+        return
+
+    prefix = make_report_prefix(report_type, params)
+    key = f"{prefix}_{watermark}"
+    report = get_cached_report(key)
+
+    # Файл нужен и при известном file_id: если Telegram его не примет, отправляем с диска
+    if report is None or not os.path.exists(report['path']):
+        edit_report_progress(request_key, "⏳ Формирую отчёт...")
+        os.makedirs(REPORTS_DIR, exist_ok=True)
+        path = os.path.join(REPORTS_DIR, f"{key}.xlsx")
+        # Пишем во временный файл и подменяем: недописанный отчёт никто не получит
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        filename, error = build_report(report_type, params, tmp_path, make_report_progress(request_key))
+        if error:
+            remove_report_file(tmp_path)
+            finish_report_request(request_key, error=error)
+            return
+        os.replace(tmp_path, path)
+        save_cached_report(key, prefix, report_type, path)
+        report = get_cached_report(key)
+
+    finish_report_request(request_key, report)
+def report_worker():
+    """Поток формирования отчётов"""
+    while True:
+        request_key = report_queue.get()
+        try:
+            run_report_request(request_key)
+        except Exception as e:
+            print(f"Ошибка формирования отчёта {request_key}: {e}")
+            print(traceback.format_exc())
+            rollback_db_writes()
+            finish_report_request(request_key, error=f"Ошибка генерации отчета: {str(e)}")
+        finally:
+            report_queue.task_done()
+def start_report_workers():
+    """Запустить потоки отчётов (повторные вызовы ничего не делают)"""
+    with report_lock:
+        while len(report_workers) < REPORT_WORKERS:
+            worker = threading.Thread(target=report_worker, name=f"report-{len(report_workers)}", daemon=True)
+            report_workers.append(worker)
+            worker.start()
+def request_report(chat_id, report_type, params, caption, on_done=None):
+    """Заказать отчёт: формируется в фоне, ход показывается в одном сообщении.
+
+    Одинаковые запросы, пришедшие во время формирования, ждут тот же файл.
+    report_type — 'points' (params: начало и конец периода) или 'raspush' (params: id задачи).
+    on_done() вызывается после отправки отчёта или сообщения об ошибке
+    """
+    progress = bot.send_message(chat_id, "⏳ Отчёт поставлен в очередь...")
+    waiter = {'chat_id': chat_id, 'message_id': progress.message_id, 'caption': caption, 'on_done': on_done}
+    request_key = (report_type, tuple(params))
+
+    with report_lock:
+        if request_key in report_requests:
+            report_requests[request_key].append(waiter)
+            return
+        report_requests[request_key] = [waiter]
+
+    start_report_workers()
+    report_queue.put(request_key)
+
+# Функции рассылки
+def show_broadcast_options(chat_id):
+    """Опции рассылки"""
+    markup = types.InlineKeyboardMarkup(row_width=2)
+    buttons = [
+        types.InlineKeyboardButton('📢 Всем пользователям', callback_data='broadcast_all'),
+        types.InlineKeyboardButton('🏙️ Муниципалитету', callback_data='broadcast_by_city'),
+        types.InlineKeyboardButton('🔙 Назад', callback_data='admin_panel')
+    ]
+
+    markup.add(*buttons)
+    bot.send_message(chat_id, "<b>📨 Выберите тип рассылки:</b>", parse_mode='HTML', reply_markup=markup)
+def show_cities_for_broadcast(chat_id):
+    """Выбор муниципалитета для рассылки"""
+    conn = get_db_read_connection()
+    cursor = conn.cursor()
+    cursor.execute('SELECT DISTINCT city FROM users WHERE city != "Не указан" ORDER BY city')
+    cities = cursor.fetchall()
+
+    markup = types.InlineKeyboardMarkup(row_width=2)
+    for city_record in cities:
+        city = city_record['city']
+        city_emoji = AVAILABLE_CITIES.get(city, '🏙️')
+        markup.add(types.InlineKeyboardButton(f"{city_emoji} {city}", callback_data=f'broadcast_city_{city}'))
+
+    markup.add(types.InlineKeyboardButton('🔙 Назад', callback_data='admin_broadcast'))
+    bot.send_message(chat_id, "<b>🏙️ Выберите муниципалитет:</b>", parse_mode='HTML', reply_markup=markup)
+def ask_for_broadcast_text(chat_id, target_type, target_value):
+    """Запрос текста рассылки"""
+    if target_type == 'all':
+        target_info = "📢 <b>Всем пользователям</b>"
+    elif target_type == 'city':
+        city_emoji = AVAILABLE_CITIES.get(target_value, '🏙️')
+        target_info = f"🏙️ <b>Муниципалитету:</b> {city_emoji} {target_value}"
+
+    msg = bot.send_message(
+        chat_id,
+        f"<b>✏️ Введите текст рассылки:</b>\n\n{target_info}",
+        parse_mode='HTML'
+    )
+
+    bot.register_next_step_handler(msg, process_broadcast_text, target_type, target_value, chat_id)
+def process_broadcast_text(message, target_type, target_value, original_chat_id):
+    """Обработка текста рассылки"""
+    broadcast_text = message.text.strip()
+
+    if not broadcast_text:
+        bot.send_message(original_chat_id, "❌ Текст не может быть пустым")
+        return
+
+    # Автоматически определяем форматирование
+    if "```" in broadcast_text or "`" in broadcast_text:
+        parse_mode = 'MarkdownV2'
+    elif "<" in broadcast_text and ">" in broadcast_text:
+        parse_mode = 'HTML'
+    else:
+        parse_mode = None
+
+    # Сохраняем текст в кэше
+    cache_key = f"{original_chat_id}_{target_type}_{target_value}"
+    broadcast_cache[cache_key] = {
+        'text': broadcast_text,
+        'parse_mode': parse_mode
+    }
+
+    # Показываем предпросмотр
+    try:
+        if parse_mode == 'HTML':
+            preview_text = f"""
+<b>📋 Предпросмотр рассылки (HTML):</b>
+
+{broadcast_text}
+
+────────────────
+<i>Отправить это сообщение?</i>
+"""
+        elif parse_mode == 'MarkdownV2':
+            preview_text = f"""
+*📋 Предпросмотр рассылки (Markdown):*
+
+{broadcast_text}
+
+────────────────
+_Отправить это сообщение?_
+"""
+        else:
+            preview_text = f"""
+📋 Предпросмотр рассылки:
+
+{broadcast_text}
+
+────────────────
+Отправить это сообщение?
 """
 
         markup = types.InlineKeyboardMarkup(row_width=2)
@@ -1735,31 +3964,28 @@ def send_broadcast(chat_id, target_type, target_value, broadcast_data, admin_id)
 
         recipients = cursor.fetchall()
 
-        successful, failed = 0, 0
-
-        for recipient in recipients:
-            try:
-                if parse_mode:
-                    bot.send_message(recipient['user_id'], broadcast_text, parse_mode=parse_mode)
-                else:
-                    bot.send_message(recipient['user_id'], broadcast_text)
-                successful += 1
-            except:
-                failed += 1
-
-        # Отчет
-        report = f"""
+        def broadcast_report(job):
+            # Отчет
+            return f"""
 📊 <b>Отчет о рассылке:</b>
 
 <blockquote>Цель: {target_description}
-Всего получателей: {len(recipients)}
-✅ Успешно отправлено: {successful}
-❌ Не удалось отправить: {failed}</blockquote>
+Всего получателей: {job['total']}
+✅ Успешно отправлено: {job['sent']}
+🚫 Заблокировали бота: {job['blocked']}
+❌ Не удалось отправить: {job['failed']}</blockquote>
 
-<i>{"Некоторые пользователи могли заблокировать бота" if failed > 0 else "Все сообщения доставлены"}</i>
+<i>{"Пользователи, заблокировавшие бота, исключены из следующих рассылок" if job['blocked'] > 0 else "Все сообщения доставлены" if job['failed'] == 0 else "Часть сообщений не доставлена"}</i>
 """
 
-        bot.send_message(chat_id, report, parse_mode='HTML')
+        enqueue_bulk(
+            [recipient['user_id'] for recipient in recipients],
+            broadcast_text,
+            title=f"Рассылка {target_description}",
+            report_chat_id=chat_id,
+            on_done=broadcast_report,
+            parse_mode=parse_mode
+        )
 
     except Exception as e:
         bot.send_message(chat_id, f"❌ Ошибка: {str(e)}")
@@ -1815,29 +4041,23 @@ def notify_all_about_raspush(task_id, name, description):
         )
     )
 
-    for user in users:
-        try:
-            bot.send_message(
-                user['user_id'],
-                f"🚀 <b>НОВАЯ ЗАДАЧА РАСПУШ</b>\n\n"
-                f"<b>{name}</b>\n\n"
-                f"{description}\n\n"
-                f"<i>За задачу начисляются баллы!</i>",
-                parse_mode='HTML',
-                reply_markup=markup
-            )
-        except:
-            pass
+    enqueue_bulk(
+        [user['user_id'] for user in users],
+        f"🚀 <b>НОВАЯ ЗАДАЧА РАСПУШ</b>\n\n"
+        f"<b>{name}</b>\n\n"
+        f"{description}\n\n"
+        f"<i>За задачу начисляются баллы!</i>",
+        title="Задача РАСПУШ",
+        parse_mode='HTML',
+        reply_markup=markup
+    )
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("raspush_start_"))
-def handle_raspush_start(call):
+@callback_route(prefix='raspush_start_', parse=int)
+def handle_raspush_start(call, task_id):
     """Обработчик кнопки начала выполнения распуша"""
     user_id = call.from_user.id
 
-    # Получаем ID задачи
-    task_id = int(call.data.split("_")[-1])
-
     # Проверяем, есть ли у пользователя муниципалитет
     user = get_user_info(user_id)
     if not user or user['city'] == 'Не указан':
@@ -1925,20 +4145,19 @@ def handle_raspush_links_submission(message):
     # Получаем информацию о пользователе
     user = get_user_info(user_id)
 
-    # Сохраняем выполнение
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
     now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     all_links = "\n".join(vk_links + tg_links)
 
+    # Выполнение, счётчик распушей и баллы — одной транзакцией
     try:
-        cursor.execute('''
-            INSERT INTO raspush_completions 
-            (task_id, user_id, city, links, completed_at)
-            VALUES (?, ?, ?, ?, ?)
-        ''', (task_id, user_id, user['city'], all_links, now))
-        conn.commit()
+        with db_transaction() as conn:
+            conn.execute('''
+                INSERT INTO raspush_completions 
+                (task_id, user_id, city, links, completed_at)
+                VALUES (?, ?, ?, ?, ?)
+            ''', (task_id, user_id, user['city'], all_links, now))
+            new_points, new_raspush_count = apply_points(user_id, points, f"Распуш-задача #{task_id}", user_id,
+                                                         counter_type='raspush_completed')
     except sqlite3.IntegrityError:
         # Уже есть запись для этого города
         bot.send_message(
@@ -1949,19 +4168,9 @@ def handle_raspush_links_submission(message):
         del raspush_active_tasks[user_id]
         return
 
-    # Обновляем счётчик выполненных распушей
-    new_raspush_count = update_user_counter(user_id, 'raspush_completed', 1)
-
     # И в сообщении пользователю:
     f"📋 Выполнено распушей: {new_raspush_count}\n\n"
 
-    # Начисляем баллы
-    new_points = update_user_points(user_id, points)
-    log_points_history(user_id, points, f"Распуш-задача #{task_id}", user_id)
-
-    # Сохраняем в Excel для отчета
-    save_raspush_to_excel(user['city'], all_links, task_id)
-
     # Отправляем подтверждение
     bot.send_message(
         user_id,
@@ -1993,33 +4202,18 @@ def handle_raspush_links_submission(message):
         except:
             pass
 
-def save_raspush_to_excel(city, links, task_id):
-    """Сохранить отчет о распуше в Excel"""
-    try:
-        file_name = "raspush_results.xlsx"
-
-        if os.path.exists(file_name):
-            df = pd.read_excel(file_name)
-        else:
-            df = pd.DataFrame(columns=["Дата", "Задача #", "Муниципалитет", "Ссылки"])
-
-        new_row = {
-            "Дата": datetime.now().strftime("%d.%m.%Y %H:%M"),
-            "Задача #": task_id,
-            "Муниципалитет": city,
-            "Ссылки": links
-        }
+def generate_raspush_report(task_id, filename=None, progress=None):
+    """Сгенерировать отчет по задаче распуша.
 
-        df = pd.concat([df, pd.DataFrame([new_row])], ignore_index=True)
-        df.to_excel(file_name, index=False)
-        return True
-    except Exception as e:
-        print(f"Ошибка сохранения в Excel: {e}")
-        return False
-def generate_raspush_report(task_id):
-    """Сгенерировать отчет по задаче распуша"""
-    conn = get_db_connection()
+    Строки читаются из raspush_completions порциями и сразу пишутся в книгу
+    write_only, поэтому память не растёт с числом выполнений
+    """
+    conn = get_db_read_connection()
     cursor = conn.cursor()
+    cursor.execute('SELECT COUNT(*) FROM raspush_completions WHERE task_id = ?', (task_id,))
+    total_rows = cursor.fetchone()[0]
+    if not total_rows:
+        return None, "Нет данных по этой задаче"
 
     cursor.execute('''
         SELECT city, links, completed_at, user_id
@@ -2028,35 +4222,33 @@ def generate_raspush_report(task_id):
         ORDER BY completed_at
     ''', (task_id,))
 
-    data = cursor.fetchall()
-
-    if not data:
-        return None, "Нет данных по этой задаче"
-
-    # Создаем DataFrame
-    rows = []
-    for row in data:
-        rows.append({
-            'Муниципалитет': row['city'],
-            'Ссылки': row['links'],
-            'Дата выполнения': row['completed_at'],
-            'ID пользователя': row['user_id']
-        })
-
-    df = pd.DataFrame(rows)
-
-    filename = f"raspush_report_{task_id}_{datetime.now().strftime('%Y%m%d')}.xlsx"
-    df.to_excel(filename, index=False)
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet('Распуш')
+    for column, width in zip('ABCD', (25, 60, 20, 15)):
+        sheet.column_dimensions[column].width = width
+    sheet.append(['Муниципалитет', 'Ссылки', 'Дата выполнения', 'ID пользователя'])
 
+    written = 0
+    while True:
+        rows = cursor.fetchmany(REPORT_FETCH_SIZE)
+        if not rows:
+            break
+        for row in rows:
+            sheet.append([row['city'], row['links'], row['completed_at'], row['user_id']])
+        written += len(rows)
+        if progress:
+            progress(written, total_rows)
+
+    if filename is None:
+        filename = f"raspush_report_{task_id}_{datetime.now().strftime('%Y%m%d')}.xlsx"
+    workbook.save(filename)
     return filename, None
 def cleanup_old_raspush():
-    """Удалить просроченные задачи распуша"""
-    try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-
-        now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    """Удалить просроченные задачи распуша (задание планировщика, ошибки учитываются в /jobs)"""
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
+    with db_transaction() as conn:
+        cursor = conn.cursor()
         cursor.execute('''
             SELECT id FROM raspush_tasks WHERE expires_at <= ?
         ''', (now,))
@@ -2068,17 +4260,12 @@ def cleanup_old_raspush():
             cursor.execute('DELETE FROM raspush_completions WHERE task_id = ?', (task_id,))
             cursor.execute('DELETE FROM raspush_tasks WHERE id = ?', (task_id,))
 
-        conn.commit()
-    except Exception as e:
-        print(f"Ошибка при очистке распуша: {e}")
+    for task in expired:
+        drop_cached_reports(make_report_prefix('raspush', (task['id'],)))
 
-@bot.callback_query_handler(func=lambda call: call.data == "admin_create_raspush")
+@callback_route('admin_create_raspush', admin=True)
 def admin_create_raspush_handler(call):
     """Админ: начало создания задачи распуша"""
-    if not is_admin(call.from_user.id):
-        bot.answer_callback_query(call.id, "⛔ Нет доступа")
-        return
-
     bot.edit_message_text(
         "🚀 <b>Создание задачи РАСПУШ</b>\n\n"
         "Введите название задачи:",
@@ -2141,13 +4328,9 @@ def process_raspush_description(message):
     # Возвращаем в админ-панель
     show_city_admin_tasks(message.chat.id)
 
-@bot.callback_query_handler(func=lambda call: call.data == "admin_raspush_report")
+@callback_route('admin_raspush_report', admin=True)
 def admin_raspush_report_handler(call):
     """Админ: запрос отчета по распушу"""
-    if not is_admin(call.from_user.id):
-        bot.answer_callback_query(call.id, "⛔ Нет доступа")
-        return
-
     msg = bot.send_message(
         call.message.chat.id,
         "📊 <b>Введите номер задачи РАСПУШ для отчета:</b>\n\n"
@@ -2161,30 +4344,14 @@ def process_raspush_report_request(message):
     """Обработка запроса отчета по распушу"""
     try:
         task_id = int(message.text.strip())
-
-        bot.send_message(message.chat.id, "⏳ Генерирую отчет...")
-
-        filename, error = generate_raspush_report(task_id)
-
-        if error:
-            bot.send_message(message.chat.id, f"❌ {error}")
-        else:
-            with open(filename, 'rb') as file:
-                bot.send_document(
-                    message.chat.id,
-                    file,
-                    caption=f"📊 Отчет по задаче РАСПУШ #{task_id}",
-                    parse_mode='HTML'
-                )
-            os.remove(filename)
-
-    except ValueError:
+    except (AttributeError, ValueError):
         bot.send_message(message.chat.id, "❌ Введите номер задачи (число)")
-    except Exception as e:
-        bot.send_message(message.chat.id, f"❌ Ошибка: {str(e)}")
+        show_city_admin_tasks(message.chat.id)
+        return
 
-    # Возвращаем в админ-панель
-    show_city_admin_tasks(message.chat.id)
+    # Отчет формируется в фоне, после отправки возвращаем в админ-панель
+    request_report(message.chat.id, 'raspush', (task_id,), f"📊 Отчет по задаче РАСПУШ #{task_id}",
+                   on_done=lambda: show_city_admin_tasks(message.chat.id))
 
 
 # ДОБАВИТЬ эту функцию:
@@ -2211,24 +4378,12 @@ def delete_raspush_task(task_id, admin_id):
         cursor.execute('DELETE FROM raspush_tasks WHERE id = ?', (task_id,))
 
         conn.commit()
+        drop_cached_reports(make_report_prefix('raspush', (task_id,)))
 
         return True, f"✅ Задача '{task_name}' удалена. Выполнений: {completions_count}"
 
     except Exception as e:
         return False, f"Ошибка при удалении: {str(e)}"
-def raspush_cleanup_scheduler():
-    """Планировщик очистки просроченных задач распуша"""
-    while True:
-        try:
-            cleanup_old_raspush()
-            time.sleep(86400)  # 24 часа
-        except Exception as e:
-            print(f"Ошибка в планировщике распуша: {e}")
-            time.sleep(3600)
-
-# Запуск очистки просроченных задач в отдельном потоке
-raspush_cleanup_thread = threading.Thread(target=raspush_cleanup_scheduler, daemon=True)
-raspush_cleanup_thread.start()
 
 # ======================================
 # ДОСТИЖЕНИЯ И ПЛАНЁРКИ
@@ -2249,46 +4404,150 @@ def get_user_counters(user_id):
         counters[row['counter_type']] = row['value']
 
     return counters
+# Увеличение счётчика на месте: без удаления строки, как было с INSERT OR REPLACE
+COUNTER_UPSERT_SQL = '''
+    INSERT INTO user_counters (user_id, counter_type, value, last_updated)
+    VALUES (?, ?, ?, ?)
+    ON CONFLICT (user_id, counter_type)
+    DO UPDATE SET value = value + excluded.value, last_updated = excluded.last_updated
+'''
 def update_user_counter(user_id, counter_type, amount=1):
-    """Обновить счётчик пользователя"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
+    """Обновить счётчик пользователя, вернуть новое значение (один запрос и один commit)"""
     now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
-    # Обновляем или создаём счётчик
-    cursor.execute('''
-        INSERT OR REPLACE INTO user_counters (user_id, counter_type, value, last_updated)
-        VALUES (?, ?, COALESCE((SELECT value FROM user_counters WHERE user_id = ? AND counter_type = ?), 0) + ?, ?)
-    ''', (user_id, counter_type, user_id, counter_type, amount, now))
+    with db_transaction() as conn:
+        cursor = conn.cursor()
+        cursor.execute(COUNTER_UPSERT_SQL + ' RETURNING value', (user_id, counter_type, amount, now))
+        new_value = cursor.fetchone()['value']
+        invalidate_screens([user_id])
 
-    # Получаем новое значение
-    cursor.execute('''
-        SELECT value FROM user_counters WHERE user_id = ? AND counter_type = ?
-    ''', (user_id, counter_type))
+        crossed = achievements_crossed(counter_type, new_value - amount, new_value)
+        if crossed:
+            grant_auto_achievements([(user_id, achievement_id) for achievement_id in crossed])
 
-    new_value = cursor.fetchone()['value']
+    return new_value
+def update_user_counters_bulk(user_ids, counter_type, amount=1):
+    """Увеличить счётчик сразу многим пользователям одной транзакцией.
 
-    conn.commit()
+    Возвращает {user_id: новое значение}
+    """
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    user_ids = list(dict.fromkeys(user_ids))
+    values = {}
+    if not user_ids:
+        return values
 
-    # ============ ИЗМЕНЁННЫЙ КОД ============
-    # Проверяем достижения ТОЛЬКО если они настроены
-    if counter_type in COUNTERS_CONFIG:
-        achievements_config = COUNTERS_CONFIG[counter_type].get('achievements', {})
-        # Больше никаких автоматических проверок
-    # ========================================
+    with db_transaction() as conn:
+        cursor = conn.cursor()
+        cursor.executemany(COUNTER_UPSERT_SQL, [(user_id, counter_type, amount, now) for user_id in user_ids])
+
+        for i in range(0, len(user_ids), 500):
+            chunk = user_ids[i:i + 500]
+            cursor.execute(f'''
+                SELECT user_id, value FROM user_counters
+                WHERE counter_type = ? AND user_id IN ({",".join("?" * len(chunk))})
+            ''', [counter_type] + chunk)
+            values.update((row['user_id'], row['value']) for row in cursor.fetchall())
+        invalidate_screens(values)
+
+        unlocks = [(user_id, achievement_id)
+                   for user_id, value in values.items()
+                   for achievement_id in achievements_crossed(counter_type, value - amount, value)]
+        if unlocks:
+            grant_auto_achievements(unlocks)
+
+    return values
+def achievements_crossed(counter_type, old_value, new_value):
+    """Достижения, пороги которых пройдены при росте счётчика с old_value до new_value"""
+    thresholds, achievement_ids = ACHIEVEMENT_THRESHOLDS.get(counter_type, ((), ()))
+    return achievement_ids[bisect_right(thresholds, old_value):bisect_right(thresholds, new_value)]
+def achievements_reached(counter_type, value):
+    """Все достижения, положенные при значении счётчика value"""
+    thresholds, achievement_ids = ACHIEVEMENT_THRESHOLDS.get(counter_type, ((), ()))
+    return achievement_ids[:bisect_right(thresholds, value)]
+def grant_auto_achievements(unlocks, bulk_notify=False):
+    """Выдать автоматические достижения [(user_id, achievement_id)] одной транзакцией.
+
+    Уже полученные пропускаются. Запись достижения, история и баллы сохраняются вместе,
+    уведомления ставятся в очередь отправки после commit: каждому со стикером или,
+    при bulk_notify, одной рассылкой на достижение. Возвращает список выданных
+    """
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    granted = []
 
-    return new_value
+    with db_transaction() as conn:
+        cursor = conn.cursor()
+        for user_id, achievement_id in unlocks:
+            cursor.execute('''
+                INSERT OR IGNORE INTO user_achievements (user_id, achievement_id, unlocked_at, is_manual)
+                VALUES (?, ?, ?, 0)
+            ''', (user_id, achievement_id, now))
+            if cursor.rowcount:
+                granted.append((user_id, achievement_id))
+
+        if not granted:
+            return granted
+        invalidate_screens({user_id for user_id, _ in granted})
+
+        cursor.executemany('''
+            INSERT INTO achievements_history 
+            (user_id, achievement_id, unlocked_at, is_manual, points_awarded)
+            VALUES (?, ?, ?, 0, ?)
+        ''', [(user_id, achievement_id, now, AUTO_ACHIEVEMENT_POINTS) for user_id, achievement_id in granted])
+
+        apply_points_batch([(user_id, AUTO_ACHIEVEMENT_POINTS, f"Автоматическое достижение: {achievement_id}", None)
+                            for user_id, achievement_id in granted])
+
+        if bulk_notify:
+            run_after_commit(lambda: notify_achievements_bulk(granted))
+        else:
+            run_after_commit(lambda: notify_achievements(granted))
+
+    return granted
+def notify_achievements_bulk(granted):
+    """Уведомить о многих достижениях сразу: текст через очередь рассылки, без стикеров"""
+    by_achievement = {}
+    for user_id, achievement_id in granted:
+        by_achievement.setdefault(achievement_id, []).append(user_id)
+
+    for achievement_id, user_ids in by_achievement.items():
+        message = ACHIEVEMENT_MESSAGES.get(achievement_id,
+                                           f'🎉 Поздравляем! Вы получили достижение: {achievement_id}')
+        enqueue_bulk(user_ids, f"<b>🎉 Новое достижение!</b>\n\n{message}\n\n",
+                     title=f"Достижение: {achievement_id}", parse_mode='HTML')
+
+    conn = get_db_connection()
+    conn.executemany('UPDATE user_achievements SET notified = 1 WHERE user_id = ? AND achievement_id = ?', granted)
+    conn.commit()
 def check_achievements(user_id, counter_type, current_value):
     """Проверить и разблокировать достижения"""
-    if counter_type not in COUNTERS_CONFIG:
-        return
+    reached = achievements_reached(counter_type, current_value)
+    if reached:
+        grant_auto_achievements([(user_id, achievement_id) for achievement_id in reached])
+def backfill_achievements():
+    """Выдать недостающие автоматические достижения всем пользователям за один проход.
 
-    achievements_config = COUNTERS_CONFIG[counter_type]['achievements']
+    Возвращает список выданных [(user_id, achievement_id)]
+    """
+    conn = get_db_read_connection()
+    cursor = conn.cursor()
+
+    cursor.execute('SELECT user_id, achievement_id FROM user_achievements')
+    existing = {(row['user_id'], row['achievement_id']) for row in cursor.fetchall()}
+
+    cursor.execute('''
+        SELECT uc.user_id, uc.counter_type, uc.value
+        FROM user_counters uc
+        JOIN users u ON u.user_id = uc.user_id
+    ''')
+    unlocks = [(row['user_id'], achievement_id)
+               for row in cursor.fetchall()
+               for achievement_id in achievements_reached(row['counter_type'], row['value'])
+               if (row['user_id'], achievement_id) not in existing]
 
-    for threshold, achievement_id in achievements_config.items():
-        if current_value >= threshold and not has_achievement(user_id, achievement_id):
-            unlock_achievement(user_id, achievement_id)
+    if not unlocks:
+        return []
+    return grant_auto_achievements(unlocks, bulk_notify=True)
 def has_achievement(user_id, achievement_id):
     """Проверить, есть ли у пользователя достижение"""
     conn = get_db_connection()
@@ -2302,43 +4561,7 @@ def has_achievement(user_id, achievement_id):
     return cursor.fetchone() is not None
 def unlock_achievement(user_id, achievement_id):
     """Разблокировать достижение"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
-    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-
-    # Проверяем, есть ли уже это достижение
-    if has_achievement(user_id, achievement_id):
-        return False
-
-    # Вставляем в user_achievements
-    cursor.execute('''
-        INSERT INTO user_achievements (user_id, achievement_id, unlocked_at, is_manual)
-        VALUES (?, ?, ?, 0)
-    ''', (user_id, achievement_id, now))
-
-    # Вставляем в историю достижений
-    cursor.execute('''
-        INSERT INTO achievements_history 
-        (user_id, achievement_id, unlocked_at, is_manual, points_awarded)
-        VALUES (?, ?, ?, 0, ?)
-    ''', (user_id, achievement_id, now, 5))
-
-    # Начисляем баллы пользователю
-    cursor.execute('UPDATE users SET points = points + 5 WHERE user_id = ?', (user_id,))
-
-    conn.commit()
-
-    # Логируем начисление баллов
-    try:
-        log_points_history(user_id, 5, f"Автоматическое достижение: {achievement_id}", None)
-    except:
-        pass
-
-    # Отправляем уведомление
-    notify_achievement_unlocked(user_id, achievement_id, is_manual=False)
-
-    return True
+    return bool(grant_auto_achievements([(user_id, achievement_id)]))
 def give_manual_achievement(user_id, achievement_id, admin_id, reason=""):
     """Выдать ручное достижение пользователю"""
     conn = get_db_connection()
@@ -2355,26 +4578,21 @@ def give_manual_achievement(user_id, achievement_id, admin_id, reason=""):
     if cursor.fetchone():
         return False, "У пользователя уже есть это достижение"
 
-    # Добавляем достижение
-    cursor.execute('''
-        INSERT INTO user_achievements (user_id, achievement_id, unlocked_at, is_manual, admin_id)
-        VALUES (?, ?, ?, 1, ?)
-    ''', (user_id, achievement_id, now, admin_id))
-
-    # Добавляем в историю достижений
-    cursor.execute('''
-        INSERT INTO achievements_history (user_id, achievement_id, unlocked_at, 
-                                         is_manual, admin_id, reason, points_awarded)
-        VALUES (?, ?, ?, 1, ?, ?, ?)
-    ''', (user_id, achievement_id, now, admin_id, reason, 10))
-
-    # Начисляем баллы за ручное достижение
-    cursor.execute('UPDATE users SET points = points + 10 WHERE user_id = ?', (user_id,))
+    # Достижение, история и баллы за ручное достижение — одной транзакцией
+    with db_transaction():
+        cursor.execute('''
+            INSERT INTO user_achievements (user_id, achievement_id, unlocked_at, is_manual, admin_id)
+            VALUES (?, ?, ?, 1, ?)
+        ''', (user_id, achievement_id, now, admin_id))
+        invalidate_screens([user_id])
 
-    conn.commit()
+        cursor.execute('''
+            INSERT INTO achievements_history (user_id, achievement_id, unlocked_at, 
+                                             is_manual, admin_id, reason, points_awarded)
+            VALUES (?, ?, ?, 1, ?, ?, ?)
+        ''', (user_id, achievement_id, now, admin_id, reason, 10))
 
-    # Логируем начисление баллов
-    log_points_history(user_id, 10, f"Ручное достижение: {achievement_id} ({reason})", admin_id)
+        apply_points(user_id, 10, f"Ручное достижение: {achievement_id} ({reason})", admin_id)
 
     # Отправляем уведомление
     notify_achievement_unlocked(user_id, achievement_id, is_manual=True)
@@ -2402,19 +4620,6 @@ def remove_achievement(user_id, achievement_id, admin_id, reason=""):
         WHERE user_id = ? AND achievement_id = ?
     ''', (user_id, achievement_id))
 
-    # Создаем таблицу для логирования удалений, если её нет
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS removed_achievements_history (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            achievement_id TEXT,
-            admin_id INTEGER,
-            reason TEXT,
-            removed_at TEXT,
-            FOREIGN KEY (user_id) REFERENCES users (user_id)
-        )
-    ''')
-
     # Логируем удаление
     cursor.execute('''
         INSERT INTO removed_achievements_history 
@@ -2423,57 +4628,59 @@ def remove_achievement(user_id, achievement_id, admin_id, reason=""):
     ''', (user_id, achievement_id, admin_id, reason, now))
 
     conn.commit()
+    invalidate_screens([user_id])
 
     return True, "Достижение успешно снято"
-def notify_achievement_unlocked(user_id, achievement_id, is_manual=False):
-    """Отправить уведомление о разблокированном достижении со стикером"""
-    try:
-        message = ACHIEVEMENT_MESSAGES.get(
-            achievement_id,
-            f'🎉 Поздравляем! Вы получили достижение: {achievement_id}'
-        )
-
-        user = get_user_info(user_id)
-        if not user:
-            return
+def notify_achievements(granted):
+    """Уведомить о выданных достижениях [(user_id, achievement_id)] через очередь отправки.
 
-        # 1. Отправляем стикер (если есть)
+    Каждому — стикер (или эмодзи) и поздравление; поток обработчика Telegram не ждёт
+    """
+    for user_id, achievement_id in granted:
+        emoji = ACHIEVEMENT_EMOJIS.get(achievement_id, '🏆')
         if achievement_id in STICKER_IDS:
-            sticker_id = STICKER_IDS[achievement_id]
-            try:
-                bot.send_sticker(user_id, sticker_id)
-            except Exception as e:
-                # Фоллбэк на обычный эмодзи
-                emoji = ACHIEVEMENT_EMOJIS.get(achievement_id, '🏆')
-                bot.send_message(user_id, emoji, parse_mode='HTML')
+            enqueue_sticker(user_id, STICKER_IDS[achievement_id], fallback_text=emoji)
         else:
-            # Если стикера нет, отправляем обычный эмодзи
-            emoji = ACHIEVEMENT_EMOJIS.get(achievement_id, '🏆')
-            bot.send_message(user_id, emoji, parse_mode='HTML')
+            enqueue_message(user_id, emoji, parse_mode='HTML')
 
-        # 2. Отправляем текст поздравления
-        bot.send_message(
-            user_id,
-            f"<b>🎉 Новое достижение!</b>\n\n"
-            f"{message}\n\n",
-            parse_mode='HTML'
-        )
+        message = ACHIEVEMENT_MESSAGES.get(achievement_id,
+                                           f'🎉 Поздравляем! Вы получили достижение: {achievement_id}')
+        enqueue_message(user_id, f"<b>🎉 Новое достижение!</b>\n\n{message}\n\n", parse_mode='HTML')
 
-        # 3. Помечаем как уведомлённое
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute('''
-            UPDATE user_achievements 
-            SET notified = 1 
-            WHERE user_id = ? AND achievement_id = ?
-        ''', (user_id, achievement_id))
-        conn.commit()
+    conn = get_db_connection()
+    conn.executemany('UPDATE user_achievements SET notified = 1 WHERE user_id = ? AND achievement_id = ?', granted)
+    conn.commit()
+def notify_achievement_unlocked(user_id, achievement_id, is_manual=False):
+    """Отправить уведомление о разблокированном достижении со стикером (через очередь отправки)"""
+    try:
+        if not get_user_info(user_id):
+            return
+        notify_achievements([(user_id, achievement_id)])
 
     except Exception as e:
         print(f"Ошибка при отправке уведомления: {e}")
 def show_user_achievements(user_id, chat_id, message_id=None):
     """Показать все достижения пользователя"""
-    conn = get_db_connection()
+    response, markup = get_screen(user_id, 'achievements', lambda: render_user_achievements(user_id))
+
+    if message_id:
+        bot.edit_message_text(
+            response,
+            chat_id,
+            message_id,
+            parse_mode='HTML',
+            reply_markup=markup
+        )
+    else:
+        bot.send_message(
+            chat_id,
+            response,
+            parse_mode='HTML',
+            reply_markup=markup
+        )
+def render_user_achievements(user_id):
+    """Текст и клавиатура экрана достижений"""
+    conn = get_db_read_connection()
     cursor = conn.cursor()
 
     # Получаем достижения пользователя
@@ -2526,27 +4733,10 @@ def show_user_achievements(user_id, chat_id, message_id=None):
     markup = types.InlineKeyboardMarkup()
     markup.add(types.InlineKeyboardButton('🔙 Назад', callback_data='personal_cabinet'))
 
-    if message_id:
-        bot.edit_message_text(
-            response,
-            chat_id,
-            message_id,
-            parse_mode='HTML',
-            reply_markup=markup
-        )
-    else:
-        bot.send_message(
-            chat_id,
-            response,
-            parse_mode='HTML',
-            reply_markup=markup
-        )
+    return response, markup
 def show_users_for_achievement(chat_id, action):
     """Показать список пользователей для управления счётчиками"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('SELECT user_id, first_name, city, points FROM users ORDER BY points DESC LIMIT 15')
-    users = cursor.fetchall()
+    users = get_top_users(15)
 
     markup = types.InlineKeyboardMarkup(row_width=2)
     for user in users:
@@ -2689,27 +4879,25 @@ def process_remove_achievement_reason(message, user_id, achievement_id, original
 # Функции для планёрок
 def add_meeting_participation(user_id, meeting_topic, admin_id, notes=""):
     """Добавить запись о посещении планёрки"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    return add_meetings_participation([user_id], meeting_topic, admin_id, notes)[user_id]
+def add_meetings_participation(user_ids, meeting_topic, admin_id, notes=""):
+    """Отметить планёрку всем участникам сразу: история и счётчики одной транзакцией.
 
+    Возвращает {user_id: всего планёрок}
+    """
     now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     meeting_date = datetime.now().strftime("%Y-%m-%d")
 
-    # Добавляем в историю планёрок
-    cursor.execute('''
-        INSERT INTO meetings_history (user_id, meeting_date, meeting_topic, added_by_admin, notes, created_at)
-        VALUES (?, ?, ?, ?, ?, ?)
-    ''', (user_id, meeting_date, meeting_topic, admin_id, notes, now))
-
-    # Обновляем счётчик планёрок
-    new_value = update_user_counter(user_id, 'meetings_attended', 1)
-
-    conn.commit()
+    with db_transaction() as conn:
+        conn.executemany('''
+            INSERT INTO meetings_history (user_id, meeting_date, meeting_topic, added_by_admin, notes, created_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', [(user_id, meeting_date, meeting_topic, admin_id, notes, now) for user_id in user_ids])
 
-    return new_value
+        return update_user_counters_bulk(user_ids, 'meetings_attended', 1)
 def get_meetings_statistics():
     """Получить статистику по планёркам"""
-    conn = get_db_connection()
+    conn = get_db_read_connection()
     cursor = conn.cursor()
 
     # Общая статистика
@@ -2749,6 +4937,42 @@ def show_meeting_addition_panel(chat_id, user_id=None):
     else:
         # Сначала выбираем пользователя
         show_users_for_achievement(chat_id, 'add_meeting_detail')
+def ask_meeting_participants(chat_id):
+    """Планёрка сразу для нескольких участников: запрос списка ID"""
+    msg = bot.send_message(
+        chat_id,
+        "👥 <b>Планёрка: несколько участников</b>\n\n"
+        "Отправьте ID участников через пробел или запятую:",
+        parse_mode='HTML'
+    )
+    bot.register_next_step_handler(msg, process_meeting_participants, chat_id)
+def process_meeting_participants(message, original_chat_id):
+    """Обработка списка участников планёрки"""
+    try:
+        user_ids = list(dict.fromkeys(int(part) for part in re.split(r'[\s,;]+', message.text.strip()) if part))
+    except ValueError:
+        bot.send_message(original_chat_id, "❌ ID должны быть числами")
+        show_achievements_admin_panel(original_chat_id)
+        return
+
+    conn = get_db_read_connection()
+    found = set()
+    for i in range(0, len(user_ids), 500):
+        chunk = user_ids[i:i + 500]
+        rows = conn.execute(f'SELECT user_id FROM users WHERE user_id IN ({",".join("?" * len(chunk))})', chunk)
+        found.update(row['user_id'] for row in rows)
+
+    missing = [str(user_id) for user_id in user_ids if user_id not in found]
+    if not user_ids or missing:
+        bot.send_message(original_chat_id,
+                         f"❌ Не найдены пользователи: {', '.join(missing)}" if missing else "❌ Список пуст")
+        show_achievements_admin_panel(original_chat_id)
+        return
+
+    msg = bot.send_message(original_chat_id,
+                           f"👥 Участников: {len(user_ids)}\n\nВведите дату планёрки:",
+                           parse_mode='HTML')
+    bot.register_next_step_handler(msg, process_meeting_topic, user_ids, original_chat_id)
 def process_meeting_topic(message, user_id, original_chat_id):
     """Обработка темы планёрки"""
     meeting_topic = message.text.strip()
@@ -2766,11 +4990,24 @@ def process_meeting_topic(message, user_id, original_chat_id):
     )
     bot.register_next_step_handler(msg, process_meeting_notes, user_id, meeting_topic, original_chat_id)
 def process_meeting_notes(message, user_id, meeting_topic, original_chat_id):
-    """Обработка заметок к планёрке"""
+    """Обработка заметок к планёрке (user_id — ID участника или список ID)"""
     notes = message.text.strip()
     if notes == '-':
         notes = ""
 
+    if isinstance(user_id, list):
+        counts = add_meetings_participation(user_id, meeting_topic, message.from_user.id, notes)
+        bot.send_message(
+            original_chat_id,
+            f"✅ <b>Планёрка добавлена!</b>\n\n"
+            f"<b>Участников:</b> {len(counts)}\n"
+            f"<b>Дата:</b> {meeting_topic}\n"
+            f"{f'<b>Заметки:</b> {notes}' if notes else ''}",
+            parse_mode='HTML'
+        )
+        show_achievements_admin_panel(original_chat_id)
+        return
+
     # Добавляем планёрку
     new_count = add_meeting_participation(user_id, meeting_topic, message.from_user.id, notes)
 
@@ -2890,15 +5127,20 @@ def add_city_task(task_name, description, city, admin_id, due_date=None, points=
 
             task_ids.append(cursor.lastrowid)
 
-            # Записываем в Excel для каждого муниципалитета
-            success, excel_message = add_task_to_excel(task_name, description, city_name, due_date)
-            if not success:
-                print(f"Внимание для {city_name}: Не удалось записать в Excel: {excel_message}")
+        conn.commit()
+
+        for task_id, city_name in zip(task_ids, AVAILABLE_CITIES.keys()):
+            schedule_task_deadline(task_id, task_name, city_name, due_date_str)
+
+        # Записываем в Excel строки всех муниципалитетов за одну запись файла
+        success, excel_message = add_tasks_to_excel(task_name, description, list(AVAILABLE_CITIES.keys()), due_date)
+        if not success:
+            print(f"Внимание: Не удалось записать в Excel: {excel_message}")
 
-            # Уведомляем пользователей муниципалитета
+        # Уведомляем пользователей муниципалитетов
+        for city_name in AVAILABLE_CITIES.keys():
             notify_city_about_task(city_name, task_name, description, due_date_str, points)
 
-        conn.commit()
         return task_ids
     else:
         # Добавляем задачу для одного муниципалитета
@@ -2917,6 +5159,7 @@ def add_city_task(task_name, description, city, admin_id, due_date=None, points=
             print(f"Внимание: Не удалось записать в Excel: {excel_message}")
 
         conn.commit()
+        schedule_task_deadline(task_id, task_name, city, due_date_str)
 
         # Уведомляем пользователей
         notify_city_about_task(city, task_name, description, due_date_str, points)
@@ -2932,31 +5175,26 @@ def notify_city_about_task(city, task_name, description, due_date, points, task_
 
     city_emoji = AVAILABLE_CITIES.get(city, '🏙️')
 
-    for user in users:
-        try:
-            message = (
-                f"{city_emoji} <b>НОВАЯ ЗАДАЧА ДЛЯ {city}</b>\n\n"
-                f"<b>{task_name}</b>\n\n"
-            )
-
-            if description:
-                message += f"<b>Описание:</b>\n{description}\n\n"
+    message = (
+        f"{city_emoji} <b>НОВАЯ ЗАДАЧА ДЛЯ {city}</b>\n\n"
+        f"<b>{task_name}</b>\n\n"
+    )
 
-            # ИСПРАВЬ ЭТУ ЧАСТЬ - используй параметр due_date, а не due_date_str
-            if due_date:  # ← проверяем due_date, не due_date_str
-                due_date_obj = datetime.strptime(due_date, "%Y-%m-%d %H:%M:%S")
-                formatted_date = due_date_obj.strftime("%d.%m.%Y в %H:%M")
-                message += f"<b>Срок выполнения:</b> до {formatted_date}\n"
+    if description:
+        message += f"<b>Описание:</b>\n{description}\n\n"
 
-            if points > 0:
-                message += f"<b>Награда:</b> 🏅 +{points} баллов\n\n"
+    if due_date:
+        due_date_obj = datetime.strptime(due_date, "%Y-%m-%d %H:%M:%S")
+        formatted_date = due_date_obj.strftime("%d.%m.%Y в %H:%M")
+        message += f"<b>Срок выполнения:</b> до {formatted_date}\n"
 
-            message += "<i>Задача отмечена в вашем списке «Мои задачи»</i>"
+    if points > 0:
+        message += f"<b>Награда:</b> 🏅 +{points} баллов\n\n"
 
-            bot.send_message(user['user_id'], message, parse_mode='HTML')
+    message += "<i>Задача отмечена в вашем списке «Мои задачи»</i>"
 
-        except Exception as e:
-            print(f"Не удалось отправить уведомление пользователю {user['user_id']}: {e}")
+    enqueue_bulk([user['user_id'] for user in users], message,
+                 title=f"Новая задача для {city}", parse_mode='HTML')
 def complete_city_task(task_id, admin_id, reason="", action="complete", points=0):
     """Отметить задачу как выполненную или снять её с опцией добавления/списания баллов"""
     conn = get_db_connection()
@@ -2972,40 +5210,15 @@ def complete_city_task(task_id, admin_id, reason="", action="complete", points=0
         return False, "Задача уже выполнена"
 
     # 1. УДАЛЯЕМ ИЗ EXCEL ПЕРЕД ОБНОВЛЕНИЕМ БД
-    try:
-        # Загружаем Excel файл
-        df = pd.read_excel(EXCEL_FILE_PATH, engine='openpyxl')
-
-        task_name = task['task_name']
-        assigned_city = task['assigned_city']
-
-        # Ищем задачу в Excel
-        mask = (
-                df['Задача'].astype(str).str.contains(task_name, case=False, na=False) &
-                (df['Ответственный'].astype(str) == assigned_city)
-        )
-
-        if mask.any():
-            # Удаляем найденную задачу
-            df = df[~mask]
-            df.to_excel(EXCEL_FILE_PATH, index=False)
-            excel_result = " (удалена из Excel)"
-        else:
-            excel_result = " (не найдена в Excel)"
-
-    except Exception as e:
-        print(f"Ошибка при удалении из Excel: {e}")
-        excel_result = " (ошибка при удалении из Excel)"
+    if TASKS_STORAGE == 'sqlite':
+        removed = delete_db_tasks_by_name(task['task_name'], task['assigned_city'])
+        excel_result = " (удалена из списка задач)" if removed else " (не найдена в списке задач)"
+    else:
+        excel_result = remove_city_task_from_excel(task)
 
     # 2. ОБНОВЛЯЕМ БД
     now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
-    cursor.execute('''
-        UPDATE bot_tasks 
-        SET is_completed = 1, completed_date = ?
-        WHERE id = ?
-    ''', (now, task_id))
-
     # Обработка баллов в зависимости от действия
     points_to_award = 0
 
@@ -3016,25 +5229,22 @@ def complete_city_task(task_id, admin_id, reason="", action="complete", points=0
     elif action == "remove_points":
         points_to_award = -abs(points)  # Отрицательное значение
 
-    if points_to_award != 0:
+    # Статус задачи и баллы всем пользователям муниципалитета — одной транзакцией
+    with db_transaction():
         cursor.execute('''
-            UPDATE users 
-            SET points = points + ? 
-            WHERE city = ? AND is_banned = 0
-        ''', (points_to_award, task['assigned_city']))
-
-        cursor.execute('SELECT user_id FROM users WHERE city = ?', (task['assigned_city'],))
-        users = cursor.fetchall()
-
-        for user in users:
-            log_points_history(
-                user['user_id'],
-                points_to_award,
-                f"Снятие задачи: {task['task_name']} ({reason})",
-                admin_id
-            )
+            UPDATE bot_tasks 
+            SET is_completed = 1, completed_date = ?
+            WHERE id = ?
+        ''', (now, task_id))
 
-    conn.commit()
+        if points_to_award != 0:
+            # Баллы получают и заблокировавшие бота — исключены только забаненные админом
+            cursor.execute('SELECT user_id FROM users WHERE city = ? AND is_banned != 1', (task['assigned_city'],))
+            reason_text = f"Снятие задачи: {task['task_name']} ({reason})"
+            apply_points_batch([(user['user_id'], points_to_award, reason_text, admin_id)
+                                for user in cursor.fetchall()])
+
+    cancel_task_deadline(task_id)
 
     # 3. ФОРМИРУЕМ ОТВЕТ
     points_message = ""
@@ -3048,6 +5258,33 @@ def complete_city_task(task_id, admin_id, reason="", action="complete", points=0
     return True, f"✅ Задача снята. {points_message}{excel_result}"
 
     return True, f"Задача снята. {f'Начислено баллов: {points_to_award}' if points_to_award > 0 else f'Списано баллов: {abs(points_to_award)}' if points_to_award < 0 else ''}"
+def remove_city_task_from_excel(task):
+    """Удалить задачу муниципалитета из Excel файла (по названию и ответственному)"""
+    try:
+        tasks, error = load_tasks_from_excel()
+        if error:
+            raise Exception(error)
+
+        task_name = task['task_name'].lower()
+        assigned_city = task['assigned_city']
+
+        # Ищем задачу в Excel
+        task_ids = [
+            sheet_task['ID'] for sheet_task in tasks
+            if task_name in str(sheet_task['Задача']).lower()
+            and sheet_task['Ответственный'] == assigned_city
+        ]
+
+        if task_ids and delete_excel_tasks(task_ids):
+            excel_result = " (удалена из Excel)"
+        else:
+            excel_result = " (не найдена в Excel)"
+
+    except Exception as e:
+        print(f"Ошибка при удалении из Excel: {e}")
+        excel_result = " (ошибка при удалении из Excel)"
+
+    return excel_result
 def notify_city_about_task_completion(city, task_name, points):
     """Уведомить муниципалитет о выполнении задачи"""
     conn = get_db_connection()
@@ -3058,21 +5295,17 @@ def notify_city_about_task_completion(city, task_name, points):
 
     city_emoji = AVAILABLE_CITIES.get(city, '🏙️')
 
-    for user in users:
-        try:
-            message = (
-                f"{city_emoji} <b>ЗАДАЧА ВЫПОЛНЕНА!</b>\n\n"
-                f"<b>{task_name}</b>\n\n"
-                f"<i>Задача для {city} отмечена как выполненная</i>\n"
-            )
-
-            if points > 0:
-                message += f"\n<b>🎁 Награда:</b> 🏅 +{points} баллов каждому участнику!"
+    message = (
+        f"{city_emoji} <b>ЗАДАЧА ВЫПОЛНЕНА!</b>\n\n"
+        f"<b>{task_name}</b>\n\n"
+        f"<i>Задача для {city} отмечена как выполненная</i>\n"
+    )
 
-            bot.send_message(user['user_id'], message, parse_mode='HTML')
+    if points > 0:
+        message += f"\n<b>🎁 Награда:</b> 🏅 +{points} баллов каждому участнику!"
 
-        except Exception as e:
-            print(f"Не удалось отправить уведомление пользователю {user['user_id']}: {e}")
+    enqueue_bulk([user['user_id'] for user in users], message,
+                 title=f"Выполнение задачи ({city})", parse_mode='HTML')
 def send_completion_result(chat_id, success, result_message, task_id):
     """Отправка результата снятия задачи"""
     if success:
@@ -3286,54 +5519,120 @@ def process_task_points_selection(call, points):
     )
 
 
-def check_task_deadlines():
-    """Проверка дедлайнов задач и отправка уведомлений"""
-    while True:
-        try:
-            conn = get_db_connection()
-            cursor = conn.cursor()
-
-            # Используем текущее время и время через 24 часа
-            now = datetime.now()
-            today_str = now.strftime("%Y-%m-%d %H:%M:%S")
-            tomorrow = (now + timedelta(days=1)).strftime("%Y-%m-%d %H:%M:%S")
+def add_task_deadline(task_id, task_name, city, due_date, notified=0):
+    """Положить напоминания о дедлайне задачи в кучу (без перестановки задания планировщика)"""
+    due = datetime.strptime(due_date, "%Y-%m-%d %H:%M:%S")
+    with deadline_lock:
+        deadline_tasks[task_id] = {'id': task_id, 'task_name': task_name, 'assigned_city': city,
+                                   'due_date': due_date, 'due': due, 'notified': notified}
+        for hours, bit in DEADLINE_REMINDERS:
+            if not notified & bit:
+                heapq.heappush(deadline_heap, (due - timedelta(hours=hours), task_id))
+def schedule_task_deadline(task_id, task_name, city, due_date, notified=0):
+    """Поставить напоминания о дедлайне задачи в очередь планировщика"""
+    if not due_date:
+        return
 
-            cursor.execute('''
-                SELECT id, task_name, assigned_city, due_date
-                FROM bot_tasks 
-                WHERE is_completed = 0 
-                AND due_date IS NOT NULL
-                AND due_date > ?
-                AND due_date <= ?
-                AND deadline_notified = 0
-            ''', (today_str, tomorrow))
-
-            tasks = cursor.fetchall()
-
-            for task in tasks:
-                notify_task_deadline_reminder(task)
-
-                cursor.execute('''
-                    UPDATE bot_tasks 
-                    SET deadline_notified = 1 
-                    WHERE id = ?
-                ''', (task['id'],))
+    add_task_deadline(task_id, task_name, city, due_date, notified)
+    # Новое напоминание может оказаться раньше текущего запуска задания
+    reschedule_deadline_job()
+def cancel_task_deadline(task_id):
+    """Снять напоминания по закрытой задаче (записи в куче отбросятся при извлечении)"""
+    with deadline_lock:
+        deadline_tasks.pop(task_id, None)
+    reschedule_deadline_job()
+def reschedule_deadline_job():
+    """Перенести задание task_deadlines на время ближайшего напоминания"""
+    with deadline_lock:
+        # Закрытые задачи выбрасываем из кучи сразу, чтобы не просыпаться впустую
+        while deadline_heap and deadline_heap[0][1] not in deadline_tasks:
+            heapq.heappop(deadline_heap)
+        next_at = deadline_heap[0][0].timestamp() if deadline_heap else None
+
+    with scheduler_condition:
+        job = scheduler_jobs.get('task_deadlines')
+        current = job['next_run'] if job else None
+    if next_at is None:
+        if current is not None:
+            cancel_job('task_deadlines')
+    elif current is None or next_at < current:
+        schedule_job('task_deadlines', run_deadline_reminders, run_at=next_at,
+                     title="Напоминания о дедлайнах")
+def start_deadline_reminders():
+    """Загрузить в планировщик открытые задачи с будущим сроком"""
+    conn = get_db_read_connection()
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT id, task_name, assigned_city, due_date, deadline_notified
+        FROM bot_tasks 
+        WHERE is_completed = 0 
+        AND due_date IS NOT NULL
+        AND due_date > ?
+    ''', (datetime.now().strftime("%Y-%m-%d %H:%M:%S"),))
+
+    for task in cursor.fetchall():
+        add_task_deadline(task['id'], task['task_name'], task['assigned_city'],
+                          task['due_date'], task['deadline_notified'] or 0)
+    reschedule_deadline_job()
+def send_due_deadline_reminder(task_id):
+    """Отправить напоминание, срок которого наступил.
+
+    Если прошло сразу несколько порогов (задача создана за 10 часов до срока или бот
+    был выключен), уходит одно напоминание — по самому близкому к сроку порогу
+    """
+    now = datetime.now()
+    with deadline_lock:
+        task = deadline_tasks.get(task_id)
+        if task is None:
+            return
+        if task['due'] <= now:
+            deadline_tasks.pop(task_id, None)
+            return
 
-            conn.commit()
+        passed = [(hours, bit) for hours, bit in DEADLINE_REMINDERS if task['due'] - timedelta(hours=hours) <= now]
+        hours, bit = min(passed)
+        send = not task['notified'] & bit
+        for _, passed_bit in passed:
+            task['notified'] |= passed_bit
+        mask = task['notified']
+        if len(passed) == len(DEADLINE_REMINDERS):
+            deadline_tasks.pop(task_id, None)
 
-        except Exception as e:
-            print(f"Ошибка при проверке дедлайнов: {e}")
-            import traceback
-            print(traceback.format_exc())
+    if not send:
+        return
 
-        # Проверяем каждые 30 минут
-        time.sleep(1800)
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute('''
+        UPDATE bot_tasks 
+        SET deadline_notified = deadline_notified | ? 
+        WHERE id = ? AND is_completed = 0
+    ''', (mask, task_id))
+    conn.commit()
 
-def notify_task_deadline_reminder(task):
+    # Задачу успели закрыть — напоминать не о чем
+    if cursor.rowcount:
+        notify_task_deadline_reminder(task, hours)
+def run_deadline_reminders():
+    """Задание планировщика: отправить наступившие напоминания и встать на следующее"""
+    try:
+        while True:
+            with deadline_lock:
+                while deadline_heap and deadline_heap[0][1] not in deadline_tasks:
+                    heapq.heappop(deadline_heap)
+                if not deadline_heap or deadline_heap[0][0] > datetime.now():
+                    break
+                _, task_id = heapq.heappop(deadline_heap)
+
+            send_due_deadline_reminder(task_id)
+    finally:
+        reschedule_deadline_job()
+def notify_task_deadline_reminder(task, hours=24):
     """Уведомление о приближении дедлайна"""
     conn = get_db_connection()
     cursor = conn.cursor()
 
+    # Только рассылка: заблокировавшим бота (USER_BLOCKED_BOT) сообщение всё равно не доставить
     cursor.execute('SELECT user_id FROM users WHERE city = ? AND is_banned = 0', (task['assigned_city'],))
     users = cursor.fetchall()
 
@@ -3341,20 +5640,17 @@ def notify_task_deadline_reminder(task):
     due_date = datetime.strptime(task['due_date'], "%Y-%m-%d %H:%M:%S")
     formatted_date = due_date.strftime("%d.%m.%Y в %H:%M")
 
-    for user in users:
-        try:
-            message = (
-                f"⏰ <b>НАПОМИНАНИЕ О ДЕДЛАЙНЕ!</b>\n\n"
-                f"<b>{city_emoji} {task['assigned_city']}</b>\n"
-                f"<b>Задача:</b> {task['task_name']}\n"
-                f"<b>Срок выполнения:</b> {formatted_date}\n\n"
-                f"<i>Осталось менее 24 часов!</i>"
-            )
+    message = (
+        f"⏰ <b>НАПОМИНАНИЕ О ДЕДЛАЙНЕ!</b>\n\n"
+        f"<b>{city_emoji} {task['assigned_city']}</b>\n"
+        f"<b>Задача:</b> {task['task_name']}\n"
+        f"<b>Срок выполнения:</b> {formatted_date}\n\n"
+        f"<i>Осталось менее {hours} часов!</i>"
+    )
 
-            bot.send_message(user['user_id'], message, parse_mode='HTML')
-        except Exception as e:
-            print(f"Не удалось отправить напоминание пользователю {user['user_id']}: {e}")
-def assign_task_to_user(user_id, task_index_in_all):
+    enqueue_bulk([user['user_id'] for user in users], message,
+                 title="Напоминание о дедлайне", parse_mode='HTML')
+def assign_task_to_user(user_id, task_id):
     """Назначить задачу пользователю (добавить его муниципалитет в Ответственный)"""
     try:
         user = get_user_info(user_id)
@@ -3363,67 +5659,24 @@ def assign_task_to_user(user_id, task_index_in_all):
 
         user_city = user['city']
 
-        # Загружаем все задачи с правильными типами данных
-        tasks, error = load_tasks_from_excel()
-        if error:
-            return False, error
-
-        if task_index_in_all >= len(tasks):
+        task, _ = find_task_by_id(task_id)
+        if task is None:
             return False, "Задача не найдена"
 
-        task = tasks[task_index_in_all]
+        if TASKS_STORAGE == 'sqlite':
+            task_row = get_db_task(task_id)
+            if not task_row:
+                return False, "Задача не найдена"
+            update_db_task_responsible(task_row['id'], user_city)
+            log_points_history(user_id, 0, f"Принял задачу: {task['Задача']}", user_id)
+            return True, f"✅ Задача '{task['Задача']}' назначена на ваш муниципалитет ({user_city})"
 
-        # ОБНОВЛЕННАЯ ЧАСТЬ: Читаем Excel с правильными типами данных
-        file_path = EXCEL_FILE_PATH
-        if not os.path.exists(file_path):
+        if not os.path.exists(EXCEL_FILE_PATH):
             return False, "Файл не найден"
 
-        # Читаем файл с указанием типа для столбца "Ответственный"
-        df = pd.read_excel(
-            file_path,
-            engine='openpyxl',
-            dtype={'Ответственный': str}  # ← ВАЖНО: читаем как строку
-        )
-
-        # Преобразуем все значения "Ответственный" в строки и очищаем
-        df['Ответственный'] = df['Ответственный'].astype(str).str.strip()
-
-        # Заменяем NaN и специальные значения
-        df['Ответственный'] = df['Ответственный'].replace({
-            'nan': '',
-            'None': '',
-            'NaN': '',
-            '<NA>': '',
-            'NaT': '',
-            'None': ''
-        })
-
-        # Находим задачу
         task_name = task['Задача']
-        task_date = task['Дата']
-
-        # Ищем строку (учитываем, что дата может быть в разных форматах)
-        mask = (df['Задача'].astype(str).str.strip() == task_name.strip())
-
-        if task_date:
-            # Сравниваем только даты, игнорируя время и формат
-            try:
-                # Пробуем разные форматы дат
-                if isinstance(task_date, str):
-                    task_date_str = task_date
-                else:
-                    task_date_str = str(task_date)
-
-                # Ищем частичное совпадение для даты
-                mask = mask & (df['Дата'].astype(str).str.contains(task_date_str.split()[0]))
-            except:
-                pass
-
-        if mask.any():
-            # Нашли задачу - обновляем
-            df.loc[mask, 'Ответственный'] = user_city
-            df.to_excel(file_path, index=False)
 
+        if update_excel_task_cells(task_id, {'Ответственный': user_city}) is not None:
             # Логируем действие
             conn = get_db_connection()
             cursor = conn.cursor()
@@ -3451,10 +5704,10 @@ def show_complete_task_menu(chat_id):
 
     # Фильтруем задачи с ответственным
     assigned_tasks = []
-    for idx, task in enumerate(tasks):
+    for task in tasks:
         responsible = str(task.get('Ответственный', '')).strip()
         if responsible and responsible.lower() not in ['', 'nan', 'none', 'nat']:
-            assigned_tasks.append((idx, task))
+            assigned_tasks.append(task)
 
     if not assigned_tasks:
         bot.send_message(
@@ -3471,14 +5724,14 @@ def show_complete_task_menu(chat_id):
     # Создаем клавиатуру с задачами
     markup = types.InlineKeyboardMarkup(row_width=2)
 
-    for idx, task in assigned_tasks[:20]:  # Показываем первые 20
+    for task in assigned_tasks[:20]:  # Показываем первые 20
         city = task.get('Ответственный', 'Не указан')
         task_name_short = task['Задача'][:20] + ("..." if len(task['Задача']) > 20 else "")
         city_emoji = AVAILABLE_CITIES.get(city, '🏙️')
 
         markup.add(types.InlineKeyboardButton(
             f"{city_emoji} {task_name_short}",
-            callback_data=f'complete_task_{idx}'
+            callback_data=f"complete_task_{task['ID']}"
         ))
 
     markup.add(types.InlineKeyboardButton('🔙 Назад', callback_data='admin_city_tasks'))
@@ -3501,10 +5754,10 @@ def show_clear_responsible_menu(chat_id):
 
     # Фильтруем задачи с ответственным
     assigned_tasks = []
-    for idx, task in enumerate(tasks):
+    for task in tasks:
         responsible = str(task.get('Ответственный', '')).strip()
         if responsible and responsible.lower() not in ['', 'nan', 'none', 'nat']:
-            assigned_tasks.append((idx, task))
+            assigned_tasks.append(task)
 
     if not assigned_tasks:
         bot.send_message(
@@ -3521,14 +5774,14 @@ def show_clear_responsible_menu(chat_id):
     # Создаем клавиатуру с задачами
     markup = types.InlineKeyboardMarkup(row_width=2)
 
-    for idx, task in assigned_tasks[:20]:  # Показываем первые 20
+    for task in assigned_tasks[:20]:  # Показываем первые 20
         city = task.get('Ответственный', 'Не указан')
         task_name_short = task['Задача'][:20] + ("..." if len(task['Задача']) > 20 else "")
         city_emoji = AVAILABLE_CITIES.get(city, '🏙️')
 
         markup.add(types.InlineKeyboardButton(
             f"{city_emoji} {task_name_short}",
-            callback_data=f'clear_responsible_{idx}'
+            callback_data=f"clear_responsible_{task['ID']}"
         ))
 
     markup.add(types.InlineKeyboardButton('🔙 Назад', callback_data='admin_city_tasks'))
@@ -3559,6 +5812,12 @@ def main(message):
         show_city_selection(user_id, message.chat.id)
         return
 
+    # Пользователь снова пишет боту — возвращаем его в рассылки
+    if user['is_banned'] == USER_BLOCKED_BOT:
+        cursor.execute('UPDATE users SET is_banned = 0 WHERE user_id = ?', (user_id,))
+        conn.commit()
+        invalidate_screens(rating=True)
+
     markup = types.InlineKeyboardMarkup(row_width=2)
     buttons = [types.InlineKeyboardButton('👤 Личный кабинет', callback_data='personal_cabinet')]
 
@@ -3644,13 +5903,185 @@ def set_content_plan_command(message):
         reply_markup=markup
     )
 
+@bot.message_handler(commands=['metrics'])
+def metrics_command(message):
+    """Время обработки кнопок, очереди обновлений, кэши задач и экранов, очередь отправки"""
+    if not is_admin(message.from_user.id):
+        bot.reply_to(message, "⛔ Нет доступа")
+        return
+
+    response = "<b>⏱ Кнопки</b> (вызовов / ошибок / среднее / максимум, мс)\n"
+    metrics = get_callback_metrics()
+    for name, metric in list(metrics.items())[:25]:
+        response += (f"<code>{name}</code>: {metric['count']} / {metric['errors']} / "
+                     f"{metric['avg_ms']} / {metric['max_ms']}\n")
+    if not metrics:
+        response += "<i>Пока нет данных</i>\n"
+
+    cache_stats = get_tasks_cache_stats()
+    screen_stats, cached_users = get_screen_cache_stats()
+    outbound_stats = get_outbound_stats()
+    update_stats = get_update_stats()
+    activity_stats = get_activity_stats()
+    response += (
+        f"\n<b>📥 Обновления:</b> потоков {update_stats['workers']}, в очереди {update_stats['queued']} "
+        f"(макс. в потоке {update_stats['max_queue']}), обработано {update_stats['processed']}, "
+        f"ошибок {update_stats['errors']}, ожиданий при полной очереди {update_stats['backpressure']}\n"
+        f"Ожидание в очереди: {update_stats['avg_wait_ms']} / {update_stats['max_wait_ms']} мс, "
+        f"обработка: {update_stats['avg_work_ms']} / {update_stats['max_work_ms']} мс\n"
+        f"<b>👥 Активны:</b> за 15 мин {activity_stats['minutes_15']}, за час {activity_stats['hour']}, "
+        f"за сутки {activity_stats['day']} (ждут записи в базу: {activity_stats['pending']})\n"
+        f"\n<b>📋 Кэш задач:</b> попаданий {cache_stats['hits']}, "
+        f"промахов {cache_stats['misses']} ({cache_stats['hit_rate']}%)\n"
+        f"<b>🖼 Кэш экранов:</b> пользователей в кэше {cached_users}\n"
+    )
+    for screen, metric in screen_stats.items():
+        response += (f"<code>{screen}</code>: попаданий {metric['hits']}, промахов {metric['misses']} "
+                     f"({metric['hit_rate']}%), сборка {metric['avg_render_ms']} / {metric['max_render_ms']} мс\n")
+    response += (
+        f"<b>📨 Очередь отправки:</b> {outbound_stats['queued']} сообщений, "
+        f"рассылок в работе: {len(outbound_stats['jobs'])}"
+    )
+
+    bot.send_message(message.chat.id, response, parse_mode='HTML')
+
+@bot.message_handler(commands=['checkrating'])
+def check_rating_command(message):
+    """Сверить рейтинг муниципалитетов с таблицей пользователей и пересобрать при расхождениях"""
+    if not is_admin(message.from_user.id):
+        bot.reply_to(message, "⛔ Нет доступа")
+        return
+
+    mismatches = check_city_leaderboard()
+    if not mismatches:
+        bot.reply_to(message, "✅ Рейтинг муниципалитетов совпадает с данными пользователей")
+        return
+
+    with db_transaction() as conn:
+        rebuild_city_leaderboard(conn.cursor())
+        invalidate_screens(rating=True)
+
+    response = f"⚠️ <b>Расхождений: {len(mismatches)}</b> — рейтинг пересобран\n\n"
+    for city, stored, actual in mismatches[:20]:
+        response += f"{city}: было {stored}, стало {actual}\n"
+    bot.send_message(message.chat.id, response, parse_mode='HTML')
+
+@bot.message_handler(commands=['backfillachievements'])
+def backfill_achievements_command(message):
+    """Выдать автоматические достижения, положенные по текущим счётчикам"""
+    if not is_admin(message.from_user.id):
+        bot.reply_to(message, "⛔ Нет доступа")
+        return
+
+    granted = backfill_achievements()
+    if not granted:
+        bot.reply_to(message, "✅ Все положенные достижения уже выданы")
+        return
+
+    by_achievement = {}
+    for _, achievement_id in granted:
+        by_achievement[achievement_id] = by_achievement.get(achievement_id, 0) + 1
+
+    response = f"🏆 <b>Выдано достижений: {len(granted)}</b>\n\n"
+    for achievement_id, count in sorted(by_achievement.items(), key=lambda item: -item[1]):
+        response += f"{ACHIEVEMENT_EMOJIS.get(achievement_id, '🏆')} {achievement_id}: {count}\n"
+    response += "\n<i>Пользователи получат уведомления через очередь рассылки</i>"
+    bot.send_message(message.chat.id, response, parse_mode='HTML')
+
+@bot.message_handler(commands=['jobs'])
+def jobs_command(message):
+    """Фоновые задания: последний и следующий запуск, длительность, ошибки"""
+    if not is_admin(message.from_user.id):
+        bot.reply_to(message, "⛔ Нет доступа")
+        return
+
+    jobs = get_scheduler_stats()
+    if not jobs:
+        bot.reply_to(message, "📭 Фоновых заданий пока не было")
+        return
+
+    response = "<b>🗓 Фоновые задания</b>\n\n"
+    for job in jobs:
+        if job['running']:
+            status = "⏳ выполняется"
+        elif job['last_error']:
+            status = "❌ ошибка"
+        elif not job['active']:
+            status = "💤 не запланировано"
+        else:
+            status = "✅ работает"
+
+        response += f"<b>{job['title']}</b> (<code>{job['name']}</code>) — {status}\n"
+        if job['interval']:
+            response += f"Интервал: {job['interval'] // 60} мин\n"
+        response += f"Последний запуск: {job['last_run'] or '—'}"
+        if job['last_duration'] is not None:
+            response += f" ({job['last_duration']} с)"
+        response += f"\nСледующий запуск: {job['next_run'] or '—'}\n"
+        response += f"Запусков: {job['runs']}, ошибок: {job['errors']}"
+        if job['avg_ms'] is not None:
+            response += f", среднее {job['avg_ms']} мс, максимум {job['max_ms']} мс"
+        if job['overlaps']:
+            response += f", наложений: {job['overlaps']}"
+        response += "\n"
+        if job['last_error']:
+            error = job['last_error'][:200].replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+            response += f"<i>{error}</i>\n"
+        response += "\n"
+
+    bot.send_message(message.chat.id, response, parse_mode='HTML')
+
+@bot.message_handler(commands=['importtasks'])
+def import_tasks_command(message):
+    """Загрузить задачи из присланного Excel файла"""
+    if not is_admin(message.from_user.id):
+        bot.reply_to(message, "⛔ Нет доступа")
+        return
+
+    if TASKS_STORAGE != 'sqlite':
+        bot.reply_to(message, "ℹ️ Задачи хранятся в Excel файле — импорт не нужен")
+        return
+
+    msg = bot.reply_to(
+        message,
+        "📤 <b>Отправьте Excel файл с задачами</b>\n\n"
+        "Столбцы: Дата, Задача, Описание, Ответственный.\n"
+        "<i>Текущий список задач будет заменён содержимым файла.</i>",
+        parse_mode='HTML'
+    )
+    bot.register_next_step_handler(msg, process_tasks_import)
+
+def process_tasks_import(message):
+    """Обработка файла для импорта задач"""
+    if not message.document:
+        bot.send_message(message.chat.id, "❌ Нужен Excel файл (.xlsx)")
+        return
+
+    tmp_path = f"tasks_import_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx"
+    try:
+        file_info = bot.get_file(message.document.file_id)
+        with open(tmp_path, 'wb') as file:
+            file.write(bot.download_file(file_info.file_path))
+
+        count, error = import_tasks_from_excel(tmp_path)
+        if error:
+            bot.send_message(message.chat.id, f"❌ {error}")
+        else:
+            bot.send_message(message.chat.id, f"✅ Импортировано задач: {count}")
+
+    except Exception as e:
+        bot.send_message(message.chat.id, f"❌ Ошибка импорта: {str(e)}")
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
 @bot.message_handler(commands=['stats'])
 def stats_command(message):
     """Показать статистику"""
     if not is_admin(message.from_user.id):
         return
 
-    conn = get_db_connection()
+    conn = get_db_read_connection()
     cursor = conn.cursor()
 
     # Общая статистика
@@ -3685,15 +6116,9 @@ def stats_command(message):
 # ОБРАБОТЧИКИ ДЛЯ РУЧНОГО ВВОДА ID
 # ==============================
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith('manual_id_'))
-def handle_manual_id(call):
+@callback_route(prefix='manual_id_', admin=True)
+def handle_manual_id(call, action):
     """Обработчик ручного ввода ID пользователя"""
-    if not is_admin(call.from_user.id):
-        bot.answer_callback_query(call.id, "⛔ Нет доступа")
-        return
-
-    action = call.data.replace('manual_id_', '')
-
     msg = bot.send_message(
         call.message.chat.id,
         f"✏️ <b>Введите ID пользователя для {('начисления' if action == 'add' else 'снятия')} баллов:</b>\n\n"
@@ -3705,1173 +6130,1116 @@ def handle_manual_id(call):
     bot.delete_message(call.message.chat.id, call.message.message_id)
     bot.answer_callback_query(call.id)
 
-@bot.callback_query_handler(func=lambda call: True)
-def callback_handler(call):
+@callback_route(prefix='select_city_')
+def handle_select_city(call, city):
+    """Регистрация: выбор муниципалитета"""
     user_id = call.from_user.id
     chat_id = call.message.chat.id
-    is_admin_user = is_admin(user_id)
-
-    # Регистрация
-    if call.data.startswith('select_city_'):
-        city = call.data.replace('select_city_', '')
-        get_or_create_user(user_id, call.from_user.username, call.from_user.first_name,
-                           call.from_user.last_name, city)
-        bot.edit_message_text(f"✅ Вы выбрали: {AVAILABLE_CITIES.get(city, '🏙️')} {city}",
-                              chat_id, call.message.message_id)
-
-    elif call.data == 'change_city':
-        markup = types.InlineKeyboardMarkup(row_width=2)
-        for city, emoji in AVAILABLE_CITIES.items():
-            markup.add(types.InlineKeyboardButton(f"{emoji} {city}", callback_data=f'change_city_{city}'))
-        bot.edit_message_text("🏙️ <b>Выберите новый муниципалитет:</b>",
-                              chat_id, call.message.message_id,
-                              parse_mode='HTML', reply_markup=markup)
-
-    elif call.data.startswith('change_city_'):
-        city = call.data.replace('change_city_', '')
-        if update_user_city(user_id, city):
-            city_emoji = AVAILABLE_CITIES.get(city, '🏙️')
-            bot.edit_message_text(f"✅ Муниципалитет изменен на: {city_emoji} {city}",
-                                  chat_id, call.message.message_id)
-
-    # Пагинация муниципалитетов
-    elif call.data.startswith('city_page_'):
-        page = int(call.data.replace('city_page_', ''))
-        bot.delete_message(chat_id, call.message.message_id)
-        show_city_selection(user_id, chat_id, page)
-
-    # Личный кабинет
-    elif call.data == 'personal_cabinet':
-        show_personal_cabinet(user_id, chat_id)
-    elif call.data == 'user_history':
-        # Показываем историю пользователя
-        show_user_history(call.from_user.id, call.message.chat.id, call.message.message_id)
-    # Админ-панель
-    elif call.data == 'admin_panel':
-        if is_admin_user:
-            show_admin_panel(chat_id)
-        else:
-            bot.answer_callback_query(call.id, "⛔ Нет доступа")
-    elif call.data == 'admin_set_rules':
-        if not is_admin_user:
-            bot.answer_callback_query(call.id, "⛔ Нет доступа")
-            return
-
-        rules_text = get_rules()
-        bot.edit_message_text(
-            "<b>📋 Установка правил работы</b>\n\n"
-            "Используйте команду:\n"
-            "<code>/setrules [текст правил]</code>\n\n"
-            "<b>Пример:</b>\n"
-            "<code>/setrules 1. Соблюдать сроки\\n2. Проверять информацию</code>\n\n"
-            "Для переноса строк используйте \\n\n\n"
-            "<b>Текущие правила:</b>\n"
-            f"{rules_text[:200]}..." if len(rules_text) > 200 else rules_text,
-            chat_id,
-            call.message.message_id,
-            parse_mode='HTML',
-            reply_markup=types.InlineKeyboardMarkup().add(
-                types.InlineKeyboardButton('🔙 Назад', callback_data='admin_panel')
-            )
-        )
-    elif call.data == 'admin_achievements_stats':
-        if not is_admin(call.from_user.id):
-            bot.answer_callback_query(call.id, "⛔ Нет доступа")
-            return
-
-        conn = get_db_connection()
-        cursor = conn.cursor()
-
-        # Получаем всех пользователей с их достижениями
-        cursor.execute('''
-                SELECT u.user_id, u.first_name, u.city, 
-                       GROUP_CONCAT(ua.achievement_id) as achievements
-                FROM users u
-                LEFT JOIN user_achievements ua ON u.user_id = ua.user_id
-                GROUP BY u.user_id
-                ORDER BY u.first_name
-            ''')
-
-        users = cursor.fetchall()
-
-        response = "<b>📊 Общая статистика достижений</b>\n\n"
-
-        for user in users:
-            if not user['achievements']:
-                continue
+    get_or_create_user(user_id, call.from_user.username, call.from_user.first_name,
+                       call.from_user.last_name, city)
+    bot.edit_message_text(f"✅ Вы выбрали: {AVAILABLE_CITIES.get(city, '🏙️')} {city}",
+                          chat_id, call.message.message_id)
+
+@callback_route('change_city')
+def handle_change_city(call):
+    """Смена муниципалитета: список муниципалитетов"""
+    chat_id = call.message.chat.id
+    markup = types.InlineKeyboardMarkup(row_width=2)
+    for city, emoji in AVAILABLE_CITIES.items():
+        markup.add(types.InlineKeyboardButton(f"{emoji} {city}", callback_data=f'change_city_{city}'))
+    bot.edit_message_text("🏙️ <b>Выберите новый муниципалитет:</b>",
+                          chat_id, call.message.message_id,
+                          parse_mode='HTML', reply_markup=markup)
 
-            # Собираем эмодзи достижений
-            achievement_emojis = []
-            for ach_id in user['achievements'].split(','):
-                if ach_id and ach_id in ACHIEVEMENT_EMOJIS:
-                    achievement_emojis.append(ACHIEVEMENT_EMOJIS[ach_id])
+@callback_route(prefix='change_city_')
+def handle_change_city_selected(call, city):
+    """Смена муниципалитета: выбран новый муниципалитет"""
+    user_id = call.from_user.id
+    chat_id = call.message.chat.id
+    if update_user_city(user_id, city):
+        city_emoji = AVAILABLE_CITIES.get(city, '🏙️')
+        bot.edit_message_text(f"✅ Муниципалитет изменен на: {city_emoji} {city}",
+                              chat_id, call.message.message_id)
 
-            city_emoji = AVAILABLE_CITIES.get(user['city'], '🏙️')
-            response += f"{user['first_name']} | {city_emoji} {user['city']} | {' '.join(achievement_emojis)}\n"
+@callback_route(prefix='city_page_', parse=int)
+def handle_city_page(call, page):
+    """Пагинация муниципалитетов при регистрации"""
+    user_id = call.from_user.id
+    chat_id = call.message.chat.id
+    bot.delete_message(chat_id, call.message.message_id)
+    show_city_selection(user_id, chat_id, page)
 
-        if not response.endswith("\n\n"):
-            response += "\n\n"
+@callback_route('personal_cabinet')
+def handle_personal_cabinet(call):
+    """Личный кабинет"""
+    user_id = call.from_user.id
+    chat_id = call.message.chat.id
+    show_personal_cabinet(user_id, chat_id)
 
-        response += f"<i>Всего пользователей с достижениями: {len([u for u in users if u['achievements']])}</i>"
+@callback_route('user_history')
+def handle_user_history(call):
+    """История баллов пользователя"""
+    show_user_history(call.from_user.id, call.message.chat.id, call.message.message_id)
 
-        bot.edit_message_text(
-            response,
-            call.message.chat.id,
-            call.message.message_id,
-            parse_mode='HTML',
-            reply_markup=types.InlineKeyboardMarkup().add(
-                types.InlineKeyboardButton('🔙 Назад', callback_data='admin_achievements')
-            )
-        )
-    elif call.data == 'admin_change_city':
-        if not is_admin(call.from_user.id):
-            bot.answer_callback_query(call.id, "⛔ Нет доступа")
-            return
+@callback_route('admin_panel', admin=True)
+def handle_admin_panel(call):
+    """Админ-панель"""
+    show_admin_panel(call.message.chat.id)
 
-        msg = bot.send_message(
-            call.message.chat.id,
-            "🌐 <b>Изменение муниципалитета</b>\n\n"
-            "Введите ID пользователя и новый муниципалитет в формате:\n"
-            "<code>ID_пользователя : Муниципалитет</code>\n\n"
-            "<i>Пример: 123456 : Москва</i>",
-            parse_mode='HTML'
+@callback_route('admin_set_rules', admin=True)
+def handle_admin_set_rules(call):
+    """Админ: подсказка по установке правил"""
+    chat_id = call.message.chat.id
+    rules_text = get_rules()
+    bot.edit_message_text(
+        "<b>📋 Установка правил работы</b>\n\n"
+        "Используйте команду:\n"
+        "<code>/setrules [текст правил]</code>\n\n"
+        "<b>Пример:</b>\n"
+        "<code>/setrules 1. Соблюдать сроки\\n2. Проверять информацию</code>\n\n"
+        "Для переноса строк используйте \\n\n\n"
+        "<b>Текущие правила:</b>\n"
+        f"{rules_text[:200]}..." if len(rules_text) > 200 else rules_text,
+        chat_id,
+        call.message.message_id,
+        parse_mode='HTML',
+        reply_markup=types.InlineKeyboardMarkup().add(
+            types.InlineKeyboardButton('🔙 Назад', callback_data='admin_panel')
         )
+    )
 
-        def process_city_change(message):
-            try:
-                if ':' not in message.text:
-                    bot.send_message(message.chat.id, "❌ Неверный формат. Используйте: ID : Город")
-                    return
+@callback_route('admin_achievements_stats', admin=True)
+def handle_admin_achievements_stats(call):
+    """Админ: общая статистика достижений"""
+    conn = get_db_read_connection()
+    cursor = conn.cursor()
 
-                user_id_str, new_city = message.text.split(':', 1)
-                user_id = int(user_id_str.strip())
-                new_city = new_city.strip()
+    # Получаем всех пользователей с их достижениями
+    cursor.execute('''
+            SELECT u.user_id, u.first_name, u.city, 
+                   GROUP_CONCAT(ua.achievement_id) as achievements
+            FROM users u
+            LEFT JOIN user_achievements ua ON u.user_id = ua.user_id
+            GROUP BY u.user_id
+            ORDER BY u.first_name
+        ''')
 
-                if new_city not in AVAILABLE_CITIES:
-                    bot.send_message(message.chat.id, f"❌ Муниципалитет '{new_city}' не найден")
-                    return
+    users = cursor.fetchall()
 
-                # Меняем муниципалитет
-                conn = get_db_connection()
-                cursor = conn.cursor()
-                cursor.execute('UPDATE users SET city = ? WHERE user_id = ?', (new_city, user_id))
-                conn.commit()
+    response = "<b>📊 Общая статистика достижений</b>\n\n"
 
-                city_emoji = AVAILABLE_CITIES.get(new_city, '🏙️')
-                bot.send_message(
-                    message.chat.id,
-                    f"✅ Муниципалитет пользователя #{user_id} изменен на: {city_emoji} {new_city}"
-                )
+    for user in users:
+        if not user['achievements']:
+            continue
 
-                # Уведомляем пользователя
-                try:
-                    bot.send_message(
-                        user_id,
-                        f"🌐 <b>Ваш муниципалитет изменен!</b>\n\n"
-                        f"Администратор изменил ваш муниципалитет на: {city_emoji} {new_city}",
-                        parse_mode='HTML'
-                    )
-                except:
-                    pass
+        # Собираем эмодзи достижений
+        achievement_emojis = []
+        for ach_id in user['achievements'].split(','):
+            if ach_id and ach_id in ACHIEVEMENT_EMOJIS:
+                achievement_emojis.append(ACHIEVEMENT_EMOJIS[ach_id])
 
-                # Возвращаем в админ-панель
-                show_admin_panel(message.chat.id)
+        city_emoji = AVAILABLE_CITIES.get(user['city'], '🏙️')
+        response += f"{user['first_name']} | {city_emoji} {user['city']} | {' '.join(achievement_emojis)}\n"
 
-            except ValueError:
-                bot.send_message(message.chat.id, "❌ Ошибка: ID должен быть числом")
-            except Exception as e:
-                bot.send_message(message.chat.id, f"❌ Ошибка: {str(e)}")
+    if not response.endswith("\n\n"):
+        response += "\n\n"
 
-        bot.register_next_step_handler(msg, process_city_change)
-    elif call.data == 'admin_view_user_achievements':
-        if not is_admin(call.from_user.id):
-            bot.answer_callback_query(call.id, "⛔ Нет доступа")
-            return
+    response += f"<i>Всего пользователей с достижениями: {len([u for u in users if u['achievements']])}</i>"
 
-        # Запрашиваем ID пользователя
-        msg = bot.send_message(
-            call.message.chat.id,
-            "👤 <b>Введите ID пользователя для просмотра его достижений:</b>",
-            parse_mode='HTML'
+    bot.edit_message_text(
+        response,
+        call.message.chat.id,
+        call.message.message_id,
+        parse_mode='HTML',
+        reply_markup=types.InlineKeyboardMarkup().add(
+            types.InlineKeyboardButton('🔙 Назад', callback_data='admin_achievements')
         )
+    )
 
-        def process_user_id(message):
-            try:
-                target_user_id = int(message.text)
-                show_user_achievements(target_user_id, message.chat.id)
-            except ValueError:
-                bot.send_message(message.chat.id, "❌ Введите числовой ID пользователя")
-
-        bot.register_next_step_handler(msg, process_user_id)
-    elif call.data == 'admin_history_report':
-        if not is_admin(call.from_user.id):
-            bot.answer_callback_query(call.id, "⛔ Нет доступа")
-            return
-        ask_report_period(call.message.chat.id)
-    elif call.data == 'admin_set_content_plan':
-        if not is_admin_user:
-            bot.answer_callback_query(call.id, "⛔ Нет доступа")
-            return
+@callback_route('admin_change_city', admin=True)
+def handle_admin_change_city(call):
+    """Админ: изменение муниципалитета пользователя"""
+    msg = bot.send_message(
+        call.message.chat.id,
+        "🌐 <b>Изменение муниципалитета</b>\n\n"
+        "Введите ID пользователя и новый муниципалитет в формате:\n"
+        "<code>ID_пользователя : Муниципалитет</code>\n\n"
+        "<i>Пример: 123456 : Москва</i>",
+        parse_mode='HTML'
+    )
 
-        content_info = get_content_plan_info()
-        if content_info['file_id']:
-            status = "✅ Контент-план загружен"
-            preview = f"Подпись: {content_info['caption'][:50]}..."
-        else:
-            status = "❌ Контент-план не загружен"
-            preview = ""
+    def process_city_change(message):
+        try:
+            if ':' not in message.text:
+                bot.send_message(message.chat.id, "❌ Неверный формат. Используйте: ID : Город")
+                return
 
-        bot.edit_message_text(
-            f"<b>📅 Обновление контент-плана</b>\n\n"
-            f"{status}\n{preview}\n\n"
-            "Для обновления отправьте изображение с подписью командой:\n"
-            "<code>/setcontentplan</code>\n\n"
-            "Или просто отправьте новое изображение с подписью в этот чат.\n\n"
-            "<i>Бот сохранит изображение и будет показывать его пользователям.</i>",
-            chat_id,
-            call.message.message_id,
-            parse_mode='HTML',
-            reply_markup=types.InlineKeyboardMarkup().add(
-                types.InlineKeyboardButton('🔙 Назад', callback_data='admin_panel')
-            )
-        )
-    # Начисление/снятие баллов
-    elif call.data == 'admin_add_points_menu':
-        if not is_admin_user:
-            bot.answer_callback_query(call.id, "⛔ Нет доступа")
-            return
-        bot.delete_message(chat_id, call.message.message_id)
-        show_user_selection_for_points(chat_id, 'add')
+            user_id_str, new_city = message.text.split(':', 1)
+            user_id = int(user_id_str.strip())
+            new_city = new_city.strip()
 
-    elif call.data == 'admin_remove_points_menu':
-        if not is_admin_user:
-            bot.answer_callback_query(call.id, "⛔ Нет доступа")
-            return
-        bot.delete_message(chat_id, call.message.message_id)
-        show_user_selection_for_points(chat_id, 'remove')
+            if new_city not in AVAILABLE_CITIES:
+                bot.send_message(message.chat.id, f"❌ Муниципалитет '{new_city}' не найден")
+                return
 
-    elif call.data.startswith('select_user_add_') or call.data.startswith('select_user_remove_'):
-        if not is_admin_user:
-            bot.answer_callback_query(call.id, "⛔ Нет доступа")
-            return
-        parts = call.data.split('_')
-        action, target_user_id = parts[2], int(parts[3])
-        bot.delete_message(chat_id, call.message.message_id)
-        show_points_amount_selection(chat_id, target_user_id, action)
-
-    elif call.data.startswith('select_points_add_') or call.data.startswith('select_points_remove_'):
-        if not is_admin_user:
-            bot.answer_callback_query(call.id, "⛔ Нет доступа")
-            return
-        parts = call.data.split('_')
-        action, target_user_id, points = parts[2], int(parts[3]), int(parts[4])
-        bot.delete_message(chat_id, call.message.message_id)
-        ask_for_reason(chat_id, target_user_id, points, action)
-
-    elif call.data.startswith('custom_points_'):
-        if not is_admin_user:
-            bot.answer_callback_query(call.id, "⛔ Нет доступа")
-            return
-        parts = call.data.split('_')
-        action, target_user_id = parts[2], int(parts[3])
+            # Меняем муниципалитет
+            conn = get_db_connection()
+            cursor = conn.cursor()
+            cursor.execute('UPDATE users SET city = ? WHERE user_id = ?', (new_city, user_id))
+            conn.commit()
+            invalidate_screens([user_id], rating=True)
 
-        msg = bot.send_message(
-            chat_id,
-            f"✏️ <b>Введите количество баллов:</b>",
-            parse_mode='HTML'
-        )
+            city_emoji = AVAILABLE_CITIES.get(new_city, '🏙️')
+            bot.send_message(
+                message.chat.id,
+                f"✅ Муниципалитет пользователя #{user_id} изменен на: {city_emoji} {new_city}"
+            )
 
-        # Вспомогательная функция для обработки ввода
-        def process_custom_input(message):
+            # Уведомляем пользователя
             try:
-                points = int(message.text)
-                if points <= 0:
-                    bot.send_message(chat_id, "❌ Должно быть положительным числом")
-                    return
-                ask_for_reason(chat_id, target_user_id, points, action)
+                bot.send_message(
+                    user_id,
+                    f"🌐 <b>Ваш муниципалитет изменен!</b>\n\n"
+                    f"Администратор изменил ваш муниципалитет на: {city_emoji} {new_city}",
+                    parse_mode='HTML'
+                )
             except:
-                bot.send_message(chat_id, "❌ Введите число")
-
-        bot.register_next_step_handler(msg, process_custom_input)
-
-    # Достижения
-    elif call.data == 'admin_achievements':
-        if not is_admin(call.from_user.id):
-            bot.answer_callback_query(call.id, "⛔ Нет доступа")
-            return
-        bot.delete_message(call.message.chat.id, call.message.message_id)
-        show_achievements_admin_panel(call.message.chat.id)
-
-    elif call.data == 'admin_add_task':
-        if not is_admin(call.from_user.id):
-            bot.answer_callback_query(call.id, "⛔ Нет доступа")
-            return
-        bot.delete_message(call.message.chat.id, call.message.message_id)
-        show_users_for_achievement(call.message.chat.id, 'add_task')
-
-    elif call.data == 'admin_add_idea':
-        if not is_admin(call.from_user.id):
-            bot.answer_callback_query(call.id, "⛔ Нет доступа")
-            return
-        bot.delete_message(call.message.chat.id, call.message.message_id)
-        show_users_for_achievement(call.message.chat.id, 'add_idea')
-
-    elif call.data.startswith('achievement_user_add_task_'):
-        if not is_admin_user:
-            bot.answer_callback_query(call.id, "⛔ Нет доступа")
-            return
+                pass
 
-        # Формат: achievement_user_add_task_123456
-        try:
-            target_user_id = int(call.data.split('_')[-1])
-            update_user_counter(target_user_id, 'completed_tasks', 1)
-            bot.answer_callback_query(call.id, "✅ Добавлено ТЗ")
+            # Возвращаем в админ-панель
+            show_admin_panel(message.chat.id)
 
-            # Обновляем сообщение или показываем результат
-            user = get_user_info(target_user_id)
-            if user:
-                counters = get_user_counters(target_user_id)
-                new_value = counters.get('completed_tasks', 0)
-
-                bot.edit_message_text(
-                    f"✅ <b>Добавлено ТЗ</b>\n\n"
-                    f"Пользователь: {user['first_name']}\n"
-                    f"Выполнено ТЗ: {new_value}\n\n"
-                    f"<i>Пользователь получил уведомление о достижении (если разблокировано)</i>",
-                    chat_id,
-                    call.message.message_id,
-                    parse_mode='HTML',
-                    reply_markup=types.InlineKeyboardMarkup().add(
-                        types.InlineKeyboardButton('🔙 Назад', callback_data='admin_achievements')
-                    )
-                )
+        except ValueError:
+            bot.send_message(message.chat.id, "❌ Ошибка: ID должен быть числом")
         except Exception as e:
-            bot.answer_callback_query(call.id, f"❌ Ошибка: {str(e)}")
-
-    elif call.data.startswith('achievement_user_add_idea_'):
-        if not is_admin_user:
-            bot.answer_callback_query(call.id, "⛔ Нет доступа")
-            return
+            bot.send_message(message.chat.id, f"❌ Ошибка: {str(e)}")
 
-        # Формат: achievement_user_add_idea_123456
-        try:
-            target_user_id = int(call.data.split('_')[-1])
-            update_user_counter(target_user_id, 'content_ideas', 1)
-            bot.answer_callback_query(call.id, "✅ Добавлена идея")
+    bot.register_next_step_handler(msg, process_city_change)
 
-            user = get_user_info(target_user_id)
-            if user:
-                counters = get_user_counters(target_user_id)
-                new_value = counters.get('content_ideas', 0)
-
-                bot.edit_message_text(
-                    f"✅ <b>Добавлена идея</b>\n\n"
-                    f"Пользователь: {user['first_name']}\n"
-                    f"Идей предложено: {new_value}\n\n"
-                    f"<i>Пользователь получил уведомление о достижении (если разблокировано)</i>",
-                    chat_id,
-                    call.message.message_id,
-                    parse_mode='HTML',
-                    reply_markup=types.InlineKeyboardMarkup().add(
-                        types.InlineKeyboardButton('🔙 Назад', callback_data='admin_achievements')
-                    )
-                )
-        except Exception as e:
-            bot.answer_callback_query(call.id, f"❌ Ошибка: {str(e)}")
-
-    elif call.data.startswith('achievement_user_add_meeting_'):
-        if not is_admin_user:
-            bot.answer_callback_query(call.id, "⛔ Нет доступа")
-            return
+@callback_route('admin_view_user_achievements', admin=True)
+def handle_admin_view_user_achievements(call):
+    """Админ: просмотр достижений пользователя"""
+    # Запрашиваем ID пользователя
+    msg = bot.send_message(
+        call.message.chat.id,
+        "👤 <b>Введите ID пользователя для просмотра его достижений:</b>",
+        parse_mode='HTML'
+    )
 
-        # Формат: achievement_user_add_meeting_123456
-        # Для планёрок нужен дополнительный ввод данных
+    def process_user_id(message):
         try:
-            target_user_id = int(call.data.split('_')[-1])
-            user = get_user_info(target_user_id)
-
-            if user:
-                # Запрашиваем тему планёрки
-                msg = bot.send_message(
-                    chat_id,
-                    f"📋 <b>Добавление планёрки</b>\n\n"
-                    f"Пользователь: {user['first_name']}\n"
-                    f"Введите дату планёрки:",
-                    parse_mode='HTML'
-                )
-                bot.register_next_step_handler(msg, process_meeting_topic, target_user_id, chat_id)
-
-                # Удаляем предыдущее сообщение
-                bot.delete_message(chat_id, call.message.message_id)
-        except Exception as e:
-            bot.answer_callback_query(call.id, f"❌ Ошибка: {str(e)}")
-
-    elif call.data == 'show_all_achievements':
-        show_user_achievements(call.from_user.id, call.message.chat.id, call.message.message_id)
-
-    elif call.data == 'admin_give_achievement':
-        if not is_admin(call.from_user.id):
-            bot.answer_callback_query(call.id, "⛔ Нет доступа")
-            return
-        bot.delete_message(call.message.chat.id, call.message.message_id)
-        show_custom_achievement_selection(call.message.chat.id)
-
-    elif call.data == 'admin_add_meeting':
-        if not is_admin(call.from_user.id):
-            bot.answer_callback_query(call.id, "⛔ Нет доступа")
-            return
-        bot.delete_message(call.message.chat.id, call.message.message_id)
-        show_meeting_addition_panel(call.message.chat.id)
-
-    elif call.data == 'admin_meetings_stats':
-        if not is_admin(call.from_user.id):
-            bot.answer_callback_query(call.id, "⛔ Нет доступа")
-            return
+            target_user_id = int(message.text)
+            show_user_achievements(target_user_id, message.chat.id)
+        except ValueError:
+            bot.send_message(message.chat.id, "❌ Введите числовой ID пользователя")
 
-        stats = get_meetings_statistics()
+    bot.register_next_step_handler(msg, process_user_id)
 
-        response = f"<b>📊 Статистика планёрок</b>\n\n"
-        response += f"<b>Всего проведено планёрок:</b> {stats['total_meetings']}\n"
-        response += f"<b>Уникальных участников:</b> {stats['unique_participants']}\n\n"
+@callback_route('admin_history_report', admin=True)
+def handle_admin_history_report(call):
+    """Админ: отчёт по истории баллов"""
+    ask_report_period(call.message.chat.id)
 
-        response += "<b>🏆 Топ участников планёрок:</b>\n"
-        for i, participant in enumerate(stats['top_participants'], 1):
-            city_emoji = AVAILABLE_CITIES.get(participant['city'], '🏙️')
-            response += f"{i}. {participant['first_name']} ({city_emoji} {participant['city']}): {participant['meetings_count']} планёрок\n"
+@callback_route('admin_set_content_plan', admin=True)
+def handle_admin_set_content_plan(call):
+    """Админ: обновление контент-плана"""
+    chat_id = call.message.chat.id
+    content_info = get_content_plan_info()
+    if content_info['file_id']:
+        status = "✅ Контент-план загружен"
+        preview = f"Подпись: {content_info['caption'][:50]}..."
+    else:
+        status = "❌ Контент-план не загружен"
+        preview = ""
 
-        bot.edit_message_text(
-            response,
-            call.message.chat.id,
-            call.message.message_id,
-            parse_mode='HTML',
-            reply_markup=types.InlineKeyboardMarkup().add(
-                types.InlineKeyboardButton('🔙 Назад', callback_data='admin_achievements')
-            )
+    bot.edit_message_text(
+        f"<b>📅 Обновление контент-плана</b>\n\n"
+        f"{status}\n{preview}\n\n"
+        "Для обновления отправьте изображение с подписью командой:\n"
+        "<code>/setcontentplan</code>\n\n"
+        "Или просто отправьте новое изображение с подписью в этот чат.\n\n"
+        "<i>Бот сохранит изображение и будет показывать его пользователям.</i>",
+        chat_id,
+        call.message.message_id,
+        parse_mode='HTML',
+        reply_markup=types.InlineKeyboardMarkup().add(
+            types.InlineKeyboardButton('🔙 Назад', callback_data='admin_panel')
         )
+    )
 
-    elif call.data.startswith('give_achievement_'):
-        if not is_admin(call.from_user.id):
-            bot.answer_callback_query(call.id, "⛔ Нет доступа")
-            return
-
-        achievement_id = call.data.replace('give_achievement_', '')
-
-        # Сохраняем выбранное достижение в кэше
-        cache_key = f"give_achievement_{call.from_user.id}"
-        broadcast_cache[cache_key] = achievement_id
-
-        # Теперь выбираем пользователя
-        bot.delete_message(call.message.chat.id, call.message.message_id)
-        show_users_for_achievement(call.message.chat.id, 'give_manual_achievement')
-
-    elif call.data.startswith('achievement_user_give_manual_achievement'):
-        if not is_admin(call.from_user.id):
-            bot.answer_callback_query(call.id, "⛔ Нет доступа")
-            return
+@callback_route('admin_add_points_menu', admin=True)
+def handle_admin_add_points_menu(call):
+    """Админ: начисление баллов"""
+    chat_id = call.message.chat.id
+    bot.delete_message(chat_id, call.message.message_id)
+    show_user_selection_for_points(chat_id, 'add')
 
-        # Формат: achievement_user_give_manual_achievement_123456
-        try:
-            # Берём всё после последнего подчёркивания
-            target_user_id = int(call.data.rsplit('_', 1)[-1])
-            # Получаем achievement_id из кэша
-            cache_key = f"give_achievement_{call.from_user.id}"
-            if cache_key in broadcast_cache:
-                achievement_id = broadcast_cache[cache_key]
-                # Запрашиваем причину выдачи
-                msg = bot.send_message(
-                    call.message.chat.id,
-                    f"📝 <b>Выдача достижения</b>\n\n"
-                    f"<b>Достижение:</b> {get_achievement_emoji(achievement_id)} {achievement_id}\n"
-                    f"<b>Получатель ID:</b> {target_user_id}\n\n"
-                    f"Введите причину выдачи (или '-' чтобы пропустить):",
-                    parse_mode='HTML'
-                )
-                bot.register_next_step_handler(msg, process_manual_achievement_reason,
-                                               target_user_id, achievement_id, call.message.chat.id)
-                del broadcast_cache[cache_key]
-            else:
-                bot.answer_callback_query(call.id, "❌ Ошибка: достижение не выбрано")
+@callback_route('admin_remove_points_menu', admin=True)
+def handle_admin_remove_points_menu(call):
+    """Админ: снятие баллов"""
+    chat_id = call.message.chat.id
+    bot.delete_message(chat_id, call.message.message_id)
+    show_user_selection_for_points(chat_id, 'remove')
 
-        except ValueError as e:
-            bot.answer_callback_query(call.id, f"❌ Ошибка формата: {e}")
+@callback_route(prefix='select_user_', parse=split_args(str, int), admin=True)
+def handle_select_user(call, action, target_user_id):
+    """Админ: выбран пользователь для начисления/снятия баллов"""
+    chat_id = call.message.chat.id
+    bot.delete_message(chat_id, call.message.message_id)
+    show_points_amount_selection(chat_id, target_user_id, action)
 
-    elif call.data == 'admin_remove_achievement':
-        if not is_admin(call.from_user.id):
-            bot.answer_callback_query(call.id, "⛔ Нет доступа")
-            return
-        bot.delete_message(call.message.chat.id, call.message.message_id)
-        show_remove_achievement_selection(call.message.chat.id)
+@callback_route(prefix='select_points_', parse=split_args(str, int, int), admin=True)
+def handle_select_points(call, action, target_user_id, points):
+    """Админ: выбрано количество баллов"""
+    chat_id = call.message.chat.id
+    bot.delete_message(chat_id, call.message.message_id)
+    ask_for_reason(chat_id, target_user_id, points, action)
 
-    elif call.data.startswith('remove_achievement_'):
-        if not is_admin(call.from_user.id):
-            bot.answer_callback_query(call.id, "⛔ Нет доступа")
-            return
+@callback_route(prefix='custom_points_', parse=split_args(str, int), admin=True)
+def handle_custom_points(call, action, target_user_id):
+    """Админ: своё количество баллов"""
+    chat_id = call.message.chat.id
 
-        achievement_id = call.data.replace('remove_achievement_', '')
+    msg = bot.send_message(
+        chat_id,
+        f"✏️ <b>Введите количество баллов:</b>",
+        parse_mode='HTML'
+    )
 
-        # Сохраняем в кэше
-        cache_key = f"remove_achievement_{call.from_user.id}"
-        broadcast_cache[cache_key] = achievement_id
+    # Вспомогательная функция для обработки ввода
+    def process_custom_input(message):
+        try:
+            points = int(message.text)
+            if points <= 0:
+                bot.send_message(chat_id, "❌ Должно быть положительным числом")
+                return
+            ask_for_reason(chat_id, target_user_id, points, action)
+        except:
+            bot.send_message(chat_id, "❌ Введите число")
 
-        # Выбираем пользователя
-        bot.delete_message(call.message.chat.id, call.message.message_id)
-        show_users_for_achievement(call.message.chat.id, 'remove_achievement')
+    bot.register_next_step_handler(msg, process_custom_input)
 
-    elif call.data.startswith('achievement_user_remove_achievement_'):
-        if not is_admin(call.from_user.id):
-            bot.answer_callback_query(call.id, "⛔ Нет доступа")
-            return
+@callback_route('admin_achievements', admin=True)
+def handle_admin_achievements(call):
+    """Админ: панель достижений"""
+    bot.delete_message(call.message.chat.id, call.message.message_id)
+    show_achievements_admin_panel(call.message.chat.id)
 
-        try:
-            target_user_id = int(call.data.rsplit('_', 1)[-1])
-
-            # Получаем achievement_id из кэша
-            cache_key = f"remove_achievement_{call.from_user.id}"
-            if cache_key in broadcast_cache:
-                achievement_id = broadcast_cache[cache_key]
-
-                # Запрашиваем причину
-                msg = bot.send_message(
-                    call.message.chat.id,
-                    f"🗑️ <b>Снятие достижения</b>\n\n"
-                    f"<b>Достижение:</b> {get_achievement_emoji(achievement_id)} {achievement_id}\n"
-                    f"<b>Пользователь ID:</b> {target_user_id}\n\n"
-                    f"Введите причину снятия (или '-' чтобы пропустить):",
-                    parse_mode='HTML'
-                )
-                bot.register_next_step_handler(msg, process_remove_achievement_reason,
-                                               target_user_id, achievement_id, call.message.chat.id)
+@callback_route('admin_add_task', admin=True)
+def handle_admin_add_task(call):
+    """Админ: добавить выполненное ТЗ"""
+    bot.delete_message(call.message.chat.id, call.message.message_id)
+    show_users_for_achievement(call.message.chat.id, 'add_task')
 
-                del broadcast_cache[cache_key]
-            else:
-                bot.answer_callback_query(call.id, "❌ Ошибка: достижение не выбрано")
-        except ValueError as e:
-            bot.answer_callback_query(call.id, f"❌ Ошибка формата: {e}")
-
-    #рейтинг
-    elif call.data == 'city_rating':
-        show_city_rating(call.message.chat.id, call.message.message_id)
-    elif call.data == 'admin_city_stats':
-        if not is_admin(call.from_user.id):
-            bot.answer_callback_query(call.id, "⛔ Нет доступа")
-            return
-        show_city_stats_for_admin(call.message.chat.id)
-    # Правила и контент-план
-    elif call.data == 'show_rules':
-        rules_text = get_rules()
-        bot.edit_message_text(
-            rules_text,
-            chat_id,
-            call.message.message_id,
-            parse_mode='HTML',
-            reply_markup=types.InlineKeyboardMarkup().add(
-                types.InlineKeyboardButton('🔙 Назад', callback_data='personal_cabinet')
-            )
-        )
+@callback_route('admin_add_idea', admin=True)
+def handle_admin_add_idea(call):
+    """Админ: добавить идею"""
+    bot.delete_message(call.message.chat.id, call.message.message_id)
+    show_users_for_achievement(call.message.chat.id, 'add_idea')
 
-    elif call.data == 'show_content_plan':
-        content_plan_info = get_content_plan_info()
+@callback_route(prefix='achievement_user_add_task_', parse=int, admin=True)
+def handle_achievement_user_add_task(call, target_user_id):
+    """Админ: +1 выполненное ТЗ пользователю"""
+    chat_id = call.message.chat.id
+    try:
+        update_user_counter(target_user_id, 'completed_tasks', 1)
+        bot.answer_callback_query(call.id, "✅ Добавлено ТЗ")
 
-        if content_plan_info['file_id']:
-            # Отправляем изображение с подписью
-            bot.send_photo(
-                chat_id,
-                content_plan_info['file_id'],
-                caption=content_plan_info['caption'],
-                parse_mode='HTML'
-            )
+        # Обновляем сообщение или показываем результат
+        user = get_user_info(target_user_id)
+        if user:
+            counters = get_user_counters(target_user_id)
+            new_value = counters.get('completed_tasks', 0)
 
-            # Показываем кнопку "Назад" в отдельном сообщении
-            bot.send_message(
+            bot.edit_message_text(
+                f"✅ <b>Добавлено ТЗ</b>\n\n"
+                f"Пользователь: {user['first_name']}\n"
+                f"Выполнено ТЗ: {new_value}\n\n"
+                f"<i>Пользователь получил уведомление о достижении (если разблокировано)</i>",
                 chat_id,
-                "⬇️ <b>Контент-план выше</b>",
+                call.message.message_id,
                 parse_mode='HTML',
                 reply_markup=types.InlineKeyboardMarkup().add(
-                    types.InlineKeyboardButton('🔙 Назад', callback_data='personal_cabinet')
+                    types.InlineKeyboardButton('🔙 Назад', callback_data='admin_achievements')
                 )
             )
+    except Exception as e:
+        bot.answer_callback_query(call.id, f"❌ Ошибка: {str(e)}")
+
+@callback_route(prefix='achievement_user_add_idea_', parse=int, admin=True)
+def handle_achievement_user_add_idea(call, target_user_id):
+    """Админ: +1 идея пользователю"""
+    chat_id = call.message.chat.id
+    try:
+        update_user_counter(target_user_id, 'content_ideas', 1)
+        bot.answer_callback_query(call.id, "✅ Добавлена идея")
+
+        user = get_user_info(target_user_id)
+        if user:
+            counters = get_user_counters(target_user_id)
+            new_value = counters.get('content_ideas', 0)
 
-            # Удаляем предыдущее сообщение с личным кабинетом
-            bot.delete_message(chat_id, call.message.message_id)
-        else:
             bot.edit_message_text(
-                "📅 <b>Контент-план</b>\n\n"
-                "Контент-план ещё не загружен администратором.",
+                f"✅ <b>Добавлена идея</b>\n\n"
+                f"Пользователь: {user['first_name']}\n"
+                f"Идей предложено: {new_value}\n\n"
+                f"<i>Пользователь получил уведомление о достижении (если разблокировано)</i>",
                 chat_id,
                 call.message.message_id,
                 parse_mode='HTML',
                 reply_markup=types.InlineKeyboardMarkup().add(
-                    types.InlineKeyboardButton('🔙 Назад', callback_data='personal_cabinet')
+                    types.InlineKeyboardButton('🔙 Назад', callback_data='admin_achievements')
                 )
             )
+    except Exception as e:
+        bot.answer_callback_query(call.id, f"❌ Ошибка: {str(e)}")
 
-    # Мои задачи (по муниципалитету)
-    elif call.data == 'my_city_tasks':
-        show_user_tasks_by_city(call.from_user.id, call.message.chat.id, message_id=call.message.message_id)
+@callback_route(prefix=('achievement_user_add_meeting_', 'achievement_user_add_meeting_detail_'), parse=int, admin=True)
+def handle_achievement_user_add_meeting(call, target_user_id):
+    """Админ: добавить пользователю планёрку"""
+    chat_id = call.message.chat.id
+    # Для планёрок нужен дополнительный ввод данных
+    try:
+        user = get_user_info(target_user_id)
 
-        # Список всех задач
-    elif call.data == 'all_tasks_list':
-        show_all_tasks(call.message.chat.id, message_id=call.message.message_id)
+        if user:
+            # Запрашиваем тему планёрки
+            msg = bot.send_message(
+                chat_id,
+                f"📋 <b>Добавление планёрки</b>\n\n"
+                f"Пользователь: {user['first_name']}\n"
+                f"Введите дату планёрки:",
+                parse_mode='HTML'
+            )
+            bot.register_next_step_handler(msg, process_meeting_topic, target_user_id, chat_id)
 
-        # Пагинация для моих задач (по муниципалитету)
-    elif call.data.startswith('city_tasks_page_'):
-        try:
-            page = int(call.data.replace('city_tasks_page_', ''))
-            show_user_tasks_by_city(call.from_user.id, call.message.chat.id, page, call.message.message_id)
-        except ValueError:
-            bot.answer_callback_query(call.id, "❌ Ошибка пагинации")
+            # Удаляем предыдущее сообщение
+            bot.delete_message(chat_id, call.message.message_id)
+    except Exception as e:
+        bot.answer_callback_query(call.id, f"❌ Ошибка: {str(e)}")
 
-        # Пагинация для всех задач
-    elif call.data.startswith('all_tasks_page_'):
-        try:
-            page = int(call.data.replace('all_tasks_page_', ''))
-            show_all_tasks(call.message.chat.id, page, call.message.message_id)
-        except ValueError:
-            bot.answer_callback_query(call.id, "❌ Ошибка пагинации")
+@callback_route('show_all_achievements')
+def handle_show_all_achievements(call):
+    """Все достижения пользователя"""
+    show_user_achievements(call.from_user.id, call.message.chat.id, call.message.message_id)
 
-        # Детальный просмотр задачи из моего муниципалитета
-    elif call.data.startswith('show_city_task_detail_'):
-        try:
-            # Формат: show_city_task_detail_индекс_страница
-            parts = call.data.replace('show_city_task_detail_', '').split('_')
-            task_index = int(parts[0])  # Это уже индекс в отфильтрованном списке
-            page_context = int(parts[1]) if len(parts) > 1 else 0
+@callback_route('admin_give_achievement', admin=True)
+def handle_admin_give_achievement(call):
+    """Админ: выдача достижения"""
+    bot.delete_message(call.message.chat.id, call.message.message_id)
+    show_custom_achievement_selection(call.message.chat.id)
 
-            show_task_detail_by_city(
-                call.from_user.id,
-                call.message.chat.id,
-                task_index,  # ← Правильный индекс
-                page_context,
-                call.message.message_id
-            )
-        except ValueError:
-            bot.answer_callback_query(call.id, "❌ Ошибка загрузки задачи")
+@callback_route('admin_add_meeting', admin=True)
+def handle_admin_add_meeting(call):
+    """Админ: добавление планёрки"""
+    bot.delete_message(call.message.chat.id, call.message.message_id)
+    show_meeting_addition_panel(call.message.chat.id)
 
-        # Детальный просмотр задачи из общего списка
-    elif call.data.startswith('show_all_task_detail_'):
-        try:
-            task_index = int(call.data.replace('show_all_task_detail_', ''))
+@callback_route('admin_add_meeting_group', admin=True)
+def handle_admin_add_meeting_group(call):
+    """Админ: планёрка для нескольких участников"""
+    bot.delete_message(call.message.chat.id, call.message.message_id)
+    ask_meeting_participants(call.message.chat.id)
+
+@callback_route('admin_meetings_stats', admin=True)
+def handle_admin_meetings_stats(call):
+    """Админ: статистика планёрок"""
+    stats = get_meetings_statistics()
+
+    response = f"<b>📊 Статистика планёрок</b>\n\n"
+    response += f"<b>Всего проведено планёрок:</b> {stats['total_meetings']}\n"
+    response += f"<b>Уникальных участников:</b> {stats['unique_participants']}\n\n"
+
+    response += "<b>🏆 Топ участников планёрок:</b>\n"
+    for i, participant in enumerate(stats['top_participants'], 1):
+        city_emoji = AVAILABLE_CITIES.get(participant['city'], '🏙️')
+        response += f"{i}. {participant['first_name']} ({city_emoji} {participant['city']}): {participant['meetings_count']} планёрок\n"
+
+    bot.edit_message_text(
+        response,
+        call.message.chat.id,
+        call.message.message_id,
+        parse_mode='HTML',
+        reply_markup=types.InlineKeyboardMarkup().add(
+            types.InlineKeyboardButton('🔙 Назад', callback_data='admin_achievements')
+        )
+    )
 
-            # Определяем страницу, на которой была задача
-            page_context = task_index // TASKS_PER_PAGE
+@callback_route(prefix='give_achievement_', admin=True)
+def handle_give_achievement(call, achievement_id):
+    """Админ: выбрано достижение для выдачи"""
+    # Сохраняем выбранное достижение в кэше
+    cache_key = f"give_achievement_{call.from_user.id}"
+    broadcast_cache[cache_key] = achievement_id
 
-            show_task_detail_all(
+    # Теперь выбираем пользователя
+    bot.delete_message(call.message.chat.id, call.message.message_id)
+    show_users_for_achievement(call.message.chat.id, 'give_manual_achievement')
+
+@callback_route(prefix='achievement_user_give_manual_achievement_', parse=int, admin=True)
+def handle_achievement_user_give_manual_achievement(call, target_user_id):
+    """Админ: выбран получатель достижения"""
+    try:
+        # Получаем achievement_id из кэша
+        cache_key = f"give_achievement_{call.from_user.id}"
+        if cache_key in broadcast_cache:
+            achievement_id = broadcast_cache[cache_key]
+            # Запрашиваем причину выдачи
+            msg = bot.send_message(
                 call.message.chat.id,
-                task_index,
-                page_context,
-                call.message.message_id
+                f"📝 <b>Выдача достижения</b>\n\n"
+                f"<b>Достижение:</b> {get_achievement_emoji(achievement_id)} {achievement_id}\n"
+                f"<b>Получатель ID:</b> {target_user_id}\n\n"
+                f"Введите причину выдачи (или '-' чтобы пропустить):",
+                parse_mode='HTML'
             )
-        except ValueError:
-            bot.answer_callback_query(call.id, "❌ Ошибка загрузки задачи")
-    # Панель управления задачами
-    elif call.data == 'admin_city_tasks':
-        if not is_admin(call.from_user.id):
-            bot.answer_callback_query(call.id, "⛔ Нет доступа")
-            return
-        show_city_admin_tasks(call.message.chat.id, call.message.message_id)  # ← функция обновлена
+            bot.register_next_step_handler(msg, process_manual_achievement_reason,
+                                           target_user_id, achievement_id, call.message.chat.id)
+            del broadcast_cache[cache_key]
+        else:
+            bot.answer_callback_query(call.id, "❌ Ошибка: достижение не выбрано")
 
-    # Добавить задачу
-    elif call.data == 'admin_add_task_city':
-        if not is_admin(call.from_user.id):
-            bot.answer_callback_query(call.id, "⛔ Нет доступа")
-            return
-        start_add_city_task_dialog(call.message.chat.id)
+    except ValueError as e:
+        bot.answer_callback_query(call.id, f"❌ Ошибка формата: {e}")
 
-    elif call.data.startswith('raspush_my_tasks_'):
-        """Показать активные задачи распуша в разделе Мои задачи"""
-        user_id = call.from_user.id
-        user = get_user_info(user_id)
+@callback_route('admin_remove_achievement', admin=True)
+def handle_admin_remove_achievement(call):
+    """Админ: снятие достижения"""
+    bot.delete_message(call.message.chat.id, call.message.message_id)
+    show_remove_achievement_selection(call.message.chat.id)
 
-        if not user or user['city'] == 'Не указан':
-            bot.answer_callback_query(call.id, "❌ Сначала выберите муниципалитет")
-            return
+@callback_route(prefix='remove_achievement_', admin=True)
+def handle_remove_achievement(call, achievement_id):
+    """Админ: выбрано достижение для снятия"""
+    # Сохраняем в кэше
+    cache_key = f"remove_achievement_{call.from_user.id}"
+    broadcast_cache[cache_key] = achievement_id
 
-        conn = get_db_connection()
-        cursor = conn.cursor()
-
-        # Получаем активные задачи распуша
-        cursor.execute('''
-            SELECT id, task_name, task_description, expires_at
-            FROM raspush_tasks 
-            WHERE expires_at > datetime('now')
-            ORDER BY created_at DESC
-        ''')
+    # Выбираем пользователя
+    bot.delete_message(call.message.chat.id, call.message.message_id)
+    show_users_for_achievement(call.message.chat.id, 'remove_achievement')
 
-        tasks = cursor.fetchall()
+@callback_route(prefix='achievement_user_remove_achievement_', parse=int, admin=True)
+def handle_achievement_user_remove_achievement(call, target_user_id):
+    """Админ: выбран пользователь для снятия достижения"""
+    try:
+        # Получаем achievement_id из кэша
+        cache_key = f"remove_achievement_{call.from_user.id}"
+        if cache_key in broadcast_cache:
+            achievement_id = broadcast_cache[cache_key]
 
-        if not tasks:
-            bot.edit_message_text(
-                "📭 <b>Активных задач РАСПУШ нет</b>",
+            # Запрашиваем причину
+            msg = bot.send_message(
                 call.message.chat.id,
-                call.message.message_id,
-                parse_mode='HTML',
-                reply_markup=types.InlineKeyboardMarkup().add(
-                    types.InlineKeyboardButton('🔙 Назад', callback_data='my_city_tasks')
-                )
+                f"🗑️ <b>Снятие достижения</b>\n\n"
+                f"<b>Достижение:</b> {get_achievement_emoji(achievement_id)} {achievement_id}\n"
+                f"<b>Пользователь ID:</b> {target_user_id}\n\n"
+                f"Введите причину снятия (или '-' чтобы пропустить):",
+                parse_mode='HTML'
             )
-            return
+            bot.register_next_step_handler(msg, process_remove_achievement_reason,
+                                           target_user_id, achievement_id, call.message.chat.id)
 
-        markup = types.InlineKeyboardMarkup()
-        for task in tasks[:5]:  # Показываем 5 последних
-            # Проверяем, выполнял ли уже этот муниципалитет
-            cursor.execute('''
-                SELECT 1 FROM raspush_completions 
-                WHERE task_id = ? AND city = ?
-            ''', (task['id'], user['city']))
+            del broadcast_cache[cache_key]
+        else:
+            bot.answer_callback_query(call.id, "❌ Ошибка: достижение не выбрано")
+    except ValueError as e:
+        bot.answer_callback_query(call.id, f"❌ Ошибка формата: {e}")
+
+@callback_route('city_rating')
+def handle_city_rating(call):
+    """Рейтинг муниципалитетов"""
+    show_city_rating(call.message.chat.id, call.message.message_id)
+
+@callback_route('admin_city_stats', admin=True)
+def handle_admin_city_stats(call):
+    """Админ: статистика по муниципалитетам"""
+    show_city_stats_for_admin(call.message.chat.id)
+
+@callback_route('show_rules')
+def handle_show_rules(call):
+    """Правила работы"""
+    chat_id = call.message.chat.id
+    rules_text = get_rules()
+    bot.edit_message_text(
+        rules_text,
+        chat_id,
+        call.message.message_id,
+        parse_mode='HTML',
+        reply_markup=types.InlineKeyboardMarkup().add(
+            types.InlineKeyboardButton('🔙 Назад', callback_data='personal_cabinet')
+        )
+    )
 
-            already_completed = cursor.fetchone()
+@callback_route('show_content_plan')
+def handle_show_content_plan(call):
+    """Контент-план"""
+    chat_id = call.message.chat.id
+    content_plan_info = get_content_plan_info()
 
-            if not already_completed:
-                markup.add(
-                    types.InlineKeyboardButton(
-                        f"🚀 {task['task_name'][:30]}",
-                        callback_data=f"raspush_start_{task['id']}"
-                    )
-                )
+    if content_plan_info['file_id']:
+        # Отправляем изображение с подписью
+        bot.send_photo(
+            chat_id,
+            content_plan_info['file_id'],
+            caption=content_plan_info['caption'],
+            parse_mode='HTML'
+        )
 
-        markup.add(types.InlineKeyboardButton('🔙 Назад', callback_data='my_city_tasks'))
+        # Показываем кнопку "Назад" в отдельном сообщении
+        bot.send_message(
+            chat_id,
+            "⬇️ <b>Контент-план выше</b>",
+            parse_mode='HTML',
+            reply_markup=types.InlineKeyboardMarkup().add(
+                types.InlineKeyboardButton('🔙 Назад', callback_data='personal_cabinet')
+            )
+        )
 
+        # Удаляем предыдущее сообщение с личным кабинетом
+        bot.delete_message(chat_id, call.message.message_id)
+    else:
         bot.edit_message_text(
-            "🚀 <b>Активные задачи РАСПУШ</b>\n\n"
-            "Выберите задачу для выполнения:",
-            call.message.chat.id,
+            "📅 <b>Контент-план</b>\n\n"
+            "Контент-план ещё не загружен администратором.",
+            chat_id,
             call.message.message_id,
             parse_mode='HTML',
-            reply_markup=markup
+            reply_markup=types.InlineKeyboardMarkup().add(
+                types.InlineKeyboardButton('🔙 Назад', callback_data='personal_cabinet')
+            )
         )
 
-    elif call.data.startswith('accept_task:'):
-
-        task_uid = call.data.split(':', 1)[1]
-
-        user_id = call.from_user.id
+@callback_route('my_city_tasks')
+def handle_my_city_tasks(call):
+    """Мои задачи (по муниципалитету)"""
+    show_user_tasks_by_city(call.from_user.id, call.message.chat.id, message_id=call.message.message_id)
+
+@callback_route('all_tasks_list')
+def handle_all_tasks_list(call):
+    """Список всех задач"""
+    show_all_tasks(call.message.chat.id, message_id=call.message.message_id)
+
+@callback_route(prefix='city_tasks_page_', parse=int)
+def handle_city_tasks_page(call, page):
+    """Пагинация моих задач (по муниципалитету)"""
+    show_user_tasks_by_city(call.from_user.id, call.message.chat.id, page, call.message.message_id)
+
+@callback_route(prefix='all_tasks_page_', parse=int)
+def handle_all_tasks_page(call, page):
+    """Пагинация всех задач"""
+    show_all_tasks(call.message.chat.id, page, call.message.message_id)
+
+@callback_route(prefix='show_city_task_detail_', parse=split_args(str, int))
+def handle_show_city_task_detail(call, task_id, page_context=0):
+    """Детальный просмотр задачи из моего муниципалитета (show_city_task_detail_ID_страница)"""
+    show_task_detail_by_city(
+        call.from_user.id,
+        call.message.chat.id,
+        task_id,
+        page_context,
+        call.message.message_id
+    )
 
-        success, message = accept_task_by_uid(task_uid, user_id)
+@callback_route(prefix='show_all_task_detail_', parse=split_args(str, int))
+def handle_show_all_task_detail(call, task_id, page_context=0):
+    """Детальный просмотр задачи из общего списка (show_all_task_detail_ID_страница)"""
+    show_task_detail_all(
+        call.message.chat.id,
+        task_id,
+        page_context,
+        call.message.message_id
+    )
 
-        bot.answer_callback_query(call.id)
+@callback_route('admin_city_tasks', admin=True)
+def handle_admin_city_tasks(call):
+    """Админ: панель управления задачами"""
+    show_city_admin_tasks(call.message.chat.id, call.message.message_id)
 
-        if success:
+@callback_route('admin_add_task_city', admin=True)
+def handle_admin_add_task_city(call):
+    """Админ: добавить задачу муниципалитету"""
+    start_add_city_task_dialog(call.message.chat.id)
 
-            bot.edit_message_text(
+@callback_route(prefix='raspush_my_tasks_', parse=int)
+def handle_raspush_my_tasks(call, page):
+    """Показать активные задачи распуша в разделе Мои задачи"""
+    user_id = call.from_user.id
+    user = get_user_info(user_id)
 
-                message,
+    if not user or user['city'] == 'Не указан':
+        bot.answer_callback_query(call.id, "❌ Сначала выберите муниципалитет")
+        return
 
-                call.message.chat.id,
+    conn = get_db_read_connection()
+    cursor = conn.cursor()
 
-                call.message.message_id,
+    # Получаем активные задачи распуша
+    cursor.execute('''
+        SELECT id, task_name, task_description, expires_at
+        FROM raspush_tasks 
+        WHERE expires_at > datetime('now')
+        ORDER BY created_at DESC
+    ''')
 
-                parse_mode='HTML'
+    tasks = cursor.fetchall()
 
+    if not tasks:
+        bot.edit_message_text(
+            "📭 <b>Активных задач РАСПУШ нет</b>",
+            call.message.chat.id,
+            call.message.message_id,
+            parse_mode='HTML',
+            reply_markup=types.InlineKeyboardMarkup().add(
+                types.InlineKeyboardButton('🔙 Назад', callback_data='my_city_tasks')
             )
+        )
+        return
 
-        else:
-
-            bot.send_message(call.message.chat.id, message)
+    markup = types.InlineKeyboardMarkup()
+    for task in tasks[:5]:  # Показываем 5 последних
+        # Проверяем, выполнял ли уже этот муниципалитет
+        cursor.execute('''
+            SELECT 1 FROM raspush_completions 
+            WHERE task_id = ? AND city = ?
+        ''', (task['id'], user['city']))
 
+        already_completed = cursor.fetchone()
 
+        if not already_completed:
+            markup.add(
+                types.InlineKeyboardButton(
+                    f"🚀 {task['task_name'][:30]}",
+                    callback_data=f"raspush_start_{task['id']}"
+                )
+            )
 
-    # Кнопка "Снять задачу" в админ-панели
-    elif call.data == 'admin_complete_task_menu':
-        if not is_admin(call.from_user.id):
-            bot.answer_callback_query(call.id, "⛔ Нет доступа")
-            return
-        show_complete_task_menu(call.message.chat.id)
+    markup.add(types.InlineKeyboardButton('🔙 Назад', callback_data='my_city_tasks'))
 
-    elif call.data == 'admin_clear_responsible_menu':
-        if not is_admin(call.from_user.id):
-            bot.answer_callback_query(call.id, "⛔ Нет доступа")
-            return
-        show_clear_responsible_menu(call.message.chat.id)
+    bot.edit_message_text(
+        "🚀 <b>Активные задачи РАСПУШ</b>\n\n"
+        "Выберите задачу для выполнения:",
+        call.message.chat.id,
+        call.message.message_id,
+        parse_mode='HTML',
+        reply_markup=markup
+    )
 
-    elif call.data.startswith('complete_task_'):
-        if not is_admin(call.from_user.id):
-            bot.answer_callback_query(call.id, "⛔ Нет доступа")
-            return
+@callback_route(prefix='accept_task:')
+def handle_accept_task(call, task_uid):
+    """Принять свободную задачу на свой муниципалитет"""
+    success, message = accept_task_by_uid(task_uid, call.from_user.id)
 
-        task_index = int(call.data.replace('complete_task_', ''))
+    bot.answer_callback_query(call.id)
 
-        # Запрашиваем ID пользователя
-        msg = bot.send_message(
+    if success:
+        bot.edit_message_text(
+            message,
             call.message.chat.id,
-            "👤 <b>Отметить задачу выполненной</b>\n\n"
-            "Введите ID пользователя, который выполнил задачу:",
+            call.message.message_id,
             parse_mode='HTML'
         )
+    else:
+        bot.send_message(call.message.chat.id, message)
 
-        def process_user_for_completion(message):
-            try:
-                user_id = int(message.text)
-
-                # Запрашиваем баллы
-                msg2 = bot.send_message(
-                    message.chat.id,
-                    "💰 Введите количество баллов для начисления (0 если не нужно):",
-                    parse_mode='HTML'
-                )
+@callback_route('admin_complete_task_menu', admin=True)
+def handle_admin_complete_task_menu(call):
+    """Кнопка "Снять задачу" в админ-панели"""
+    show_complete_task_menu(call.message.chat.id)
 
-                def process_points_for_completion(msg2):
-                    try:
-                        points = int(msg2.text)
-                        if points < 0:
-                            bot.send_message(msg2.chat.id, "❌ Количество баллов не может быть отрицательным")
-                            return
-
-                        # Запрашиваем причину
-                        msg3 = bot.send_message(
-                            msg2.chat.id,
-                            "📝 Введите причину выполнения (или '-' для пропуска):",
-                            parse_mode='HTML'
-                        )
+@callback_route('admin_clear_responsible_menu', admin=True)
+def handle_admin_clear_responsible_menu(call):
+    """Админ: меню снятия ответственного"""
+    show_clear_responsible_menu(call.message.chat.id)
 
-                        def process_reason_for_completion(msg3):
-                            reason = msg3.text.strip()
-                            if reason == '-':
-                                reason = ""
-
-                            # Выполняем завершение задачи
-                            success, result = complete_task_with_points(
-                                task_index, user_id, points, reason
-                            )
-
-                            if success:
-                                # Получаем информацию о пользователе для красивого ответа
-                                user_info = get_user_info(user_id)
-                                if user_info:
-                                    city_emoji = AVAILABLE_CITIES.get(user_info['city'], '🏙️')
-                                    bot.send_message(
-                                        msg3.chat.id,
-                                        f"✅ <b>Задача отмечена выполненной!</b>\n\n"
-                                        f"<b>Исполнитель:</b> {user_info['first_name']} ({city_emoji} {user_info['city']})\n"
-                                        f"<b>Баллы:</b> {'+' + str(points) if points > 0 else '0'}\n"
-                                        f"<b>Причина:</b> {reason if reason else 'не указана'}\n\n"
-                                        f"{result}",
-                                        parse_mode='HTML'
-                                    )
-                                else:
-                                    bot.send_message(msg3.chat.id, result, parse_mode='HTML')
-                            else:
-                                bot.send_message(msg3.chat.id, result, parse_mode='HTML')
+@callback_route(prefix='complete_task_', admin=True)
+def handle_complete_task(call, task_id):
+    """Админ: отметить задачу выполненной"""
 
-                            # Возвращаем к списку задач
-                            show_city_admin_tasks(msg3.chat.id)
+    # Запрашиваем ID пользователя
+    msg = bot.send_message(
+        call.message.chat.id,
+        "👤 <b>Отметить задачу выполненной</b>\n\n"
+        "Введите ID пользователя, который выполнил задачу:",
+        parse_mode='HTML'
+    )
 
-                        bot.register_next_step_handler(msg3, process_reason_for_completion)
+    def process_user_for_completion(message):
+        try:
+            user_id = int(message.text)
 
-                    except ValueError:
-                        bot.send_message(msg2.chat.id, "❌ Введите число")
+            # Запрашиваем баллы
+            msg2 = bot.send_message(
+                message.chat.id,
+                "💰 Введите количество баллов для начисления (0 если не нужно):",
+                parse_mode='HTML'
+            )
 
-                bot.register_next_step_handler(msg2, process_points_for_completion)
+            def process_points_for_completion(msg2):
+                try:
+                    points = int(msg2.text)
+                    if points < 0:
+                        bot.send_message(msg2.chat.id, "❌ Количество баллов не может быть отрицательным")
+                        return
+
+                    # Запрашиваем причину
+                    msg3 = bot.send_message(
+                        msg2.chat.id,
+                        "📝 Введите причину выполнения (или '-' для пропуска):",
+                        parse_mode='HTML'
+                    )
 
-            except ValueError:
-                bot.send_message(message.chat.id, "❌ Введите числовой ID пользователя")
+                    def process_reason_for_completion(msg3):
+                        reason = msg3.text.strip()
+                        if reason == '-':
+                            reason = ""
 
-        bot.register_next_step_handler(msg, process_user_for_completion)
-    # ДОБАВИТЬ этот обработчик в callback_handler:
-    elif call.data == 'admin_delete_raspush_menu':
-        if not is_admin(call.from_user.id):
-            bot.answer_callback_query(call.id, "⛔ Нет доступа")
-            return
+                        # Выполняем завершение задачи
+                        success, result = complete_task_with_points(
+                            task_id, user_id, points, reason
+                        )
 
-        conn = get_db_connection()
-        cursor = conn.cursor()
+                        if success:
+                            # Получаем информацию о пользователе для красивого ответа
+                            user_info = get_user_info(user_id)
+                            if user_info:
+                                city_emoji = AVAILABLE_CITIES.get(user_info['city'], '🏙️')
+                                bot.send_message(
+                                    msg3.chat.id,
+                                    f"✅ <b>Задача отмечена выполненной!</b>\n\n"
+                                    f"<b>Исполнитель:</b> {user_info['first_name']} ({city_emoji} {user_info['city']})\n"
+                                    f"<b>Баллы:</b> {'+' + str(points) if points > 0 else '0'}\n"
+                                    f"<b>Причина:</b> {reason if reason else 'не указана'}\n\n"
+                                    f"{result}",
+                                    parse_mode='HTML'
+                                )
+                            else:
+                                bot.send_message(msg3.chat.id, result, parse_mode='HTML')
+                        else:
+                            bot.send_message(msg3.chat.id, result, parse_mode='HTML')
 
-        cursor.execute('''
-            SELECT id, task_name, created_at 
-            FROM raspush_tasks 
-            ORDER BY created_at DESC 
-            LIMIT 10
-        ''')
+                        # Возвращаем к списку задач
+                        show_city_admin_tasks(msg3.chat.id)
 
-        tasks = cursor.fetchall()
+                    bot.register_next_step_handler(msg3, process_reason_for_completion)
 
-        if not tasks:
-            bot.send_message(
-                call.message.chat.id,
-                "📭 <b>Нет активных задач РАСПУШ</b>",
-                parse_mode='HTML'
-            )
-            return
+                except ValueError:
+                    bot.send_message(msg2.chat.id, "❌ Введите число")
 
-        markup = types.InlineKeyboardMarkup()
-        for task in tasks:
-            date = datetime.strptime(task['created_at'], "%Y-%m-%d %H:%M:%S").strftime("%d.%m")
-            markup.add(
-                types.InlineKeyboardButton(
-                    f"#{task['id']} {task['task_name'][:20]} ({date})",
-                    callback_data=f"confirm_delete_raspush_{task['id']}"
-                )
-            )
+            bot.register_next_step_handler(msg2, process_points_for_completion)
 
-        markup.add(types.InlineKeyboardButton('🔙 Назад', callback_data='admin_city_tasks'))
+        except ValueError:
+            bot.send_message(message.chat.id, "❌ Введите числовой ID пользователя")
 
-        bot.edit_message_text(
-            "🗑️ <b>Выберите задачу РАСПУШ для удаления:</b>",
-            call.message.chat.id,
-            call.message.message_id,
-            parse_mode='HTML',
-            reply_markup=markup
-        )
+    bot.register_next_step_handler(msg, process_user_for_completion)
 
-    elif call.data.startswith('confirm_delete_raspush_'):
-        if not is_admin(call.from_user.id):
-            bot.answer_callback_query(call.id, "⛔ Нет доступа")
-            return
+@callback_route('admin_delete_raspush_menu', admin=True)
+def handle_admin_delete_raspush_menu(call):
+    """Админ: меню удаления задач распуша"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
 
-        task_id = int(call.data.split('_')[-1])
+    cursor.execute('''
+        SELECT id, task_name, created_at 
+        FROM raspush_tasks 
+        ORDER BY created_at DESC 
+        LIMIT 10
+    ''')
 
-        # Запрашиваем подтверждение
-        markup = types.InlineKeyboardMarkup()
-        markup.add(
-            types.InlineKeyboardButton('✅ Да, удалить', callback_data=f'execute_delete_raspush_{task_id}'),
-            types.InlineKeyboardButton('❌ Отмена', callback_data='admin_city_tasks')
-        )
+    tasks = cursor.fetchall()
 
-        bot.edit_message_text(
-            f"⚠️ <b>Вы уверены, что хотите удалить задачу #{task_id}?</b>\n\n"
-            f"Все отчеты по этой задаче также будут удалены.",
+    if not tasks:
+        bot.send_message(
             call.message.chat.id,
-            call.message.message_id,
-            parse_mode='HTML',
-            reply_markup=markup
+            "📭 <b>Нет активных задач РАСПУШ</b>",
+            parse_mode='HTML'
         )
+        return
 
-    elif call.data.startswith('execute_delete_raspush_'):
-        if not is_admin(call.from_user.id):
-            bot.answer_callback_query(call.id, "⛔ Нет доступа")
-            return
+    markup = types.InlineKeyboardMarkup()
+    for task in tasks:
+        date = datetime.strptime(task['created_at'], "%Y-%m-%d %H:%M:%S").strftime("%d.%m")
+        markup.add(
+            types.InlineKeyboardButton(
+                f"#{task['id']} {task['task_name'][:20]} ({date})",
+                callback_data=f"confirm_delete_raspush_{task['id']}"
+            )
+        )
 
-        task_id = int(call.data.split('_')[-1])
-        success, message = delete_raspush_task(task_id, call.from_user.id)
+    markup.add(types.InlineKeyboardButton('🔙 Назад', callback_data='admin_city_tasks'))
 
-        bot.answer_callback_query(call.id, "✅ Удалено" if success else "❌ Ошибка")
-        bot.send_message(call.message.chat.id, message, parse_mode='HTML')
+    bot.edit_message_text(
+        "🗑️ <b>Выберите задачу РАСПУШ для удаления:</b>",
+        call.message.chat.id,
+        call.message.message_id,
+        parse_mode='HTML',
+        reply_markup=markup
+    )
 
-        # Возвращаем к списку задач
-        show_city_admin_tasks(call.message.chat.id)
+@callback_route(prefix='confirm_delete_raspush_', parse=int, admin=True)
+def handle_confirm_delete_raspush(call, task_id):
+    """Админ: подтверждение удаления задачи распуша"""
+    # Запрашиваем подтверждение
+    markup = types.InlineKeyboardMarkup()
+    markup.add(
+        types.InlineKeyboardButton('✅ Да, удалить', callback_data=f'execute_delete_raspush_{task_id}'),
+        types.InlineKeyboardButton('❌ Отмена', callback_data='admin_city_tasks')
+    )
 
-    elif call.data.startswith('clear_responsible_'):
-        if not is_admin(call.from_user.id):
-            bot.answer_callback_query(call.id, "⛔ Нет доступа")
-            return
+    bot.edit_message_text(
+        f"⚠️ <b>Вы уверены, что хотите удалить задачу #{task_id}?</b>\n\n"
+        f"Все отчеты по этой задаче также будут удалены.",
+        call.message.chat.id,
+        call.message.message_id,
+        parse_mode='HTML',
+        reply_markup=markup
+    )
 
-        task_index = int(call.data.replace('clear_responsible_', ''))
+@callback_route(prefix='execute_delete_raspush_', parse=int, admin=True)
+def handle_execute_delete_raspush(call, task_id):
+    """Админ: удаление задачи распуша"""
+    success, message = delete_raspush_task(task_id, call.from_user.id)
 
-        # Просто очищаем ответственного
-        success, result = clear_task_responsible(task_index)
+    bot.answer_callback_query(call.id, "✅ Удалено" if success else "❌ Ошибка")
+    bot.send_message(call.message.chat.id, message, parse_mode='HTML')
 
-        if success:
-            bot.answer_callback_query(call.id, "✅ Ответственный очищен")
-            bot.send_message(
-                call.message.chat.id,
-                result,
-                parse_mode='HTML'
-            )
-        else:
-            bot.answer_callback_query(call.id, "❌ Ошибка")
-            bot.send_message(
-                call.message.chat.id,
-                result,
-                parse_mode='HTML'
-            )
+    # Возвращаем к списку задач
+    show_city_admin_tasks(call.message.chat.id)
 
-        # Возвращаем к списку задач
-        show_city_admin_tasks(call.message.chat.id)
+@callback_route(prefix='clear_responsible_', admin=True)
+def handle_clear_responsible(call, task_id):
+    """Админ: снять ответственного с задачи"""
+    # Просто очищаем ответственного
+    success, result = clear_task_responsible(task_id)
 
-    # Выбор муниципалитета для задачи
-    elif call.data.startswith('select_task_city_'):
-        city = call.data.split('_')[-1]
-        process_task_city_selection(call, city)
+    if success:
+        bot.answer_callback_query(call.id, "✅ Ответственный очищен")
+        bot.send_message(
+            call.message.chat.id,
+            result,
+            parse_mode='HTML'
+        )
+    else:
+        bot.answer_callback_query(call.id, "❌ Ошибка")
+        bot.send_message(
+            call.message.chat.id,
+            result,
+            parse_mode='HTML'
+        )
 
-    elif call.data == 'task_back_to_deadline':
-        # Возврат к выбору срока
-        process_task_city_selection(call, broadcast_cache.get(f"task_city_{call.from_user.id}"))
+    # Возвращаем к списку задач
+    show_city_admin_tasks(call.message.chat.id)
 
-    # Выбор награды
-    elif call.data.startswith('task_points_'):
-        if not is_admin(call.from_user.id):
-            bot.answer_callback_query(call.id, "⛔ Нет доступа")
-            return
-        points = call.data.replace('task_points_', '')
-        process_task_points_selection(call, points)
+@callback_route(prefix='select_task_city_')
+def handle_select_task_city(call, city):
+    """Выбор муниципалитета для задачи.
 
-    # Статистика задач
-    elif call.data == 'admin_tasks_stats':
-        if not is_admin(call.from_user.id):
-            bot.answer_callback_query(call.id, "⛔ Нет доступа")
-            return
+    city — весь остаток callback_data: 'ALL_MUNICIPALITIES' доходит целиком и ставит задачу
+    всем муниципалитетам (раньше split('_')[-1] превращал его в 'MUNICIPALITIES')
+    """
+    process_task_city_selection(call, city)
+
+@callback_route('task_back_to_deadline')
+def handle_task_back_to_deadline(call):
+    """Возврат к выбору срока задачи"""
+    process_task_city_selection(call, broadcast_cache.get(f"task_city_{call.from_user.id}"))
+
+@callback_route(prefix='task_points_', parse=int, admin=True)
+def handle_task_points(call, points):
+    """Выбор награды за задачу"""
+    process_task_points_selection(call, points)
+
+@callback_route('admin_tasks_stats', admin=True)
+def handle_admin_tasks_stats(call):
+    """Админ: статистика задач"""
+    conn = get_db_read_connection()
+    cursor = conn.cursor()
 
-        conn = get_db_connection()
-        cursor = conn.cursor()
+    cursor.execute('''
+            SELECT 
+                COUNT(*) as total_tasks,
+                SUM(CASE WHEN is_completed = 0 THEN 1 ELSE 0 END) as active_tasks,
+                SUM(CASE WHEN is_completed = 1 THEN 1 ELSE 0 END) as completed_tasks,
+                COUNT(DISTINCT assigned_city) as cities_count,
+                SUM(points_reward) as total_points
+            FROM bot_tasks
+        ''')
 
-        cursor.execute('''
-                SELECT 
-                    COUNT(*) as total_tasks,
-                    SUM(CASE WHEN is_completed = 0 THEN 1 ELSE 0 END) as active_tasks,
-                    SUM(CASE WHEN is_completed = 1 THEN 1 ELSE 0 END) as completed_tasks,
-                    COUNT(DISTINCT assigned_city) as cities_count,
-                    SUM(points_reward) as total_points
-                FROM bot_tasks
-            ''')
+    stats = cursor.fetchone()
 
-        stats = cursor.fetchone()
+    cursor.execute('''
+            SELECT assigned_city, COUNT(*) as task_count
+            FROM bot_tasks
+            WHERE is_completed = 0
+            GROUP BY assigned_city
+            ORDER BY task_count DESC
+            LIMIT 5
+        ''')
 
-        cursor.execute('''
-                SELECT assigned_city, COUNT(*) as task_count
-                FROM bot_tasks
-                WHERE is_completed = 0
-                GROUP BY assigned_city
-                ORDER BY task_count DESC
-                LIMIT 5
-            ''')
+    top_cities = cursor.fetchall()
 
-        top_cities = cursor.fetchall()
+    response = (
+        "📊 <b>Статистика задач</b>\n\n"
+        f"<b>Всего задач:</b> {stats['total_tasks']}\n"
+        f"<b>Активные:</b> {stats['active_tasks']}\n"
+        f"<b>Выполненные:</b> {stats['completed_tasks']}\n"
+        f"<b>Муниципалитетов с задачами:</b> {stats['cities_count']}\n"
+        f"<b>Всего баллов к начислению:</b> 🏅 {stats['total_points'] or 0}\n\n"
+    )
 
-        response = (
-            "📊 <b>Статистика задач</b>\n\n"
-            f"<b>Всего задач:</b> {stats['total_tasks']}\n"
-            f"<b>Активные:</b> {stats['active_tasks']}\n"
-            f"<b>Выполненные:</b> {stats['completed_tasks']}\n"
-            f"<b>Муниципалитетов с задачами:</b> {stats['cities_count']}\n"
-            f"<b>Всего баллов к начислению:</b> 🏅 {stats['total_points'] or 0}\n\n"
-        )
+    if top_cities:
+        response += "<b>🏆 Топ муниципалитетов по активным задачам:</b>\n"
+        for city in top_cities:
+            city_emoji = AVAILABLE_CITIES.get(city['assigned_city'], '🏙️')
+            response += f"• {city_emoji} {city['assigned_city']}: {city['task_count']} задач\n"
 
-        if top_cities:
-            response += "<b>🏆 Топ муниципалитетов по активным задачам:</b>\n"
-            for city in top_cities:
-                city_emoji = AVAILABLE_CITIES.get(city['assigned_city'], '🏙️')
-                response += f"• {city_emoji} {city['assigned_city']}: {city['task_count']} задач\n"
+    cache_stats = get_tasks_cache_stats()
+    response += (
+        f"\n<i>Кэш задач: попаданий {cache_stats['hits']}, "
+        f"промахов {cache_stats['misses']} ({cache_stats['hit_rate']}%)</i>"
+    )
 
-        bot.edit_message_text(
-            response,
-            call.message.chat.id,
-            call.message.message_id,
-            parse_mode='HTML',
-            reply_markup=types.InlineKeyboardMarkup().add(
-                types.InlineKeyboardButton('🔙 Назад', callback_data='admin_city_tasks')
-            )
+    bot.edit_message_text(
+        response,
+        call.message.chat.id,
+        call.message.message_id,
+        parse_mode='HTML',
+        reply_markup=types.InlineKeyboardMarkup().add(
+            types.InlineKeyboardButton('🔙 Назад', callback_data='admin_city_tasks')
         )
-    # Рассылка
-    elif call.data == 'admin_broadcast':
-        if not is_admin_user:
-            bot.answer_callback_query(call.id, "⛔ Нет доступа")
-            return
-        bot.delete_message(chat_id, call.message.message_id)
-        show_broadcast_options(chat_id)
-
-    elif call.data == 'broadcast_all':
-        if not is_admin_user:
-            bot.answer_callback_query(call.id, "⛔ Нет доступа")
-            return
-        bot.delete_message(chat_id, call.message.message_id)
-        ask_for_broadcast_text(chat_id, 'all', 'all')
+    )
 
-    elif call.data == 'broadcast_by_city':
-        if not is_admin_user:
-            bot.answer_callback_query(call.id, "⛔ Нет доступа")
-            return
-        bot.delete_message(chat_id, call.message.message_id)
-        show_cities_for_broadcast(chat_id)
+@callback_route('admin_broadcast', admin=True)
+def handle_admin_broadcast(call):
+    """Админ: рассылка"""
+    chat_id = call.message.chat.id
+    bot.delete_message(chat_id, call.message.message_id)
+    show_broadcast_options(chat_id)
 
-    elif call.data.startswith('broadcast_city_'):
-        if not is_admin_user:
-            bot.answer_callback_query(call.id, "⛔ Нет доступа")
-            return
-        city = call.data.replace('broadcast_city_', '')
-        bot.delete_message(chat_id, call.message.message_id)
-        ask_for_broadcast_text(chat_id, 'city', city)
+@callback_route('broadcast_all', admin=True)
+def handle_broadcast_all(call):
+    """Админ: рассылка всем пользователям"""
+    chat_id = call.message.chat.id
+    bot.delete_message(chat_id, call.message.message_id)
+    ask_for_broadcast_text(chat_id, 'all', 'all')
 
-    elif call.data.startswith('confirm_broadcast_'):
-        if not is_admin_user:
-            bot.answer_callback_query(call.id, "⛔ Нет доступа")
-            return
+@callback_route('broadcast_by_city', admin=True)
+def handle_broadcast_by_city(call):
+    """Админ: рассылка муниципалитету — выбор муниципалитета"""
+    chat_id = call.message.chat.id
+    bot.delete_message(chat_id, call.message.message_id)
+    show_cities_for_broadcast(chat_id)
 
-        cache_key = call.data.replace('confirm_broadcast_', '')
-        if cache_key not in broadcast_cache:
-            bot.answer_callback_query(call.id, "❌ Текст не найден")
-            return
+@callback_route(prefix='broadcast_city_', admin=True)
+def handle_broadcast_city(call, city):
+    """Админ: рассылка выбранному муниципалитету"""
+    chat_id = call.message.chat.id
+    bot.delete_message(chat_id, call.message.message_id)
+    ask_for_broadcast_text(chat_id, 'city', city)
 
-        broadcast_data = broadcast_cache[cache_key]
-        parts = cache_key.split('_')
-        target_type, target_value = parts[1], '_'.join(parts[2:])
+@callback_route(prefix='confirm_broadcast_', admin=True)
+def handle_confirm_broadcast(call, cache_key):
+    """Админ: подтверждение рассылки"""
+    user_id = call.from_user.id
+    chat_id = call.message.chat.id
+    if cache_key not in broadcast_cache:
+        bot.answer_callback_query(call.id, "❌ Текст не найден")
+        return
 
-        bot.delete_message(chat_id, call.message.message_id)
-        bot.send_message(chat_id, "⏳ <b>Рассылка запущена...</b>", parse_mode='HTML')
+    broadcast_data = broadcast_cache[cache_key]
+    parts = cache_key.split('_')
+    target_type, target_value = parts[1], '_'.join(parts[2:])
 
-        send_broadcast(chat_id, target_type, target_value, broadcast_data, user_id)
+    bot.delete_message(chat_id, call.message.message_id)
 
-        if cache_key in broadcast_cache:
-            del broadcast_cache[cache_key]
+    # Сообщения уходят через очередь, прогресс появится отдельным сообщением
+    send_broadcast(chat_id, target_type, target_value, broadcast_data, user_id)
 
-    # Список пользователей
-    elif call.data == 'admin_list_users':
-        if not is_admin_user:
-            bot.answer_callback_query(call.id, "⛔ Нет доступа")
-            return
+    if cache_key in broadcast_cache:
+        del broadcast_cache[cache_key]
 
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute('SELECT user_id, first_name, city, points FROM users ORDER BY points DESC LIMIT 20')
-        users = cursor.fetchall()
+@callback_route('admin_list_users', admin=True)
+def handle_admin_list_users(call):
+    """Админ: список пользователей"""
+    chat_id = call.message.chat.id
+    users = get_top_users(20)
 
-        response = "<b>📊 Список пользователей:</b>\n\n"
-        for i, user in enumerate(users, 1):
-            city_emoji = AVAILABLE_CITIES.get(user['city'], '🏙️')
-            response += f"{i}. {user['user_id']} | {user['first_name']} | {city_emoji} {user['city']} | {user['points']} баллов\n"
+    response = "<b>📊 Список пользователей:</b>\n\n"
+    for i, user in enumerate(users, 1):
+        city_emoji = AVAILABLE_CITIES.get(user['city'], '🏙️')
+        response += f"{i}. {user['user_id']} | {user['first_name']} | {city_emoji} {user['city']} | {user['points']} баллов\n"
 
-        bot.edit_message_text(
-            response,
-            chat_id,
-            call.message.message_id,
-            parse_mode='HTML',
-            reply_markup=types.InlineKeyboardMarkup().add(
-                types.InlineKeyboardButton('🔙 Назад', callback_data='admin_panel')
-            )
+    bot.edit_message_text(
+        response,
+        chat_id,
+        call.message.message_id,
+        parse_mode='HTML',
+        reply_markup=types.InlineKeyboardMarkup().add(
+            types.InlineKeyboardButton('🔙 Назад', callback_data='admin_panel')
         )
+    )
 
-    # Топ пользователей
-    elif call.data == 'top_users':
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute('SELECT first_name, city, points FROM users ORDER BY points DESC LIMIT 10')
-        top_users = cursor.fetchall()
+@callback_route('top_users')
+def handle_top_users(call):
+    """Топ пользователей"""
+    chat_id = call.message.chat.id
+    top_users = get_top_users(10)
 
-        response = "<b>🏆 Топ-10:</b>\n\n"
-        for i, user in enumerate(top_users, 1):
-            city_emoji = AVAILABLE_CITIES.get(user['city'], '🏙️')
-            medal = "🥇" if i == 1 else "🥈" if i == 2 else "🥉" if i == 3 else f"{i}."
-            response += f"{medal} {user['first_name']} ({city_emoji} {user['city']}): {user['points']} баллов\n"
+    response = "<b>🏆 Топ-10:</b>\n\n"
+    for i, user in enumerate(top_users, 1):
+        city_emoji = AVAILABLE_CITIES.get(user['city'], '🏙️')
+        medal = "🥇" if i == 1 else "🥈" if i == 2 else "🥉" if i == 3 else f"{i}."
+        response += f"{medal} {user['first_name']} ({city_emoji} {user['city']}): {user['points']} баллов\n"
 
-        markup = types.InlineKeyboardMarkup()
-        if is_admin_user:
-            markup.add(types.InlineKeyboardButton('⚙️ Админ-панель', callback_data='admin_panel'))
+    markup = types.InlineKeyboardMarkup()
+    if is_admin(call.from_user.id):
+        markup.add(types.InlineKeyboardButton('⚙️ Админ-панель', callback_data='admin_panel'))
 
-        bot.edit_message_text(response, chat_id, call.message.message_id, parse_mode='HTML', reply_markup=markup)
+    bot.edit_message_text(response, chat_id, call.message.message_id, parse_mode='HTML', reply_markup=markup)
 
-    # Выход из админ-панели
-    elif call.data == 'exit_admin':
-        bot.edit_message_text(
-            "✅ Вы вышли из админ-панели",
-            chat_id,
-            call.message.message_id,
-            reply_markup=types.InlineKeyboardMarkup().add(
-                types.InlineKeyboardButton('👤 Личный кабинет', callback_data='personal_cabinet')
-            )
+@callback_route('exit_admin')
+def handle_exit_admin(call):
+    """Выход из админ-панели"""
+    chat_id = call.message.chat.id
+    bot.edit_message_text(
+        "✅ Вы вышли из админ-панели",
+        chat_id,
+        call.message.message_id,
+        reply_markup=types.InlineKeyboardMarkup().add(
+            types.InlineKeyboardButton('👤 Личный кабинет', callback_data='personal_cabinet')
         )
+    )
 
+@bot.callback_query_handler(func=lambda call: True)
+def callback_handler(call):
+    """Единая точка входа для кнопок: маршрут ищется по таблице callback_route"""
+    route, raw_arg = find_callback_route(call.data)
+    if route is None:
+        return
 
-@bot.callback_query_handler(func=lambda call: call.data == "admin_create_raspush")
-def admin_create_raspush_handler(call):
-    if not is_admin(call.from_user.id):
+    if route['admin'] and not is_admin(call.from_user.id):
+        bot.answer_callback_query(call.id, "⛔ Нет доступа")
         return
 
-    msg = bot.send_message(
-        call.message.chat.id,
-        "🚀 <b>Создание задачи РАСПУШ</b>\n\n"
-        "Введите название задачи:",
-        parse_mode="HTML"
-    )
+    args = ()
+    if raw_arg is not None:
+        try:
+            arg = route['parse'](raw_arg) if route['parse'] else raw_arg
+        except (TypeError, ValueError):
+            bot.answer_callback_query(call.id, "❌ Некорректные данные кнопки")
+            return
+        args = arg if isinstance(arg, tuple) else (arg,)
+
+    started = time.perf_counter()
+    failed = False
+    try:
+        route['func'](call, *args)
+    except Exception:
+        failed = True
+        raise
+    finally:
+        record_callback_metric(route['name'], time.perf_counter() - started, failed)
 
-    bot.register_next_step_handler(msg, process_raspush_name)
 
 # ==============================
 # 8. ЗАПУСК БОТА
@@ -4880,24 +7248,44 @@ if __name__ == '__main__':
     print("Запуск бота...")
 
     try:
-        # 1. Создаем базовые таблицы
+        # 1. Приводим схему базы к текущей версии
         init_db()
 
-        # 2. Проверяем все таблицы
-        ensure_tables_exist()
+        # 2. В режиме SQLite переносим задачи из Excel при первом запуске,
+        # в режиме Excel записываем ID строкам, добавленным в файл вручную
+        if TASKS_STORAGE == 'sqlite':
+            ensure_tasks_imported()
+        elif os.path.exists(EXCEL_FILE_PATH):
+            materialize_task_ids()
 
         print("База данных готова к работе")
 
-        # Запускаем проверку дедлайнов в отдельном потоке
-        deadline_thread = threading.Thread(target=check_task_deadlines, daemon=True)
-        deadline_thread.start()
+        # Потоки отправки рассылок и уведомлений
+        start_outbound_workers()
+        resume_broadcast_jobs()
+
+        # Фоновые задания: очистка распуша, напоминания о дедлайнах
+        start_background_jobs()
+        signal.signal(signal.SIGTERM, handle_shutdown_signal)
+
+
+        # Потоки обработки входящих обновлений
+        if UPDATE_WORKERS > 0:
+            start_update_workers()
 
 
         # ГЛОБАЛЬНЫЙ ОБРАБОТЧИК ОШИБОК ДЛЯ ОПРОСА
         def polling_with_error_handling():
-            while True:
+            while not shutdown_event.is_set():
                 try:
-                    bot.polling(none_stop=True, interval=0, timeout=30, long_polling_timeout=30)
+                    if BOT_MODE == 'webhook':
+                        run_webhook()
+                    elif UPDATE_WORKERS > 0:
+                        poll_updates()
+                    else:
+                        # Обработчики выполняет telebot — ошибки с откатом записи ловит HandlerErrorHandler
+                        bot.exception_handler = HandlerErrorHandler()
+                        bot.polling(none_stop=True, interval=0, timeout=30, long_polling_timeout=30)
                 except Exception as e:
                     error_msg = f"Критическая ошибка polling: {str(e)}\n\n{traceback.format_exc()}"
                     print(f"Ошибка: {error_msg}")
@@ -4910,8 +7298,13 @@ if __name__ == '__main__':
         polling_thread = threading.Thread(target=polling_with_error_handling, daemon=True)
         polling_thread.start()
 
-        # Держим основной поток активным
-        polling_thread.join()
+        # Держим основной поток активным до Ctrl+C или SIGTERM
+        try:
+            polling_thread.join()
+        except (KeyboardInterrupt, SystemExit):
+            print("Остановка бота...")
+        finally:
+            stop_scheduler()
 
     except Exception as e:
         error_msg = f"Ошибка при запуске: {str(e)}\n\n{traceback.format_exc()}"